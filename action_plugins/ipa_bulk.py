@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2019 Red Hat
+# see file 'COPYING' for use and warranty information
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Base action for the identity modules that folds the iterations of a loop
+into one remote module run in bulk mode.
+
+On the first iteration all loop items are templated with the raw task
+arguments. If they are compatible, the module is executed once with the
+bulk parameter and the per item results are cached. The following
+iterations return the cached results without contacting the host. All
+other tasks are executed normally.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import copy
+
+from ansible.module_utils.six import string_types
+from ansible.parsing.mod_args import ModuleArgsParser
+from ansible.plugins.action import ActionBase
+
+# Cached bulk results indexed by task uuid and host
+_BULK_RESULTS = {}
+
+
+class ActionModule(ActionBase):
+
+    # The bulk parameter of the module
+    BULK_PARAM = None
+    # Aliases of the name parameter
+    NAME_ALIASES = []
+    # Per item settings with their aliases
+    ITEM_KEYS = {}
+    # States that accept item settings, in all other states only the name
+    # is used per item
+    SETTINGS_STATES = ["present"]
+
+    def run(self, tmp=None, task_vars=None):
+        if task_vars is None:
+            task_vars = dict()
+
+        cache_key = (self._task._uuid, task_vars.get("inventory_hostname"))
+        cached = _BULK_RESULTS.get(cache_key)
+        if cached is not None:
+            index = cached["index"]
+            if cached["args"][index] == self._task.args:
+                cached["index"] += 1
+                if cached["index"] >= len(cached["results"]):
+                    del _BULK_RESULTS[cache_key]
+                return copy.deepcopy(cached["results"][index])
+            # The loop changed, drop the cache
+            del _BULK_RESULTS[cache_key]
+
+        items_args = self._get_loop_args(task_vars)
+        if items_args is not None:
+            shared, items = self._fold(items_args)
+            if shared is not None:
+                results = self._run_bulk(task_vars, shared, items,
+                                         len(items_args))
+                if len(items_args) > 1:
+                    _BULK_RESULTS[cache_key] = {
+                        "args": items_args,
+                        "results": results,
+                        "index": 1,
+                    }
+                return copy.deepcopy(results[0])
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+        result.update(self._execute_module(task_vars=task_vars))
+        return result
+
+    def _get_loop_args(self, task_vars):
+        """
+        Return the templated task arguments for all loop items if this is
+        the first iteration of a plain loop, None otherwise.
+        """
+        task = self._task
+        if task.loop is None or task.loop_with or task.when or \
+           task.until or getattr(task, "_ds", None) is None:
+            return None
+
+        loop_var = "item"
+        if task.loop_control is not None and task.loop_control.loop_var:
+            loop_var = task.loop_control.loop_var
+
+        templar = self._templar
+        try:
+            items = templar.template(task.loop)
+            _action, raw_args, _delegate_to = ModuleArgsParser(
+                task_ds=task._ds).parse()
+        except Exception:
+            return None
+        if not isinstance(items, list) or len(items) < 1:
+            return None
+        if task_vars.get(loop_var) != items[0]:
+            return None
+
+        omit = task_vars.get("omit")
+        items_args = []
+        saved_vars = templar.available_variables
+        try:
+            for item in items:
+                templar.available_variables = dict(task_vars,
+                                                   **{loop_var: item})
+                args = templar.template(raw_args)
+                items_args.append(dict((key, value)
+                                       for key, value in args.items()
+                                       if value != omit))
+        except Exception:
+            return None
+        finally:
+            templar.available_variables = saved_vars
+
+        # Safety check: the first item needs to match the current args
+        if items_args[0] != task.args:
+            return None
+
+        return items_args
+
+    def _fold(self, items_args):
+        """
+        Split the item args into shared module args and bulk items, return
+        (None, None) if the items are not compatible.
+        """
+        aliases = {}
+        for key, key_aliases in self.ITEM_KEYS.items():
+            aliases[key] = key
+            for alias in key_aliases:
+                aliases[alias] = key
+
+        shared = None
+        items = []
+        names = set()
+        for args in items_args:
+            _shared = {}
+            item = {}
+            for key, value in args.items():
+                if key in ["name"] + self.NAME_ALIASES:
+                    if isinstance(value, list):
+                        if len(value) != 1:
+                            return None, None
+                        value = value[0]
+                    if not isinstance(value, string_types) or "," in value:
+                        return None, None
+                    item["name"] = value
+                elif key in aliases:
+                    item[aliases[key]] = value
+                elif key == self.BULK_PARAM:
+                    return None, None
+                else:
+                    _shared[key] = value
+
+            if "name" not in item:
+                return None, None
+            if item["name"].lower() in names:
+                return None, None
+            names.add(item["name"].lower())
+
+            state = _shared.get("state", "present")
+            if state not in self.SETTINGS_STATES and len(item) > 1:
+                return None, None
+            if state == "exact":
+                return None, None
+
+            if shared is None:
+                shared = _shared
+            elif shared != _shared:
+                return None, None
+            items.append(item)
+
+        return shared, items
+
+    def _run_bulk(self, task_vars, shared, items, count):
+        module_args = dict(shared)
+        module_args[self.BULK_PARAM] = items
+        module_result = self._execute_module(
+            module_name=self._task.action, module_args=module_args,
+            task_vars=task_vars)
+
+        base_result = super(ActionModule, self).run(None, task_vars)
+        results = []
+        for i in range(count):
+            result = copy.deepcopy(base_result)
+            if module_result.get("failed"):
+                result.update(module_result)
+            else:
+                item_result = module_result.get("results", [])[i]
+                result["changed"] = item_result.get("changed", False)
+                result["name"] = item_result.get("name")
+                result["bulk"] = True
+            results.append(result)
+        return results
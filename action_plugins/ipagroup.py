@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2019 Red Hat
+# see file 'COPYING' for use and warranty information
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Fold ipagroup loop iterations into one bulk module run, see ipa_bulk.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+from ansible.plugins.loader import action_loader
+
+IPABulkAction = action_loader.get("ipa_bulk", class_only=True)
+
+
+class ActionModule(IPABulkAction):
+
+    BULK_PARAM = "groups"
+    NAME_ALIASES = ["cn"]
+    ITEM_KEYS = {
+        "description": [],
+        "gid": ["gidnumber"],
+        "nonposix": [],
+        "external": [],
+        "nomembers": [],
+        "user": [],
+        "group": [],
+        "service": [],
+    }
+    SETTINGS_STATES = ["present", "absent"]
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2019 Red Hat
+# see file 'COPYING' for use and warranty information
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Options of the identity modules for the API backend and the command
+execution, see ipaapi_argument_spec in ansible_freeipa_module.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+
+class ModuleDocFragment(object):
+
+    DOCUMENTATION = """
+options:
+  ipaapi_server:
+    description:
+      Use the JSON-RPC API of this IPA server instead of the local server
+      API. The module can then be executed on any host, also the
+      controller. The commands are sent in batches. With auto the healthy
+      server with the lowest round trip time is used, the servers are
+      found with the _ldap._tcp SRV records of the domain or server_find
+      on the server in /etc/ipa/default.conf.
+    required: false
+  ipaapi_select_ttl:
+    description:
+      Seconds the server selected with ipaapi_server auto is cached, the
+      cached server is used as long as it answers
+    default: 3600
+  ipaapi_ca_cert:
+    description:
+      The CA certificate for the JSON-RPC connection
+      (default /etc/ipa/ca.crt if it exists)
+    required: false
+  ipaapi_session:
+    description:
+      The file to store the JSON-RPC session cookie in, so that following
+      tasks do not need to log in again
+      (default ~/.cache/ansible-freeipa/<server>-<principal>)
+    required: false
+  retry_attempts:
+    description:
+      The maximum number of attempts per command for transient errors like
+      a busy or unwilling server and timeouts, 1 disables retries
+    default: 5
+  throttle_latency:
+    description:
+      Execute the commands concurrently and adapt the number of commands
+      in flight to keep the latency per command below this value in
+      seconds. The limit grows additively and is halved on slow commands
+      or transient server errors.
+    required: false
+    type: float
+  throttle_concurrency:
+    description: The maximum number of commands in flight with throttle
+    default: 8
+  throttle_rate:
+    description:
+      Hard limit of commands per second, enables the throttle
+    required: false
+    type: float
+  ipaapi_shards:
+    description:
+      Distribute the commands over the JSON-RPC APIs of these IPA servers.
+      All commands of an entity are executed on the same server, the
+      membership commands are executed after the entities have been
+      replicated to all servers and the module waits until all changes
+      have been replicated. Servers without a DNA range or without enough
+      values for their share of the new entries get a range on demand.
+      The lookups use ipaapi_server or the local server API.
+    required: false
+    type: list
+  shard_timeout:
+    description:
+      Time in seconds to wait for the replication between the shard
+      servers
+    default: 300
+  plan:
+    description:
+      Apply the commands of a plan returned in check mode without redoing
+      the lookups. The plan is rejected if one of the entries has been
+      changed since the plan has been created. Masked passwords in the plan
+      are set with the password option. With ipaapi_server the entries are
+      compared with a digest of their attributes, a plan has to be applied
+      with the same API it has been created with.
+    required: false
+    type: list
+  ldif:
+    description:
+      Write the commands as LDIF change file to this path instead of
+      executing them, for example to apply them with ldapmodify -c. Added
+      entries get the IPA object classes and principal names, uidNumber
+      and gidNumber are assigned by the DNA plugin. Added users are added
+      to the default user group, the user private groups are created by
+      the Managed Entries plugin of the server. Member changes are single
+      multi-valued modify operations. The file is only readable by the
+      owner, it can contain passwords.
+    required: false
+  mirror:
+    description:
+      Path of a local directory mirror created with ipamirror. Lookups are
+      answered from the mirror if it is not older than mirror_max_age.
+    required: false
+  mirror_max_age:
+    description: Maximum age of the mirror in seconds
+    default: 3600
+"""
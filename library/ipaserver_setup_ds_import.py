@@ -0,0 +1,503 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Thomas Woerner <twoerner@redhat.com>
+#
+# Copyright (C) 2019  Red Hat
+# see file 'COPYING' for use and warranty information
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.0',
+    'supported_by': 'community',
+    'status': ['preview'],
+}
+
+DOCUMENTATION = '''
+---
+module: ipaserver_setup_ds_import
+short description: Seed the directory server with users and groups
+description:
+  Seed a freshly installed directory server with the users and groups of a
+  prepared LDIF file using the directory server bulk import. The entries
+  are converted to IPA entries (object classes, user private groups,
+  Kerberos principal names, ipaUniqueID) and get uidNumber and gidNumber
+  from the ID range. The userRoot backend is exported, merged with the new
+  entries and imported again with the import task. Afterwards the memberOf
+  attributes are rebuilt and the next value of the DNA plugin is moved
+  behind the assigned IDs.
+options:
+  dm_password:
+    description: Directory Manager password
+    required: yes
+  realm:
+    description: Kerberos realm name of the IPA deployment
+    required: yes
+  src:
+    description:
+      The LDIF file with the users (objectClass posixAccount or
+      inetOrgPerson) and groups (objectClass groupOfNames or posixGroup)
+    required: yes
+  timeout:
+    description: Timeout in seconds for every directory server task
+    required: no
+    default: 3600
+author:
+    - Thomas Woerner
+notes:
+  - Only pre-hashed userPassword values are imported. Cleartext passwords
+    are dropped, these users need a password reset.
+  - Entries with uid or cn values that already exist are skipped.
+'''
+
+EXAMPLES = '''
+- ipaserver_setup_ds_import:
+    dm_password: "{{ ipadm_password }}"
+    realm: "{{ result_ipaserver_test.realm }}"
+    src: /root/seed.ldif
+'''
+
+RETURN = '''
+users:
+  description: Number of imported users
+  returned: always
+  type: int
+groups:
+  description: Number of imported groups
+  returned: always
+  type: int
+skipped:
+  description: The uid and cn values of the skipped entries
+  returned: always
+  type: list
+id_range:
+  description: The first and last assigned ID
+  returned: if IDs have been assigned
+  type: list
+'''
+
+import os
+import pwd
+import time
+import uuid
+import tempfile
+import ldif
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_bytes, to_text
+from ansible.module_utils.ansible_ipa_server import (
+    DN, installutils
+)
+from ansible.module_utils.ansible_freeipa_module import LDIF_OBJECTCLASSES
+from ipapython import ipaldap
+
+DNA_POSIX_IDS = DN(('cn', 'Posix IDs'),
+                   ('cn', 'Distributed Numeric Assignment Plugin'),
+                   ('cn', 'plugins'), ('cn', 'config'))
+TASKS = DN(('cn', 'tasks'), ('cn', 'config'))
+LDIF_DIR = '/var/lib/dirsrv/slapd-%s/ldif'
+DS_USER = 'dirsrv'
+
+USER_OBJECTCLASSES = [b'posixaccount', b'inetorgperson']
+GROUP_OBJECTCLASSES = [b'groupofnames', b'posixgroup',
+                       b'groupofuniquenames']
+
+# Attributes taken over from the seed entries
+USER_ATTRIBUTES = ['givenname', 'sn', 'cn', 'displayname', 'initials',
+                   'gecos', 'homedirectory', 'loginshell', 'mail',
+                   'telephonenumber', 'mobile', 'title', 'ou',
+                   'employeenumber', 'employeetype', 'ipasshpubkey',
+                   'uidnumber', 'gidnumber', 'userpassword']
+GROUP_ATTRIBUTES = ['description', 'gidnumber']
+
+
+def _values(values):
+    return [to_bytes(to_text(x)) for x in values]
+
+
+def _first(entry, attr, default=None):
+    values = entry.get(attr)
+    if values:
+        return to_text(values[0])
+    return default
+
+
+class EntryReader(ldif.LDIFParser):
+    """
+    Stream the entries of a LDIF file to callback with lower case
+    attribute names
+    """
+
+    def __init__(self, path, callback):
+        self._file = open(path, 'rb')
+        ldif.LDIFParser.__init__(self, self._file)
+        self.callback = callback
+
+    def handle(self, dn, entry):
+        self.callback(dn, dict((attr.lower(), values)
+                               for attr, values in entry.items()))
+
+    def run(self):
+        try:
+            self.parse()
+        finally:
+            self._file.close()
+
+
+def entry_kind(entry):
+    objectclasses = [x.lower() for x in entry.get('objectclass', [])]
+    if any(x in objectclasses for x in USER_OBJECTCLASSES) and \
+       'uid' in entry:
+        return 'user'
+    if any(x in objectclasses for x in GROUP_OBJECTCLASSES):
+        return 'group'
+    return None
+
+
+class Seed(object):
+
+    def __init__(self, basedn, realm, next_id, max_id):
+        self.basedn = basedn
+        self.realm = realm
+        self.users_dn = DN(('cn', 'users'), ('cn', 'accounts'), basedn)
+        self.groups_dn = DN(('cn', 'groups'), ('cn', 'accounts'), basedn)
+        self.next_id = next_id
+        self.max_id = max_id
+        self.first_id = None
+        self.existing_users = set()
+        self.existing_groups = set()
+        self.users = set()
+        self.groups = set()
+        self.used_ids = set()
+        self.skipped = []
+
+    # pass 1: names and IDs
+
+    def collect_existing(self, dn, entry):
+        kind = entry_kind(entry)
+        if kind == 'user':
+            self.existing_users.add(_first(entry, 'uid').lower())
+        elif kind == 'group' or b'mepmanagedentry' in [
+                x.lower() for x in entry.get('objectclass', [])]:
+            self.existing_groups.add(_first(entry, 'cn').lower())
+        for attr in ['uidnumber', 'gidnumber']:
+            for value in entry.get(attr, []):
+                self.used_ids.add(int(value))
+
+    def collect_seed(self, dn, entry):
+        kind = entry_kind(entry)
+        if kind == 'user':
+            name = _first(entry, 'uid').lower()
+            # The user private group has the name of the user
+            if name in self.existing_users or name in self.users or \
+               name in self.existing_groups:
+                self.skipped.append(name)
+                return
+            self.users.add(name)
+        elif kind == 'group':
+            name = _first(entry, 'cn').lower()
+            if name in self.existing_groups or name in self.groups:
+                self.skipped.append(name)
+                return
+            self.groups.add(name)
+        else:
+            return
+        for attr in ['uidnumber', 'gidnumber']:
+            for value in entry.get(attr, []):
+                self.used_ids.add(int(value))
+
+    def check_conflicts(self):
+        for name in self.users & self.groups:
+            self.users.discard(name)
+            self.groups.discard(name)
+            self.skipped.append(name)
+
+    # pass 2: IPA entries
+
+    def allocate_id(self):
+        while self.next_id in self.used_ids:
+            self.next_id += 1
+        if self.next_id > self.max_id:
+            raise ValueError('The ID range is exhausted at %d' % self.max_id)
+        value = self.next_id
+        self.used_ids.add(value)
+        if self.first_id is None:
+            self.first_id = value
+        self.next_id += 1
+        return value
+
+    def user_entries(self, entry):
+        name = _first(entry, 'uid')
+        first = _first(entry, 'givenname', name)
+        last = _first(entry, 'sn', name)
+        fullname = _first(entry, 'cn', '%s %s' % (first, last))
+        principal = '%s@%s' % (name, self.realm)
+        dn = DN(('uid', name), self.users_dn)
+        upg_dn = DN(('cn', name), self.groups_dn)
+
+        attrs = dict((attr, entry[attr]) for attr in USER_ATTRIBUTES
+                     if attr in entry)
+        passwords = [x for x in attrs.pop('userpassword', [])
+                     if x.startswith(b'{')]
+        if passwords:
+            attrs['userpassword'] = passwords
+        if 'uidnumber' not in attrs:
+            attrs['uidnumber'] = _values([self.allocate_id()])
+        if 'gidnumber' not in attrs:
+            attrs['gidnumber'] = attrs['uidnumber']
+        defaults = {
+            'givenname': first,
+            'sn': last,
+            'cn': fullname,
+            'displayname': fullname,
+            'gecos': fullname,
+            'initials': '%s%s' % (first[:1], last[:1]),
+            'homedirectory': '/home/%s' % name,
+            'loginshell': '/bin/sh',
+        }
+        for attr, value in defaults.items():
+            if attr not in attrs:
+                attrs[attr] = _values([value])
+        attrs.update({
+            'objectclass': _values(LDIF_OBJECTCLASSES['user']),
+            'uid': _values([name]),
+            'krbprincipalname': _values([principal]),
+            'krbcanonicalname': _values([principal]),
+            'ipauniqueid': _values([uuid.uuid4()]),
+            'mepmanagedentry': _values([upg_dn]),
+        })
+        upg = {
+            'objectclass': _values(['top', 'mepmanagedentry', 'posixgroup',
+                                    'ipaobject']),
+            'cn': _values([name]),
+            'gidnumber': attrs['uidnumber'],
+            'description': _values(['User private group for %s' % name]),
+            'mepmanagedby': _values([dn]),
+            'ipauniqueid': _values([uuid.uuid4()]),
+        }
+        return [(dn, attrs), (upg_dn, upg)]
+
+    def dna_next_value(self):
+        """
+        Return the next free ID of the range behind all used IDs
+        """
+        used = [x for x in self.used_ids if x <= self.max_id]
+        return max([self.next_id] + [x + 1 for x in used])
+
+    def member_dn(self, value, attr_hint=None):
+        try:
+            rdn = DN(to_text(value))[0]
+            attr, name = rdn.attr.lower(), rdn.value
+        except ValueError:
+            attr, name = attr_hint, to_text(value)
+        key = name.lower()
+        if attr == 'uid' and (key in self.users or
+                              key in self.existing_users):
+            return DN(('uid', name), self.users_dn)
+        if attr == 'cn' and (key in self.groups or
+                             key in self.existing_groups):
+            return DN(('cn', name), self.groups_dn)
+        return None
+
+    def group_entries(self, entry):
+        name = _first(entry, 'cn')
+        attrs = dict((attr, entry[attr]) for attr in GROUP_ATTRIBUTES
+                     if attr in entry)
+        objectclasses = list(LDIF_OBJECTCLASSES['group']) + ['posixgroup']
+        if 'gidnumber' not in attrs:
+            attrs['gidnumber'] = _values([self.allocate_id()])
+        members = set()
+        for value in entry.get('member', []) + \
+                entry.get('uniquemember', []):
+            member = self.member_dn(value)
+            if member is not None:
+                members.add(member)
+        for value in entry.get('memberuid', []):
+            member = self.member_dn(value, 'uid')
+            if member is not None:
+                members.add(member)
+        if members:
+            attrs['member'] = _values(sorted(members))
+        attrs.update({
+            'objectclass': _values(objectclasses),
+            'cn': _values([name]),
+            'ipauniqueid': _values([uuid.uuid4()]),
+        })
+        return [(DN(('cn', name), self.groups_dn), attrs)]
+
+    def entries(self, entry):
+        kind = entry_kind(entry)
+        if kind == 'user':
+            if _first(entry, 'uid').lower() in self.users:
+                return self.user_entries(entry)
+        elif kind == 'group':
+            if _first(entry, 'cn').lower() in self.groups:
+                return self.group_entries(entry)
+        return []
+
+
+def run_task(conn, kind, attrs, timeout):
+    """
+    Add a directory server task and wait for it to finish
+    """
+    name = '%s-%d' % (kind.replace(' ', '-'), int(time.time() * 1000))
+    dn = DN(('cn', name), ('cn', kind), TASKS)
+    entry = conn.make_entry(dn, objectclass=['top', 'extensibleObject'],
+                            cn=[name], **attrs)
+    conn.add_entry(entry)
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(1)
+        task = conn.get_entry(dn, ['nstaskexitcode', 'nstaskstatus'])
+        exitcode = task.single_value.get('nstaskexitcode')
+        if exitcode is not None:
+            if int(exitcode) != 0:
+                raise RuntimeError('Task %s failed: %s' %
+                                   (kind, task.single_value.get(
+                                       'nstaskstatus')))
+            return
+    raise RuntimeError('Task %s timed out after %d seconds' %
+                       (kind, timeout))
+
+
+def main():
+    ansible_module = AnsibleModule(
+        argument_spec=dict(
+            dm_password=dict(required=True, no_log=True),
+            realm=dict(required=True),
+            src=dict(required=True, type='path'),
+            timeout=dict(required=False, type='int', default=3600),
+        ),
+    )
+
+    ansible_module._ansible_debug = True
+
+    # set values ############################################################
+
+    dm_password = ansible_module.params.get('dm_password')
+    realm = ansible_module.params.get('realm')
+    src = ansible_module.params.get('src')
+    timeout = ansible_module.params.get('timeout')
+
+    # init ##################################################################
+
+    if hasattr(ipaldap, 'realm_to_serverid'):
+        instance = ipaldap.realm_to_serverid(realm)
+    else:
+        instance = installutils.realm_to_serverid(realm)
+    ldif_dir = LDIF_DIR % instance
+    dirsrv = pwd.getpwnam(DS_USER)
+
+    conn = ipaldap.LDAPClient(ipaldap.realm_to_ldapi_uri(realm))
+    conn.simple_bind(DN(('cn', 'directory manager')), dm_password)
+
+    basedn = DN(conn.get_entry(DN(''), ['defaultnamingcontext'])
+                .single_value['defaultnamingcontext'])
+    dna = conn.get_entry(DNA_POSIX_IDS, ['dnanextvalue', 'dnamaxvalue'])
+    seed = Seed(basedn, realm, int(dna.single_value['dnanextvalue']),
+                int(dna.single_value['dnamaxvalue']))
+
+    exported = None
+    merged = None
+    try:
+        # export userRoot ###################################################
+
+        fd, exported = tempfile.mkstemp(dir=ldif_dir, prefix='seed-export-',
+                                        suffix='.ldif')
+        os.close(fd)
+        os.chown(exported, dirsrv.pw_uid, dirsrv.pw_gid)
+        run_task(conn, 'export', {'nsInstance': ['userRoot'],
+                                  'nsFilename': [exported]}, timeout)
+
+        # collect names and IDs #############################################
+
+        EntryReader(exported, seed.collect_existing).run()
+        EntryReader(src, seed.collect_seed).run()
+        seed.check_conflicts()
+
+        if not seed.users and not seed.groups:
+            ansible_module.exit_json(changed=False, users=0, groups=0,
+                                     skipped=seed.skipped)
+
+        # merge #############################################################
+
+        ipausers_dn = DN(('cn', 'ipausers'), seed.groups_dn)
+        new_members = _values(sorted(DN(('uid', name), seed.users_dn)
+                                     for name in seed.users))
+
+        fd, merged = tempfile.mkstemp(dir=ldif_dir, prefix='seed-merged-',
+                                      suffix='.ldif')
+        with os.fdopen(fd, 'w') as out:
+            writer = ldif.LDIFWriter(out, cols=76)
+
+            def copy_existing(dn, entry):
+                # New users are members of the default group ipausers
+                if DN(dn) == ipausers_dn:
+                    entry['member'] = entry.get('member', []) + new_members
+                writer.unparse(dn, entry)
+
+            def write_seed(dn, entry):
+                for _dn, attrs in seed.entries(entry):
+                    writer.unparse(str(_dn), attrs)
+
+            EntryReader(exported, copy_existing).run()
+            EntryReader(src, write_seed).run()
+        os.chown(merged, dirsrv.pw_uid, dirsrv.pw_gid)
+
+        # import ############################################################
+
+        run_task(conn, 'import', {'nsInstance': ['userRoot'],
+                                  'nsFilename': [merged]}, timeout)
+
+        # fixups ############################################################
+
+        conn.close()
+        conn = ipaldap.LDAPClient(ipaldap.realm_to_ldapi_uri(realm))
+        conn.simple_bind(DN(('cn', 'directory manager')), dm_password)
+
+        run_task(conn, 'memberof task', {'basedn': [str(basedn)],
+                                         'filter': ['(objectclass=*)']},
+                 timeout)
+
+        dna = conn.get_entry(DNA_POSIX_IDS, ['dnanextvalue'])
+        next_value = seed.dna_next_value()
+        if int(dna.single_value['dnanextvalue']) < next_value:
+            dna['dnanextvalue'] = [str(next_value)]
+            conn.update_entry(dna)
+
+    except Exception as e:
+        ansible_module.fail_json(msg=str(e))
+
+    finally:
+        conn.close()
+        for path in [exported, merged]:
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+    # done ##################################################################
+
+    exit_args = {}
+    if seed.first_id is not None:
+        exit_args['id_range'] = [seed.first_id, seed.next_id - 1]
+    ansible_module.exit_json(changed=True, users=len(seed.users),
+                             groups=len(seed.groups), skipped=seed.skipped,
+                             **exit_args)
+
+
+if __name__ == '__main__':
+    main()
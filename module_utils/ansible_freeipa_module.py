@@ -22,21 +22,54 @@
 
 
 import os
+import re
+import errno
+import ssl
 import uuid
 import tempfile
 import shutil
-import gssapi
+import json
+import time
+import hashlib
+import socket
+import base64
+import random
+import sqlite3
+import threading
 from datetime import datetime
-from ipalib import api
-from ipalib.config import Env
-from ipalib.constants import DEFAULT_CONFIG, LDAP_GENERALIZED_TIME_FORMAT
+from ansible.module_utils._text import to_text, to_bytes
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.module_utils.six.moves import http_client, configparser
+from ansible.module_utils.six.moves.http_cookies import SimpleCookie
+from ansible.module_utils.six.moves.urllib.parse import urlencode
 try:
-    from ipalib.install.kinit import kinit_password, kinit_keytab
+    import gssapi
+    import ldap as _ldap
+    import ldif
+    from ldap.controls import SimplePagedResultsControl
+    from ipalib import api, errors
+    from ipalib.config import Env
+    from ipalib.constants import DEFAULT_CONFIG, LDAP_GENERALIZED_TIME_FORMAT
+    try:
+        from ipalib.install.kinit import kinit_password, kinit_keytab
+    except ImportError:
+        from ipapython.ipautil import kinit_password, kinit_keytab
+    from ipapython.ipautil import run
+    from ipapython.dn import DN
+    from ipaplatform.paths import paths
+    from ipalib.krb_utils import get_credentials_if_valid
+    from ipapython.ipaldap import LDAPClient
+except ImportError:
+    # The JSON-RPC backend can be used without the IPA python bindings,
+    # for example on the controller.
+    HAS_IPALIB = False
+    LDAP_GENERALIZED_TIME_FORMAT = "%Y%m%d%H%M%SZ"
+else:
+    HAS_IPALIB = True
+try:
+    from dns import resolver as dns_resolver
 except ImportError:
-    from ipapython.ipautil import kinit_password, kinit_keytab
-from ipapython.ipautil import run
-from ipaplatform.paths import paths
-from ipalib.krb_utils import get_credentials_if_valid
+    dns_resolver = None
 
 
 def valid_creds(module, principal):
@@ -120,16 +153,1245 @@ def api_connect():
     api.Backend.ldap2.connect()
 
 
+def api_paged_search(base_dn, ldap_filter, attrs_list=None, scope=None,
+                     page_size=1000):
+    """
+    Iterate over the entries of a LDAP search on the ldap2 connection using
+    the simple paged results control. Only the current page is held in
+    memory, the entries are yielded as LDAPEntry objects.
+    """
+    ldap2 = api.Backend.ldap2
+    if scope is None:
+        scope = ldap2.SCOPE_SUBTREE
+    if attrs_list is not None:
+        attrs_list = [str(attr) for attr in attrs_list]
+
+    cookie = b""
+    while True:
+        control = SimplePagedResultsControl(True, size=page_size,
+                                            cookie=cookie)
+        with ldap2.error_handler():
+            msgid = ldap2.conn.search_ext(str(base_dn), scope,
+                                          str(ldap_filter), attrs_list,
+                                          serverctrls=[control])
+        while True:
+            with ldap2.error_handler():
+                rtype, rdata, _rmsgid, rctrls = ldap2.conn.result3(msgid,
+                                                                   all=0)
+            if rtype == _ldap.RES_SEARCH_ENTRY:
+                for entry in ldap2._convert_result(rdata):
+                    yield entry
+            elif rtype == _ldap.RES_SEARCH_RESULT:
+                break
+
+        cookie = None
+        for rctrl in rctrls or []:
+            if rctrl.controlType == SimplePagedResultsControl.controlType:
+                cookie = rctrl.cookie
+        if not cookie:
+            break
+
+
+# Errors that are retried: error names and, for the generic errors, the
+# messages of transient directory server conditions
+RETRY_ERROR_NAMES = ["NetworkError", "ServerNetworkError", "DatabaseTimeout"]
+RETRY_ERROR_MESSAGES = re.compile(
+    r"busy|unwilling to perform|timed? ?out|temporarily unavailable|"
+    r"connection reset|can't contact ldap server|server is down",
+    re.IGNORECASE)
+RETRY_HTTP_CODES = [502, 503, 504]
+
+# Socket errors of a refused, lost or unreachable connection, other
+# IOError and OSError errors are not transient
+RETRY_ERRNOS = [errno.ECONNREFUSED, errno.ECONNRESET, errno.ECONNABORTED,
+                errno.ETIMEDOUT, errno.EHOSTUNREACH, errno.ENETUNREACH,
+                errno.ENETDOWN, errno.EPIPE]
+
+# Errors of a re-applied command that show that an earlier attempt has
+# already been applied
+RETRY_APPLIED_ERRORS = {
+    "add": "DuplicateEntry",
+    "del": "NotFound",
+    "mod": "EmptyModlist",
+    "enable": "AlreadyActive",
+    "disable": "AlreadyInactive",
+}
+
+_retry_policy = {"attempts": 5, "base_delay": 0.5, "max_delay": 30.0}
+_retry_stats = {"retries": 0, "retried_commands": 0, "recovered": 0,
+                "already_applied": 0, "gave_up": 0, "delay": 0.0}
+# The statistics are updated from the worker threads of the shards
+_retry_lock = threading.Lock()
+
+
+def retry_configure(attempts=None, base_delay=None, max_delay=None):
+    """
+    Set the retry policy for transient errors, attempts is the maximum
+    number of attempts per command, 1 disables retries
+    """
+    if attempts is not None:
+        _retry_policy["attempts"] = max(1, attempts)
+    if base_delay is not None:
+        _retry_policy["base_delay"] = base_delay
+    if max_delay is not None:
+        _retry_policy["max_delay"] = max_delay
+
+
+def retry_stats():
+    """
+    Return the retry statistics for the module result
+    """
+    with _retry_lock:
+        stats = dict(_retry_stats)
+    stats["delay"] = round(stats["delay"], 3)
+    return stats
+
+
+def retryable_error(name, message, code=None):
+    """
+    Return True if the error is transient and the command can be retried
+    """
+    if name in RETRY_ERROR_NAMES:
+        return True
+    if name == "HTTPError":
+        return code in RETRY_HTTP_CODES
+    if name in [None, "DatabaseError", "ExecutionError"]:
+        return RETRY_ERROR_MESSAGES.search(to_text(message or "")) \
+            is not None
+    return False
+
+
+def _retryable_exception(e):
+    if isinstance(e, JSONRPCError):
+        return retryable_error(e.name, str(e), e.code)
+    if isinstance(e, ssl.CertificateError):
+        return False
+    if isinstance(e, (http_client.HTTPException, ssl.SSLError,
+                      socket.timeout)):
+        return True
+    if isinstance(e, socket.gaierror):
+        return e.errno == socket.EAI_AGAIN
+    if isinstance(e, (IOError, OSError)):
+        return e.errno in RETRY_ERRNOS
+    return retryable_error(e.__class__.__name__, str(e))
+
+
+def _retry_count(key, value=1):
+    with _retry_lock:
+        _retry_stats[key] += value
+
+
+def _error_name(e):
+    if isinstance(e, JSONRPCError):
+        return e.name
+    return e.__class__.__name__
+
+
+def _applied_error(command, error_name):
+    action = command.partition("_")[2]
+    return error_name is not None and \
+        RETRY_APPLIED_ERRORS.get(action) == error_name
+
+
+def _retry_delay(attempt):
+    """
+    Sleep with full jitter exponential backoff before attempt
+    """
+    delay = random.uniform(0, min(_retry_policy["max_delay"],
+                                  _retry_policy["base_delay"] *
+                                  2 ** (attempt - 1)))
+    if _throttle is not None:
+        # A transient error is a sign of an overloaded server
+        _throttle.overloaded()
+    _retry_count("retries")
+    _retry_count("delay", delay)
+    time.sleep(delay)
+
+
+def _command(command, name, args):
+    client = _jsonrpc_client()
+    if client is not None:
+        return client.command(command, name, args)
+    return api.Command[command](name, **args)
+
+
+def _command_applied(command, name, args):
+    """
+    Re-check the state of the entity of a failed add, del or undel command
+    before it is applied again. Return True if the command has already
+    been applied.
+    """
+    kind, _sep, action = command.partition("_")
+    if action not in ["add", "del", "undel"] or name is None:
+        return False
+    try:
+        result = _command("%s_show" % kind, name, {})["result"]
+    except Exception as e:
+        return action == "del" and _error_name(e) == "NotFound"
+    if action == "add":
+        return True
+    if action == "del":
+        return bool(args.get("preserve")) and \
+            bool(result.get("preserved", False))
+    return not result.get("preserved", False)
+
+
+def api_command_retry(command, name, args):
+    """
+    Execute a command, retry transient errors with backoff. Raise the
+    error if it is fatal or the attempts are exhausted.
+    """
+    attempt = 1
+    while True:
+        try:
+            result = _command(command, name, args)
+            if attempt > 1:
+                _retry_count("recovered")
+            return result
+        except Exception as e:
+            if attempt > 1 and _applied_error(command, _error_name(e)):
+                _retry_count("already_applied")
+                return {}
+            if not _retryable_exception(e):
+                raise
+            if attempt >= _retry_policy["attempts"]:
+                _retry_count("gave_up")
+                raise
+        if attempt == 1:
+            _retry_count("retried_commands")
+        attempt += 1
+        _retry_delay(attempt)
+        if _command_applied(command, name, args):
+            _retry_count("already_applied")
+            return {}
+
+
 def api_command(module, command, name, args):
     """
     Call ipa.Command, use AnsibleModule.fail_json for error handling
     """
     try:
-        return api.Command[command](name, **args)
+        return api_command_retry(command, name, args)
     except Exception as e:
         module.fail_json(msg="%s: %s" % (command, e))
 
 
+def _batch(methods):
+    """
+    Call the batch command, retry transient errors of the whole call.
+    Return the results and if the call has been retried.
+    """
+    attempt = 1
+    while True:
+        try:
+            client = _jsonrpc_client()
+            if client is not None:
+                return client.batch(methods), attempt > 1
+            return api.Command["batch"](*methods)["results"], attempt > 1
+        except Exception as e:
+            if not _retryable_exception(e):
+                raise
+            if attempt >= _retry_policy["attempts"]:
+                _retry_count("gave_up")
+                raise
+        attempt += 1
+        _retry_delay(attempt)
+
+
+def api_command_batch(module, commands):
+    """
+    Execute a list of [name, command, args] with the batch command, return
+    the list of results. Failed commands have an error key in the result.
+    Commands with transient errors are retried with backoff, the state of
+    the entity is checked before a command is applied again.
+    """
+    try:
+        return _batch_retry(commands)
+    except Exception as e:
+        module.fail_json(msg="batch: %s" % e)
+
+
+def _batch_retry(commands):
+    results = [None] * len(commands)
+    pending = list(range(len(commands)))
+    attempt = 1
+    while True:
+        methods = [
+            {"method": commands[i][1],
+             "params": [[to_text(commands[i][0])]
+                        if commands[i][0] is not None else [],
+                        commands[i][2]]}
+            for i in pending
+        ]
+        _results, retried = _batch(methods)
+
+        retry = []
+        for i, result in zip(pending, _results):
+            command = commands[i][1]
+            error_name = result.get("error_name")
+            if result.get("error") is not None:
+                if (attempt > 1 or retried) and \
+                   _applied_error(command, error_name):
+                    _retry_count("already_applied")
+                    result = {}
+                elif retryable_error(error_name, result["error"],
+                                     result.get("error_code")):
+                    if attempt < _retry_policy["attempts"]:
+                        retry.append(i)
+                        continue
+                    _retry_count("gave_up")
+            elif attempt > 1:
+                _retry_count("recovered")
+            results[i] = result
+        if not retry:
+            return results
+
+        if attempt == 1:
+            _retry_count("retried_commands", len(retry))
+        attempt += 1
+        _retry_delay(attempt)
+        pending = []
+        for i in retry:
+            name, command, args = commands[i]
+            if _command_applied(command, name, args):
+                _retry_count("already_applied")
+                results[i] = {}
+            else:
+                pending.append(i)
+        if not pending:
+            return results
+
+
+def execute_commands(module, commands, batch_size=100):
+    """
+    Execute a list of [name, command, args], use AnsibleModule.fail_json
+    for error handling. With the JSON-RPC backend the commands are sent in
+    batches of batch_size to save round trips. Transient errors are
+    retried. With a throttle configured the commands are executed
+    concurrently within its limits, with shards configured they are
+    distributed over the shard servers. Return the set of lower case names
+    that have been changed.
+    """
+    if _shards is not None:
+        return _execute_sharded(module, commands, batch_size)
+    if _throttle is not None:
+        return _execute_throttled(module, commands, batch_size)
+
+    changed_names = set()
+    if _jsonrpc is None:
+        for name, command, args in commands:
+            try:
+                api_command_retry(command, to_text(name), args)
+                changed_names.add(to_text(name).lower())
+            except Exception as e:
+                module.fail_json(msg="%s: %s: %s" % (command, name, str(e)))
+        return changed_names
+
+    for i in range(0, len(commands), batch_size):
+        chunk = commands[i:i + batch_size]
+        results = api_command_batch(module, chunk)
+        for (name, command, _args), result in zip(chunk, results):
+            if result.get("error") is not None:
+                module.fail_json(msg="%s: %s: %s" % (command, name,
+                                                     result["error"]))
+            changed_names.add(to_text(name).lower())
+    return changed_names
+
+
+class AdaptiveThrottle(object):
+    """
+    AIMD limit for the number of commands in flight
+
+    The limit grows by one per round of commands that finish within
+    target_latency and is halved if a command takes longer or a transient
+    server error is retried, at most once per round. max_rate is an
+    optional hard limit of commands per second.
+    """
+
+    def __init__(self, target_latency=0.5, max_concurrency=8,
+                 max_rate=None):
+        self.target_latency = target_latency
+        self.max_concurrency = max(1, max_concurrency)
+        self.interval = 1.0 / max_rate if max_rate else 0.0
+        self.limit = 1.0
+        self.inflight = 0
+        self.next_start = 0.0
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+        self.stats = {"commands": 0, "latency": 0.0, "latency_max": 0.0,
+                      "decreases": 0, "limit_max": 1, "wait": 0.0}
+
+    def acquire(self, count=1):
+        """
+        Wait for a free slot for count commands, return the start time
+        """
+        start = time.time()
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+            now = time.time()
+            slot = max(now, self.next_start)
+            self.next_start = slot + self.interval * count
+        if slot > now:
+            time.sleep(slot - now)
+        started = time.time()
+        with self.cond:
+            self.stats["wait"] += started - start
+        return started
+
+    def _decrease(self, started):
+        # Only one decrease per round: commands that started before the
+        # last decrease do not reduce the limit again
+        if started > self.last_decrease:
+            self.limit = max(1.0, self.limit / 2)
+            self.last_decrease = time.time()
+            self.stats["decreases"] += 1
+
+    def overloaded(self):
+        with self.cond:
+            now = time.time()
+            if now - self.last_decrease > self.target_latency:
+                self._decrease(now)
+
+    def release(self, started, count=1):
+        """
+        Release the slot of count commands started at started
+        """
+        latency = (time.time() - started) / max(1, count)
+        with self.cond:
+            self.inflight -= 1
+            self.stats["commands"] += count
+            self.stats["latency"] += latency * count
+            self.stats["latency_max"] = max(self.stats["latency_max"],
+                                            latency)
+            if latency > self.target_latency:
+                self._decrease(started)
+            else:
+                self.limit = min(self.max_concurrency,
+                                 self.limit + 1.0 / self.limit)
+            self.stats["limit_max"] = max(self.stats["limit_max"],
+                                          int(self.limit))
+            self.cond.notify_all()
+
+
+# Commands are executed phase by phase, within a phase the commands of
+# different entities run concurrently
+THROTTLE_PHASES = [
+    ["add", "undel"],
+    ["mod", "enable", "disable", "unlock"],
+    ["add_member", "remove_member"],
+    ["del"],
+]
+
+_throttle = None
+_local = threading.local()
+
+
+def throttle_configure(target_latency=0.5, max_concurrency=8,
+                       max_rate=None):
+    """
+    Execute the commands of execute_commands concurrently with an
+    adaptive limit, see AdaptiveThrottle
+    """
+    global _throttle
+
+    _throttle = AdaptiveThrottle(target_latency, max_concurrency, max_rate)
+    return _throttle
+
+
+def throttle_stats():
+    """
+    Return the throttle statistics for the module result, None if there
+    is no throttle
+    """
+    if _throttle is None:
+        return None
+    stats = dict(_throttle.stats)
+    commands = stats["commands"]
+    stats["latency"] = round(stats["latency"] / commands, 3) \
+        if commands else 0.0
+    stats["latency_max"] = round(stats["latency_max"], 3)
+    stats["wait"] = round(stats["wait"], 3)
+    stats["limit"] = int(_throttle.limit)
+    return stats
+
+
+def _command_phase(command):
+    action = command.partition("_")[2]
+    for i, actions in enumerate(THROTTLE_PHASES):
+        if action in actions:
+            return i
+    return 1
+
+
+def _execute_unit(unit):
+    """
+    Execute the commands of a unit in order, raise RuntimeError on errors
+    """
+    if _jsonrpc_client() is None:
+        for name, command, args in unit:
+            try:
+                api_command_retry(command, to_text(name), args)
+            except Exception as e:
+                raise RuntimeError("%s: %s: %s" % (command, name, str(e)))
+        return
+    try:
+        results = _batch_retry(unit)
+    except Exception as e:
+        raise RuntimeError("batch: %s" % e)
+    for (name, command, _args), result in zip(unit, results):
+        if result.get("error") is not None:
+            raise RuntimeError("%s: %s: %s" % (command, name,
+                                               result["error"]))
+
+
+def _execute_throttled(module, commands, batch_size):
+    changed_names = set()
+    failed = []
+
+    def _worker(queue):
+        # Every thread has its own LDAP connection or JSON-RPC client
+        connected = False
+        if _jsonrpc is not None:
+            _local.jsonrpc = _jsonrpc.clone()
+        elif not api.Backend.ldap2.isconnected():
+            api.Backend.ldap2.connect()
+            connected = True
+        try:
+            while not failed:
+                try:
+                    unit = queue.pop(0)
+                except IndexError:
+                    return
+                started = _throttle.acquire(len(unit))
+                try:
+                    _execute_unit(unit)
+                    changed_names.update(to_text(name).lower()
+                                         for name, _command, _args in unit)
+                except Exception as e:
+                    failed.append(str(e))
+                finally:
+                    _throttle.release(started, len(unit))
+        finally:
+            if _jsonrpc is not None:
+                _local.jsonrpc.close()
+                _local.jsonrpc = None
+            elif connected:
+                api.Backend.ldap2.disconnect()
+
+    for phase in range(len(THROTTLE_PHASES)):
+        phase_commands = [x for x in commands
+                          if _command_phase(x[1]) == phase]
+        if not phase_commands:
+            continue
+        if _jsonrpc is None:
+            # The commands of an entity stay in order in one unit
+            units = {}
+            for name, command, args in phase_commands:
+                units.setdefault(to_text(name).lower(), []).append(
+                    [name, command, args])
+            queue = list(units.values())
+        else:
+            queue = [phase_commands[i:i + batch_size]
+                     for i in range(0, len(phase_commands), batch_size)]
+
+        threads = [threading.Thread(target=_worker, args=(queue,))
+                   for _i in range(min(_throttle.max_concurrency,
+                                       len(queue)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if failed:
+            module.fail_json(msg=failed[0])
+
+    return changed_names
+
+
+class JSONRPCError(Exception):
+    def __init__(self, name, code, message):
+        super(JSONRPCError, self).__init__(message)
+        self.name = name
+        self.code = code
+
+
+class IPAJSONRPC(object):
+    """
+    Execute IPA commands with JSON-RPC over HTTPS
+
+    The connection is kept alive and reused for all requests. The session
+    cookie is stored in session_file, so that following tasks do not need
+    to log in again. Login is done with the password if there is no
+    session or the session has expired.
+    """
+
+    def __init__(self, server, principal, password, ca_cert=None,
+                 session_file=None, timeout=60):
+        self.server = server
+        self.principal = principal
+        self.password = password
+        self.session_file = session_file
+        self.timeout = timeout
+        self.cookie = None
+        self.conn = None
+
+        if ca_cert is None and os.path.exists("/etc/ipa/ca.crt"):
+            ca_cert = "/etc/ipa/ca.crt"
+        self.context = ssl.create_default_context(cafile=ca_cert)
+
+        if self.session_file is not None and \
+           os.path.exists(self.session_file):
+            with open(self.session_file) as f:
+                self.cookie = f.read().strip() or None
+
+    def clone(self):
+        """
+        Return a client with an own connection that shares the session
+        """
+        client = IPAJSONRPC(self.server, self.principal, self.password,
+                            session_file=self.session_file,
+                            timeout=self.timeout)
+        client.context = self.context
+        client.cookie = self.cookie
+        return client
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _request(self, path, body, headers):
+        headers = dict(headers)
+        headers["Referer"] = "https://%s/ipa" % self.server
+        if self.cookie is not None:
+            headers["Cookie"] = self.cookie
+
+        # The request is only sent again on a new connection if a reused
+        # keep-alive connection has been closed by the server before the
+        # request has been sent completely or before the server responded.
+        # All other errors are raised, a write could have been applied
+        # already. Commands are retried in api_command_retry.
+        while True:
+            reused = self.conn is not None
+            if self.conn is None:
+                self.conn = http_client.HTTPSConnection(
+                    self.server, timeout=self.timeout, context=self.context)
+            try:
+                self.conn.request("POST", path, body, headers)
+            except (http_client.HTTPException, ssl.SSLError, IOError):
+                self.close()
+                if not reused:
+                    raise
+                continue
+            try:
+                response = self.conn.getresponse()
+                return response, response.read()
+            except http_client.BadStatusLine:
+                # Also RemoteDisconnected: closed without a response
+                self.close()
+                if not reused:
+                    raise
+            except (http_client.HTTPException, ssl.SSLError, IOError):
+                self.close()
+                raise
+
+    def login(self):
+        if self.password is None:
+            raise JSONRPCError("AuthenticationError", 401,
+                               "No valid session and no password set")
+        response, _data = self._request(
+            "/ipa/session/login_password",
+            urlencode({"user": self.principal, "password": self.password}),
+            {"Content-Type": "application/x-www-form-urlencoded",
+             "Accept": "text/plain"})
+        if response.status != 200:
+            raise JSONRPCError("AuthenticationError", response.status,
+                               "Login as '%s' failed: %s %s" %
+                               (self.principal, response.status,
+                                response.reason))
+
+        cookie = SimpleCookie()
+        cookie.load(response.getheader("Set-Cookie", ""))
+        if "ipa_session" not in cookie:
+            raise JSONRPCError("AuthenticationError", response.status,
+                               "No session cookie received")
+        self.cookie = "ipa_session=%s" % cookie["ipa_session"].value
+
+        if self.session_file is not None:
+            session_dir = os.path.dirname(self.session_file)
+            if session_dir and not os.path.isdir(session_dir):
+                os.makedirs(session_dir, 0o700)
+            fd = os.open(self.session_file,
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(self.cookie)
+
+    def call(self, method, params):
+        body = json.dumps({"method": method, "params": params, "id": 0},
+                          default=_json_default)
+        headers = {"Content-Type": "application/json",
+                   "Accept": "application/json"}
+
+        if self.cookie is None:
+            self.login()
+        response, data = self._request("/ipa/session/json", body, headers)
+        if response.status == 401:
+            # The session has expired
+            self.login()
+            response, data = self._request("/ipa/session/json", body,
+                                           headers)
+        if response.status != 200:
+            raise JSONRPCError("HTTPError", response.status,
+                               "%s %s" % (response.status, response.reason))
+
+        reply = json.loads(to_text(data), object_hook=_json_object_hook)
+        if reply.get("error") is not None:
+            error = reply["error"]
+            raise JSONRPCError(error.get("name"), error.get("code"),
+                               error.get("message"))
+        return reply["result"]
+
+    def command(self, command, name, args):
+        return self.call(command, [[name] if name is not None else [],
+                                   args])
+
+    def batch(self, methods):
+        results = self.call("batch", [methods, {}])["results"]
+        for result in results:
+            if result.get("error") is not None and \
+               isinstance(result["error"], dict):
+                result["error_name"] = result["error"].get("name")
+                result["error_code"] = result["error"].get("code")
+                result["error"] = result["error"].get("message")
+        return results
+
+
+_jsonrpc = None
+
+
+def jsonrpc_connect(module, server, principal, password, ca_cert=None,
+                    session_file=None, select_ttl=3600):
+    """
+    Use the JSON-RPC backend with server for api_command and
+    execute_commands. With server "auto" the nearest healthy server is
+    selected, see select_server.
+    """
+    global _jsonrpc
+
+    if server == "auto":
+        server = select_server(module, principal, password, ca_cert,
+                               select_ttl)
+    if session_file is None:
+        session_file = os.path.join(
+            os.path.expanduser("~"), ".cache", "ansible-freeipa",
+            re.sub(r"[^\w.@-]", "_", "%s-%s" % (server, principal)))
+    _jsonrpc = IPAJSONRPC(server, principal, password, ca_cert,
+                          session_file)
+    return _jsonrpc
+
+
+# IPA client configuration with the domain and the server
+IPA_DEFAULT_CONF = "/etc/ipa/default.conf"
+
+
+def _ipa_default_conf():
+    """
+    Return the global settings of the IPA client configuration
+    """
+    parser = configparser.RawConfigParser()
+    if not parser.read(IPA_DEFAULT_CONF) or \
+       not parser.has_section("global"):
+        return {}
+    return dict(parser.items("global"))
+
+
+def _srv_servers(domain):
+    """
+    Return the servers of the _ldap._tcp SRV records of domain ordered by
+    priority. With IPA locations the DNS server returns the records of the
+    location of the client first.
+    """
+    if dns_resolver is None:
+        return []
+    try:
+        answers = dns_resolver.query("_ldap._tcp.%s." % domain, "SRV")
+    except Exception:
+        return []
+    records = sorted(answers, key=lambda x: (x.priority, -x.weight))
+    return [to_text(record.target).rstrip(".") for record in records]
+
+
+def _tcp_rtt(host, port=443, attempts=3, timeout=2):
+    """
+    Return the lowest TCP connect time to host in seconds
+    """
+    rtts = []
+    for _attempt in range(attempts):
+        start = time.time()
+        sock = socket.create_connection((host, port), timeout)
+        rtts.append(time.time() - start)
+        sock.close()
+    return min(rtts)
+
+
+def select_server(module, principal, password, ca_cert=None, ttl=3600,
+                  cache_file=None):
+    """
+    Return the healthy IPA server with the lowest round trip time. The
+    servers are taken from the _ldap._tcp SRV records of the domain, or
+    from server_find on the server of the IPA client configuration. The
+    choice is cached in cache_file for ttl seconds as long as the server
+    answers.
+    """
+    conf = _ipa_default_conf()
+    domain = conf.get("domain")
+    if cache_file is None:
+        cache_file = os.path.join(
+            os.path.expanduser("~"), ".cache", "ansible-freeipa",
+            "selected-server-%s" % re.sub(r"[^\w.@-]", "_",
+                                          domain or "default"))
+
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+            if time.time() - cached["selected"] < ttl:
+                _tcp_rtt(cached["server"], attempts=1)
+                return cached["server"]
+        except Exception:
+            # Expired, broken or the server does not answer
+            pass
+
+    servers = _srv_servers(domain) if domain else []
+    if not servers and conf.get("server"):
+        client = IPAJSONRPC(conf["server"], principal, password, ca_cert)
+        try:
+            _result = client.command("server_find", None,
+                                     {"sizelimit": 0})["result"]
+            servers = [to_text(server["cn"][0]) for server in _result]
+        except Exception as e:
+            module.warn("server_find on '%s' failed: %s" %
+                        (conf["server"], e))
+            servers = [conf["server"]]
+        finally:
+            client.close()
+    if not servers:
+        module.fail_json(msg="No IPA servers found for ipaapi_server auto, "
+                         "there are no SRV records and no server in %s" %
+                         IPA_DEFAULT_CONF)
+
+    results = run_concurrently(_tcp_rtt, servers, timeout=10)
+    rtts = dict((server, results[server][0]) for server in servers
+                if results[server][1] is None)
+    if not rtts:
+        module.fail_json(msg="No IPA server reachable: %s" %
+                         ", ".join(servers))
+    # The order of the SRV records decides between equally fast servers
+    server = min(rtts, key=lambda x: (round(rtts[x], 3), servers.index(x)))
+
+    cache_dir = os.path.dirname(cache_file)
+    if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, 0o700)
+    with open(cache_file, "w") as f:
+        json.dump({"server": server, "selected": time.time(),
+                   "rtt": dict((x, round(rtts[x], 4)) for x in rtts)}, f)
+    return server
+
+
+def _jsonrpc_client():
+    """
+    Return the JSON-RPC client of the current thread
+    """
+    return getattr(_local, "jsonrpc", None) or _jsonrpc
+
+
+def jsonrpc_disconnect():
+    global _jsonrpc
+
+    if _jsonrpc is not None:
+        _jsonrpc.close()
+        _jsonrpc = None
+
+
+# Attributes that are not replicated and are ignored for the convergence
+# check of the shards
+SHARD_UNREPLICATED = ["krblastsuccessfulauth", "krblastfailedauth",
+                      "krbloginfailedcount", "krblastadminunlock"]
+
+_shards = None
+
+
+def shard_configure(module, servers, principal, password, ca_cert=None,
+                    timeout=300):
+    """
+    Distribute the commands of execute_commands over the JSON-RPC APIs of
+    servers. All commands of an entity are executed on the same server,
+    the membership commands after the entities are visible on all servers.
+    timeout is the time to wait for the convergence of the servers.
+    """
+    global _shards
+
+    clients = []
+    for server in servers:
+        session_file = os.path.join(
+            os.path.expanduser("~"), ".cache", "ansible-freeipa",
+            re.sub(r"[^\w.@-]", "_", "%s-%s" % (server, principal)))
+        clients.append(IPAJSONRPC(server, principal, password, ca_cert,
+                                  session_file))
+    _shards = {"clients": clients, "timeout": timeout,
+               "stats": dict((server, {"commands": 0, "elapsed": 0.0})
+                             for server in servers),
+               "barriers": [], "dna_on_demand": []}
+    return _shards
+
+
+def shard_stats():
+    """
+    Return the shard statistics for the module result, None if there are
+    no shards
+    """
+    if _shards is None:
+        return None
+    return {"servers": _shards["stats"], "barriers": _shards["barriers"],
+            "dna_on_demand": _shards["dna_on_demand"]}
+
+
+def shard_disconnect():
+    """
+    Close the connections of the shards, the statistics are kept
+    """
+    if _shards is not None:
+        for client in _shards["clients"]:
+            client.close()
+
+
+def _shard_index(name, count):
+    digest = hashlib.sha1(to_bytes(to_text(name).lower())).hexdigest()
+    return int(digest, 16) % count
+
+
+def _dna_consumers(commands):
+    """
+    Return the number of adds per lower case name that get an ID from the
+    DNA plugin
+    """
+    names = []
+    for name, command, args in commands:
+        if command == "user_add" and "uidnumber" not in args:
+            names.append(to_text(name).lower())
+        elif command == "group_add" and "gidnumber" not in args and \
+                not args.get("nonposix") and not args.get("external"):
+            names.append(to_text(name).lower())
+    return names
+
+
+# DNA plugin config of the uidNumber and gidNumber range of a server
+DNA_POSIX_IDS = "cn=Posix IDs,cn=Distributed Numeric Assignment Plugin," \
+    "cn=plugins,cn=config"
+
+
+def _dna_server_remaining(host):
+    """
+    Return the remaining DNA values of the server host: the rest of the
+    current range and the size of the next range
+    """
+    conn = ldap_server_connect(host)
+    try:
+        entry = conn.get_entry(DN(DNA_POSIX_IDS),
+                               ["dnanextvalue", "dnamaxvalue",
+                                "dnanextrange"])
+    finally:
+        conn.close()
+    value = entry.single_value.get
+    # A server without range has a max value below the next value
+    remaining = max(int(value("dnamaxvalue", 0)) -
+                    int(value("dnanextvalue", 1)) + 1, 0)
+    for _range in entry.get("dnanextrange", []):
+        start, _sep, end = to_text(_range).partition("-")
+        remaining += int(end) - int(start) + 1
+    return remaining
+
+
+def _dna_remaining(servers):
+    """
+    Return the remaining DNA values per lower case server read from the
+    DNA plugin config of the servers, the shared config is used for the
+    servers that can not be read. None if the local API is not used.
+    """
+    if _jsonrpc is not None:
+        return None
+    remaining = {}
+    for entry in api_paged_search(
+            DN(("cn", "posix-ids"), ("cn", "dna"), ("cn", "ipa"),
+               ("cn", "etc"), api.env.basedn),
+            "(objectclass=dnasharedconfig)",
+            ["dnahostname", "dnaremainingvalues"]):
+        remaining[to_text(entry.single_value["dnahostname"]).lower()] = \
+            int(entry.single_value.get("dnaremainingvalues", 0))
+    results = run_concurrently(_dna_server_remaining, servers)
+    for server, (result, error, _elapsed) in results.items():
+        if error is None:
+            remaining[server.lower()] = result
+    return remaining
+
+
+def _shard_clients(commands):
+    """
+    Return the clients that are used for the commands. All servers are
+    used: a server without a DNA range or without enough values for its
+    share of the adds gets a range on demand from another server. These
+    servers are recorded in the statistics, as the first adds are slower.
+    """
+    clients = list(_shards["clients"])
+    consumers = _dna_consumers(commands)
+    if not consumers:
+        return clients
+    remaining = _dna_remaining([client.server for client in clients])
+    if remaining is None:
+        return clients
+    counts = [0] * len(clients)
+    for name in consumers:
+        counts[_shard_index(name, len(clients))] += 1
+    for client, count in zip(clients, counts):
+        if count > 0 and remaining.get(client.server.lower(), 0) < count:
+            _shards["dna_on_demand"].append(client.server)
+    return clients
+
+
+def _shard_show(client, name, command):
+    """
+    Return the replicated state of the entity of command on client, None
+    if there is no entity
+    """
+    try:
+        result = client.command("%s_show" % command.partition("_")[0],
+                                to_text(name), {"all": True})["result"]
+    except JSONRPCError as e:
+        if e.name == "NotFound":
+            return None
+        raise
+    return dict((key, value) for key, value in result.items()
+                if key not in SHARD_UNREPLICATED)
+
+
+def _shard_barrier(clients, last):
+    """
+    Wait until the entity of the last command executed on every shard has
+    the same state on all shards. Replication keeps the order of the
+    changes of a server, all earlier changes are then visible as well.
+    """
+    start = time.time()
+    deadline = start + _shards["timeout"]
+    delay = 0.5
+    pending = [(client, name, command)
+               for client, (name, command) in zip(clients, last)
+               if name is not None]
+    while pending:
+        _pending = []
+        for origin, name, command in pending:
+            state = _shard_show(origin, name, command)
+            if any(_shard_show(client, name, command) != state
+                   for client in clients if client is not origin):
+                _pending.append((origin, name, command))
+        pending = _pending
+        if not pending:
+            break
+        if time.time() + delay > deadline:
+            raise RuntimeError(
+                "Shards not converged after %ss: %s" %
+                (_shards["timeout"],
+                 ", ".join(origin.server for origin, _n, _c in pending)))
+        time.sleep(delay)
+        delay = min(delay * 2, 10.0)
+    _shards["barriers"].append(round(time.time() - start, 3))
+
+
+def _execute_sharded(module, commands, batch_size):
+    changed_names = set()
+    clients = _shard_clients(commands)
+    last = [(None, None)] * len(clients)
+    failed = []
+
+    def _worker(index, queue):
+        client = clients[index]
+        _local.jsonrpc = client
+        stats = _shards["stats"][client.server]
+        try:
+            for i in range(0, len(queue), batch_size):
+                if failed:
+                    return
+                unit = queue[i:i + batch_size]
+                start = time.time()
+                _execute_unit(unit)
+                stats["commands"] += len(unit)
+                stats["elapsed"] = round(stats["elapsed"] + time.time() -
+                                         start, 3)
+                changed_names.update(to_text(name).lower()
+                                     for name, _command, _args in unit)
+                last[index] = (unit[-1][0], unit[-1][1])
+        except Exception as e:
+            failed.append(str(e))
+        finally:
+            _local.jsonrpc = None
+
+    # Entities first, the membership commands need the members on all
+    # servers, the deletions last
+    groups = [[0, 1], [2], [3]]
+    for group in groups:
+        group_commands = [x for x in commands
+                          if _command_phase(x[1]) in group]
+        if not group_commands:
+            continue
+        if group[0] > 0 and len(clients) > 1 and \
+           any(name is not None for name, _command in last):
+            try:
+                _shard_barrier(clients, last)
+            except Exception as e:
+                module.fail_json(msg=str(e))
+        queues = [[] for _client in clients]
+        for phase in group:
+            for name, command, args in group_commands:
+                if _command_phase(command) == phase:
+                    queues[_shard_index(name, len(clients))].append(
+                        [name, command, args])
+        threads = [threading.Thread(target=_worker, args=(i, queue))
+                   for i, queue in enumerate(queues) if queue]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if failed:
+            module.fail_json(msg=failed[0])
+
+    # Wait for the convergence of all changes
+    if len(clients) > 1 and \
+       any(name is not None for name, _command in last):
+        try:
+            _shard_barrier(clients, last)
+        except Exception as e:
+            module.fail_json(msg=str(e))
+
+    return changed_names
+
+
+def ipaapi_argument_spec():
+    """
+    Return the argument spec of the options of the ipaapi doc fragment
+    """
+    return dict(
+        ipaapi_server=dict(type="str", default=None),
+        ipaapi_ca_cert=dict(type="path", default=None),
+        ipaapi_session=dict(type="path", default=None),
+        ipaapi_select_ttl=dict(type="int", default=3600),
+        retry_attempts=dict(type="int", default=5),
+        throttle_latency=dict(type="float", default=None),
+        throttle_concurrency=dict(type="int", default=8),
+        throttle_rate=dict(type="float", default=None),
+        ipaapi_shards=dict(type="list", default=None),
+        shard_timeout=dict(type="int", default=300),
+        plan=dict(type="list", default=None),
+        ldif=dict(type="path", default=None),
+        mirror=dict(type="path", default=None),
+        mirror_max_age=dict(type="int", default=3600),
+    )
+
+
+def ipaapi_connect(module, principal, password):
+    """
+    Configure the retries, the throttle and the shards with the options of
+    the ipaapi doc fragment and connect to the JSON-RPC API of
+    ipaapi_server or the local server API. Return the temporary ccache dir
+    and name for ipaapi_disconnect and the exit args.
+    """
+    params = module.params
+    retry_configure(attempts=params.get("retry_attempts"))
+    if params.get("throttle_latency") is not None or \
+       params.get("throttle_rate") is not None:
+        throttle_configure(params.get("throttle_latency") or 0.5,
+                           params.get("throttle_concurrency"),
+                           params.get("throttle_rate"))
+
+    exit_args = {}
+    ccache_dir = None
+    ccache_name = None
+    server = params.get("ipaapi_server")
+    if server is not None:
+        client = jsonrpc_connect(module, server, principal, password,
+                                 params.get("ipaapi_ca_cert"),
+                                 params.get("ipaapi_session"),
+                                 params.get("ipaapi_select_ttl"))
+        if server == "auto":
+            exit_args["ipaapi_server"] = client.server
+    else:
+        if not valid_creds(module, principal):
+            ccache_dir, ccache_name = temp_kinit(principal, password)
+            # The LDAP connections to the shard servers use the ccache
+            os.environ["KRB5CCNAME"] = ccache_name
+        try:
+            api_connect()
+        except Exception:
+            temp_kdestroy(ccache_dir, ccache_name)
+            raise
+
+    if params.get("ipaapi_shards") is not None:
+        shard_configure(module, params.get("ipaapi_shards"), principal,
+                        password, params.get("ipaapi_ca_cert"),
+                        params.get("shard_timeout"))
+    return ccache_dir, ccache_name, exit_args
+
+
+def ipaapi_execute(module, kind, commands, mirror=None):
+    """
+    Execute the commands with the options of the ipaapi doc fragment. In
+    check mode the plan is returned, with ldif the LDIF file is written.
+    Otherwise the commands are executed and the changed entries are
+    invalidated in the mirror. Return the set of lower case names that
+    have been changed and the exit args.
+    """
+    exit_args = {}
+    if module.check_mode:
+        exit_args["commands"] = gen_plan(module, kind, commands)
+        changed_names = set(to_text(name).lower()
+                            for name, _command, _args in commands)
+    elif module.params.get("ldif") is not None:
+        exit_args["ldif_records"] = gen_ldif(module, kind, commands,
+                                             module.params.get("ldif"))
+        changed_names = set(to_text(name).lower()
+                            for name, _command, _args in commands)
+    else:
+        changed_names = execute_commands(module, commands)
+        if mirror is not None:
+            for name in changed_names:
+                for _kind in PLAN_KINDS[kind]:
+                    mirror.invalidate(_kind, name)
+    return changed_names, exit_args
+
+
+def ipaapi_disconnect(ccache_dir, ccache_name):
+    """
+    Destroy the temporary ccache and close the JSON-RPC and shard
+    connections
+    """
+    temp_kdestroy(ccache_dir, ccache_name)
+    jsonrpc_disconnect()
+    shard_disconnect()
+
+
+def ipaapi_stats():
+    """
+    Return the retry, throttle and shard statistics for the module result
+    """
+    stats = {"retries": retry_stats()}
+    if throttle_stats() is not None:
+        stats["throttle"] = throttle_stats()
+    if shard_stats() is not None:
+        stats["shards"] = shard_stats()
+    return stats
+
+
 def execute_api_command(module, principal, password, command, name, args):
     """
     Get KRB ticket if not already there, initialize api, connect,
@@ -168,6 +1430,89 @@ def date_format(value):
     raise ValueError("Invalid date '%s'" % value)
 
 
+def gen_user_args(first, last, fullname, displayname, homedir, shell,
+                  emails, principalname, passwordexpiration, password, uid,
+                  gid, phones, title, sshpubkey):
+    """
+    Generate the user_add and user_mod args from the user settings
+    """
+    _args = {}
+    if first is not None:
+        _args["givenname"] = first
+    if last is not None:
+        _args["sn"] = last
+    if fullname is not None:
+        _args["cn"] = fullname
+    if displayname is not None:
+        _args["displayname"] = displayname
+    if homedir is not None:
+        _args["homedirectory"] = homedir
+    if shell is not None:
+        _args["loginshell"] = shell
+    if emails is not None and len(emails) > 0:
+        _args["mail"] = emails
+    if principalname is not None:
+        _args["krbprincipalname"] = principalname
+    if passwordexpiration is not None:
+        _args["krbpasswordexpiration"] = passwordexpiration
+    if password is not None:
+        _args["userpassword"] = password
+    if uid is not None:
+        _args["uidnumber"] = str(uid)
+    if gid is not None:
+        _args["gidnumber"] = str(gid)
+    if phones is not None and len(phones) > 0:
+        _args["telephonenumber"] = phones
+    if title is not None:
+        _args["title"] = title
+    if sshpubkey is not None:
+        _args["ipasshpubkey"] = sshpubkey
+
+    return _args
+
+
+USER_KEYS = {
+    "first": "str",
+    "last": "str",
+    "fullname": "str",
+    "displayname": "str",
+    "homedir": "str",
+    "shell": "str",
+    "email": "list",
+    "principalname": "str",
+    "passwordexpiration": "str",
+    "password": "str",
+    "uid": "int",
+    "gid": "int",
+    "phone": "list",
+    "title": "str",
+}
+
+
+def gen_user_item_args(item):
+    """
+    Generate the user args from a bulk item
+    """
+    passwordexpiration = item.get("passwordexpiration")
+    if passwordexpiration is not None:
+        passwordexpiration = format_passwordexpiration(passwordexpiration)
+    return gen_user_args(
+        item.get("first"), item.get("last"), item.get("fullname"),
+        item.get("displayname"), item.get("homedir"), item.get("shell"),
+        item.get("email"), item.get("principalname"), passwordexpiration,
+        item.get("password"), item.get("uid"), item.get("gid"),
+        item.get("phone"), item.get("title"), None)
+
+
+def format_passwordexpiration(passwordexpiration):
+    """
+    Convert the passwordexpiration setting to datetime
+    """
+    if passwordexpiration[-1:] != "Z":
+        passwordexpiration = "%sZ" % passwordexpiration
+    return date_format(passwordexpiration)
+
+
 def compare_args_ipa(module, args, ipa):
     for key in args.keys():
         if key not in ipa:
@@ -185,3 +1530,963 @@ def compare_args_ipa(module, args, ipa):
                 return False
 
     return True
+
+
+def _json_default(value):
+    """
+    Encode values in find results that json does not handle natively
+    """
+    if isinstance(value, datetime):
+        return {"__datetime__": value.strftime(LDAP_GENERALIZED_TIME_FORMAT)}
+    if isinstance(value, bytes):
+        return {"__base64__": base64.b64encode(value).decode("ascii")}
+    return str(value)
+
+
+def _json_object_hook(value):
+    """
+    Decode values encoded with _json_default
+    """
+    if len(value) == 1:
+        if "__datetime__" in value:
+            return datetime.strptime(value["__datetime__"],
+                                     LDAP_GENERALIZED_TIME_FORMAT)
+        if "__base64__" in value:
+            return base64.b64decode(value["__base64__"])
+    return value
+
+
+# Mirror kinds: key attribute, api.env container, LDAP filter, find command
+# and additional find args. The filters match the entries the find commands
+# return, private groups for example are not returned by group_find.
+MIRROR_KINDS = {
+    "user": ("uid", "container_user",
+             "(objectclass=posixaccount)", "user_find", {}),
+    "user_preserved": ("uid", "container_deleteuser",
+                       "(objectclass=posixaccount)", "user_find",
+                       {"preserved": True}),
+    "group": ("cn", "container_group",
+              "(&(objectclass=ipausergroup)"
+              "(!(objectclass=mepmanagedentry)))", "group_find", {}),
+    "host": ("fqdn", "container_host",
+             "(objectclass=ipahost)", "host_find", {}),
+    "topologysegment": ("cn", "container_topology",
+                        "(objectclass=iparepltoposegment)",
+                        "topologysegment_find", {}),
+}
+
+MIRROR_SUFFIXES = {
+    "user": [""],
+    "user_preserved": [""],
+    "group": [""],
+    "host": [""],
+    "topologysegment": ["domain", "ca"],
+}
+
+# Changed entries are fetched one by one up to this limit, above it the
+# find command is used once for the complete kind.
+MIRROR_FULL_FETCH = 500
+
+
+class IPAMirror(object):
+    """
+    Local SQLite mirror of users, groups, hosts and topology segments
+
+    The mirror stores the results of the find commands, so that lookups
+    return the same data as the commands would do. It is refreshed with
+    refresh(), which only fetches entries with a changed entryusn.
+    Lookups are answered from the mirror if the kind has been refreshed
+    within max_age seconds, otherwise the caller needs to ask the server.
+    """
+
+    def __init__(self, path, max_age=3600):
+        self.path = path
+        self.max_age = max_age
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                kind TEXT NOT NULL,
+                suffix TEXT NOT NULL,
+                key TEXT NOT NULL,
+                usn INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (kind, suffix, key)
+            );
+            CREATE TABLE IF NOT EXISTS refreshed (
+                kind TEXT PRIMARY KEY,
+                timestamp REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS dirty (
+                kind TEXT NOT NULL,
+                suffix TEXT NOT NULL,
+                key TEXT NOT NULL,
+                PRIMARY KEY (kind, suffix, key)
+            );
+        """)
+
+    def close(self):
+        self.conn.close()
+
+    def is_fresh(self, kind):
+        row = self.conn.execute(
+            "SELECT timestamp FROM refreshed WHERE kind = ?",
+            (kind,)).fetchone()
+        return row is not None and time.time() - row[0] <= self.max_age
+
+    def lookup(self, kind, key, suffix=""):
+        """
+        Return (found, entry). found is False if the mirror can not answer
+        the lookup, entry is None if the entry does not exist.
+        """
+        key = to_text(key).lower()
+        if not self.is_fresh(kind):
+            return False, None
+        if self.conn.execute(
+                "SELECT 1 FROM dirty WHERE kind = ? AND suffix = ? AND "
+                "key = ?", (kind, suffix, key)).fetchone() is not None:
+            return False, None
+        row = self.conn.execute(
+            "SELECT data FROM entries WHERE kind = ? AND suffix = ? AND "
+            "key = ?", (kind, suffix, key)).fetchone()
+        if row is None:
+            return True, None
+        return True, json.loads(row[0], object_hook=_json_object_hook)
+
+    def search(self, kind, suffix=""):
+        """
+        Return (found, entries) with all entries of kind and suffix.
+        """
+        if not self.is_fresh(kind):
+            return False, None
+        if self.conn.execute(
+                "SELECT 1 FROM dirty WHERE kind = ? AND suffix = ?",
+                (kind, suffix)).fetchone() is not None:
+            return False, None
+        return True, [json.loads(row[0], object_hook=_json_object_hook)
+                      for row in self.conn.execute(
+                          "SELECT data FROM entries WHERE kind = ? AND "
+                          "suffix = ? ORDER BY key", (kind, suffix))]
+
+    def invalidate(self, kind, key, suffix=""):
+        """
+        Mark an entry as modified, lookups go to the server until the next
+        refresh.
+        """
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO dirty (kind, suffix, key) "
+                "VALUES (?, ?, ?)", (kind, suffix, to_text(key).lower()))
+
+    def _store(self, kind, suffix, key, usn, entry):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO entries (kind, suffix, key, usn, data) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (kind, suffix, key, usn,
+             json.dumps(entry, default=_json_default)))
+
+    def refresh(self, module, kind):
+        """
+        Refresh kind from the server, return (updated, deleted) counts.
+        """
+        key_attr, container, ldap_filter, command, find_args = \
+            MIRROR_KINDS[kind]
+        ldap = api.Backend.ldap2
+        updated = 0
+        deleted = 0
+
+        for suffix in MIRROR_SUFFIXES[kind]:
+            base_dn = DN(getattr(api.env, container), api.env.basedn)
+            if suffix:
+                base_dn = DN(("cn", suffix), base_dn)
+
+            # One pass over the key and entryusn of all entries
+            server_usns = {}
+            try:
+                for entry in api_paged_search(
+                        base_dn, ldap_filter, [key_attr, "entryusn"],
+                        scope=ldap.SCOPE_ONELEVEL):
+                    key = to_text(entry.single_value[key_attr]).lower()
+                    server_usns[key] = int(
+                        entry.single_value.get("entryusn", 0))
+            except errors.NotFound:
+                pass
+
+            mirror_usns = dict(self.conn.execute(
+                "SELECT key, usn FROM entries WHERE kind = ? AND suffix = ?",
+                (kind, suffix)).fetchall())
+            changed = [key for key, usn in server_usns.items()
+                       if mirror_usns.get(key) != usn]
+            removed = [key for key in mirror_usns if key not in server_usns]
+
+            fetched = []
+            if suffix or len(changed) > MIRROR_FULL_FETCH:
+                _args = dict(find_args, all=True, sizelimit=0)
+                fetched = api_command(module, command,
+                                      to_text(suffix) if suffix else None,
+                                      _args)["result"]
+            else:
+                for key in changed:
+                    _args = dict(find_args, all=True)
+                    _args[key_attr] = key
+                    fetched.extend(api_command(
+                        module, command,
+                        to_text(suffix) if suffix else None,
+                        _args)["result"])
+
+            with self.conn:
+                changed = set(changed)
+                for entry in fetched:
+                    key = to_text(entry[key_attr][0]).lower()
+                    if key in changed and key in server_usns:
+                        self._store(kind, suffix, key, server_usns[key],
+                                    entry)
+                        updated += 1
+                for key in removed:
+                    self.conn.execute(
+                        "DELETE FROM entries WHERE kind = ? AND suffix = ? "
+                        "AND key = ?", (kind, suffix, key))
+                    deleted += 1
+                self.conn.execute(
+                    "DELETE FROM dirty WHERE kind = ? AND suffix = ?",
+                    (kind, suffix))
+
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO refreshed (kind, timestamp) "
+                "VALUES (?, ?)", (kind, time.time()))
+
+        return updated, deleted
+
+
+def mirror_open(module, path, max_age):
+    """
+    Open the mirror if path is set, failures disable the mirror
+    """
+    if path is None:
+        return None
+    try:
+        return IPAMirror(path, max_age)
+    except sqlite3.Error as e:
+        module.warn("Mirror '%s' not usable: %s" % (path, e))
+        return None
+
+
+def api_find_all(module, command, key, args=None, suffix=None):
+    """
+    Return all entries of a find command as dict indexed by the lower case
+    key, fail if the result is truncated
+    """
+    _args = {"all": True, "sizelimit": 0}
+    if args is not None:
+        _args.update(args)
+
+    _result = api_command(module, command, suffix, _args)
+    if _result.get("truncated"):
+        module.fail_json(
+            msg="%s: result has been truncated, check the search size "
+            "limit" % command)
+
+    return dict((to_text(entry[key][0]).lower(), entry)
+                for entry in _result["result"])
+
+
+def api_paged_index(module, kind, attrs):
+    """
+    Return all entries of kind (see MIRROR_KINDS) as dict indexed by the
+    lower case key. The entries are read with one paged search and only
+    have the key and attrs, the values are text or datetime. The direct
+    members of member are returned as member_user, member_group,
+    member_host and member_service like in the find results. The JSON-RPC
+    backend has no paged search, the find command is used instead.
+    """
+    key_attr, container, ldap_filter, command, find_args = \
+        MIRROR_KINDS[kind]
+    if _jsonrpc is not None:
+        return api_find_all(module, command, key_attr, find_args)
+
+    attrs = [key_attr] + [attr for attr in attrs if attr != key_attr]
+    members = dict(
+        (DN(getattr(api.env, "container_%s" % x), api.env.basedn),
+         "member_%s" % x) for x in ["user", "group", "host", "service"])
+    index = {}
+    try:
+        for entry in api_paged_search(
+                DN(getattr(api.env, container), api.env.basedn),
+                ldap_filter, attrs,
+                scope=api.Backend.ldap2.SCOPE_ONELEVEL):
+            result = {}
+            for attr in attrs:
+                if attr == "member":
+                    for dn in entry.get(attr, []):
+                        key = members.get(DN(dn[1:]))
+                        if key is not None:
+                            result.setdefault(key, []).append(
+                                to_text(dn[0].value))
+                elif entry.get(attr):
+                    result[attr] = [value if isinstance(value, datetime)
+                                    else to_text(value)
+                                    for value in entry[attr]]
+            index[to_text(entry.single_value[key_attr]).lower()] = result
+    except errors.NotFound:
+        pass
+    return index
+
+
+def exact_delete_names(module, current, desired, protect, max_delete):
+    """
+    Return the sorted list of current names that are not desired and not
+    protected, fail if there are more than max_delete
+    """
+    protect = set(to_text(name).lower() for name in protect or [])
+    names = sorted(name for name in current
+                   if name not in desired and name not in protect)
+    if max_delete is not None and len(names) > max_delete:
+        module.fail_json(
+            msg="Refusing to delete %d entries, the limit is %d "
+            "(exact_max_delete)" % (len(names), max_delete))
+    return names
+
+
+def normalize_item(item, valid, list_separator=","):
+    """
+    Check and convert the settings of a bulk item in place. valid is a dict
+    of the valid settings and their types. Raise ValueError on errors.
+    """
+    if not isinstance(item, dict) or not item.get("name"):
+        raise ValueError("Each item needs to be a dict with a name")
+    for key in item:
+        if key == "name":
+            continue
+        if key not in valid:
+            raise ValueError("Unknown key '%s' for '%s'" % (key, item["name"]))
+        if item[key] is None:
+            continue
+        try:
+            if valid[key] == "bool":
+                item[key] = boolean(item[key])
+            elif valid[key] == "int":
+                item[key] = int(item[key])
+            elif valid[key] == "list":
+                if not isinstance(item[key], list):
+                    item[key] = [x.strip() for x in
+                                 to_text(item[key]).split(list_separator)]
+            else:
+                item[key] = to_text(item[key])
+        except (TypeError, ValueError) as e:
+            raise ValueError("Invalid value for '%s' of '%s': %s" %
+                             (key, item["name"], e))
+    return item
+
+
+# Item settings that are not logged
+ITEM_SECRETS = ["password"]
+
+
+def item_argument_spec(valid):
+    """
+    Return the argument spec of a list of items for bulk or exact mode.
+    valid is a dict of the valid settings and their types, the secrets
+    are not logged.
+    """
+    suboptions = dict((key, dict(type=_type, no_log=key in ITEM_SECRETS))
+                      for key, _type in valid.items())
+    suboptions["name"] = dict(type="str", required=True)
+    return dict(type="list", elements="dict", suboptions=suboptions,
+                default=None, required=False)
+
+
+def check_items(module, items, valid):
+    """
+    Check list of dicts given for bulk or exact mode, return dict of items
+    indexed by the lower case name. valid is a dict of the valid settings
+    and their types, the values in items are converted in place. Unset
+    settings are removed, the argument spec sets them to None.
+    """
+    _items = {}
+    for item in items:
+        for key in [key for key, value in item.items() if value is None]:
+            del item[key]
+        try:
+            normalize_item(item, valid)
+        except ValueError as e:
+            module.fail_json(msg=str(e))
+        name = to_text(item["name"]).lower()
+        if name in _items:
+            module.fail_json(msg="Duplicate item '%s'" % item["name"])
+        _items[name] = item
+    return _items
+
+
+def get_masters(module):
+    """
+    Return the sorted list of IPA masters
+    """
+    _result = api_command(module, "server_find", None, {"sizelimit": 0})
+    return sorted(to_text(server["cn"][0]) for server in _result["result"])
+
+
+def ldap_server_connect(host, dm_password=None, timeout=10):
+    """
+    Connect to the LDAP server on host with StartTLS. Bind as Directory
+    Manager if dm_password is set, use GSSAPI with the current credentials
+    otherwise.
+    """
+    conn = LDAPClient("ldap://%s" % host, start_tls=True,
+                      cacert=paths.IPA_CA_CRT)
+    conn.conn.set_option(_ldap.OPT_NETWORK_TIMEOUT, timeout)
+    conn.conn.set_option(_ldap.OPT_TIMEOUT, timeout)
+    if dm_password is not None:
+        conn.simple_bind(DN(("cn", "directory manager")), dm_password)
+    else:
+        conn.gssapi_bind()
+    return conn
+
+
+# Base of the replication agreements on a server
+REPLICA_MAPPING_TREE = "cn=mapping tree,cn=config"
+
+# RUV element, for example
+# "{replica 4 ldap://ipaserver.test.local:389} 5d1b4f5c000000040000
+# 5d1b4f60000300040000"
+RUV_RE = re.compile(r"^\{replica (\d+)[^}]*\}\s*[0-9a-f]{20}\s+([0-9a-f]{20})",
+                    re.IGNORECASE)
+
+# Status of the last total or incremental update, for example
+# "Error (0) Total update succeeded" or "0 Replica acquired successfully"
+REPLICA_STATUS_RE = re.compile(r"^(?:Error \()?(-?\d+)\)?\s*(.*)$")
+
+
+def replica_root(suffix):
+    """
+    Return the DN of the replicated tree of the topology suffix domain or
+    ca
+    """
+    if suffix == "ca":
+        return DN(("o", "ipaca"))
+    return DN(api.env.basedn)
+
+
+def get_agreements(conn, suffix, attrs, consumer=None):
+    """
+    Return the replication agreements of the topology suffix on the server
+    of conn, only the agreement to consumer if set
+    """
+    filter_attrs = {
+        "objectclass": "nsds5replicationagreement",
+        "nsds5replicaroot": str(replica_root(suffix)),
+    }
+    if consumer is not None:
+        filter_attrs["nsds5replicahost"] = consumer
+    try:
+        return conn.get_entries(
+            DN(REPLICA_MAPPING_TREE), conn.SCOPE_SUBTREE,
+            conn.make_filter(filter_attrs, rules=conn.MATCH_ALL),
+            attrs)
+    except errors.NotFound:
+        return []
+
+
+def parse_ruv(values):
+    """
+    Return the max CSN per replica ID of the RUV values
+    """
+    ruv = {}
+    for value in values:
+        match = RUV_RE.match(to_text(value))
+        if match is not None:
+            ruv[int(match.group(1))] = match.group(2).lower()
+    return ruv
+
+
+def csn_rid(csn):
+    """
+    Return the replica ID of a CSN
+    """
+    return int(csn[12:16], 16)
+
+
+def csn_time(csn):
+    """
+    Return the timestamp of a CSN in seconds since the epoch
+    """
+    return int(csn[:8], 16)
+
+
+def replica_entry(conn, suffix, attrs):
+    """
+    Return the replica configuration entry of the topology suffix on the
+    server of conn
+    """
+    return conn.get_entry(
+        DN(("cn", "replica"), ("cn", str(replica_root(suffix))),
+           DN(REPLICA_MAPPING_TREE)), attrs)
+
+
+def replica_status(value):
+    """
+    Return (code, message) of a replica update status, code is 0 on
+    success and None if the status can not be parsed
+    """
+    if not value:
+        return None, None
+    match = REPLICA_STATUS_RE.match(to_text(value))
+    if match is None:
+        return None, to_text(value)
+    return int(match.group(1)), match.group(2)
+
+
+def run_concurrently(func, hosts, concurrency=10, timeout=60):
+    """
+    Call func(host) for all hosts with at most concurrency calls at a time
+    and a timeout per call. Return a dict with host: (result, error,
+    elapsed seconds). The calls are run in daemon threads, calls that time
+    out are not waited for and do not block the module exit. They also do
+    not count for concurrency anymore.
+    """
+    concurrency = max(concurrency, 1)
+    results = {}
+    started = {}
+
+    def _call(host):
+        try:
+            result = (func(host), None, time.time() - started[host])
+        except Exception as e:
+            result = (None, str(e), time.time() - started[host])
+        results.setdefault(host, result)
+
+    queue = list(hosts)
+    threads = {}
+    while True:
+        running = [host for host, thread in threads.items()
+                   if thread.is_alive() and
+                   time.time() - started[host] <= timeout]
+        while queue and len(running) < concurrency:
+            host = queue.pop(0)
+            started[host] = time.time()
+            threads[host] = threading.Thread(target=_call, args=(host,))
+            threads[host].daemon = True
+            threads[host].start()
+            running.append(host)
+        if not running:
+            break
+        time.sleep(0.2)
+    for host, thread in threads.items():
+        if thread.is_alive():
+            results.setdefault(host, (None, "Timeout after %ss" % timeout,
+                                      time.time() - started[host]))
+    return dict(results)
+
+
+def entry_dn(kind, name):
+    """
+    Return the DN of an user, group or host
+    """
+    if kind == "user":
+        return DN(("uid", name), api.env.container_user, api.env.basedn)
+    if kind == "user_preserved":
+        return DN(("uid", name), api.env.container_deleteuser,
+                  api.env.basedn)
+    if kind == "group":
+        return DN(("cn", name), api.env.container_group, api.env.basedn)
+    if kind == "host":
+        return DN(("fqdn", name), api.env.container_host, api.env.basedn)
+    raise ValueError("Unknown kind '%s'" % kind)
+
+
+# Kinds of entries that are checked for plan preconditions
+PLAN_KINDS = {
+    "user": ["user", "user_preserved"],
+    "group": ["group"],
+    "host": ["host"],
+}
+
+# Args that are not returned in plans
+PLAN_SECRETS = ["userpassword"]
+PLAN_SECRET_VALUE = "********"
+
+
+def entry_state(kind, name):
+    """
+    Return the precondition for name: entryusn and modifytimestamp of the
+    entry for every DN the entry can have, None if there is no entry.
+    """
+    if _jsonrpc is not None:
+        return _entry_state_jsonrpc(kind, name)
+
+    state = {}
+    for _kind in PLAN_KINDS[kind]:
+        dn = entry_dn(_kind, name)
+        try:
+            entry = api.Backend.ldap2.get_entry(
+                dn, ["entryusn", "modifytimestamp"])
+        except errors.NotFound:
+            state[to_text(dn)] = None
+        else:
+            state[to_text(dn)] = {
+                "entryusn": to_text(entry.single_value.get("entryusn")),
+                "modifytimestamp": to_text(
+                    entry.single_value.get("modifytimestamp")),
+            }
+    return state
+
+
+def _entry_state_jsonrpc(kind, name):
+    """
+    Return the precondition for name with the JSON-RPC API, read with the
+    show command (all, raw). The show command does not return the
+    operational attributes, then the precondition is a digest of the
+    replicated attributes of the entry. The state is empty if there is no
+    entry.
+    """
+    try:
+        result = api_command_retry("%s_show" % kind, to_text(name),
+                                   {"all": True, "raw": True})["result"]
+    except Exception as e:
+        if _error_name(e) == "NotFound":
+            return {}
+        raise
+    state = dict((attr, to_text(result[attr][0]))
+                 for attr in ["entryusn", "modifytimestamp"]
+                 if result.get(attr))
+    if not state:
+        attrs = dict((key.lower(), value) for key, value in result.items()
+                     if key.lower() not in SHARD_UNREPLICATED)
+        state["digest"] = hashlib.sha256(to_bytes(json.dumps(
+            attrs, sort_keys=True, default=_json_default))).hexdigest()
+    return {to_text(result["dn"]): state}
+
+
+def gen_plan(module, kind, commands):
+    """
+    Return commands as plan for check mode. Each planned command has the
+    state of the entry as precondition, secrets are masked.
+    """
+    plan = []
+    states = {}
+    for name, command, args in commands:
+        key = to_text(name).lower()
+        if key not in states:
+            states[key] = entry_state(kind, name)
+        _args = json.loads(json.dumps(args, default=_json_default))
+        for secret in PLAN_SECRETS:
+            if secret in _args:
+                _args[secret] = PLAN_SECRET_VALUE
+        plan.append({
+            "name": name,
+            "command": command,
+            "args": _args,
+            "precondition": states[key],
+        })
+    return plan
+
+
+def check_plan(module, kind, plan, secret=None):
+    """
+    Check the preconditions of a plan created in check mode and return the
+    commands. Fail if an entry has been changed since the plan has been
+    created. Masked secrets are replaced with secret.
+    """
+    commands = []
+    states = {}
+    for planned in plan:
+        try:
+            name = planned["name"]
+            command = planned["command"]
+            args = json.loads(json.dumps(planned["args"]),
+                              object_hook=_json_object_hook)
+            precondition = planned["precondition"]
+        except (KeyError, TypeError):
+            module.fail_json(msg="Invalid plan entry: %s" % planned)
+
+        if not command.startswith("%s_" % kind):
+            module.fail_json(msg="Command '%s' is not a %s command" %
+                             (command, kind))
+
+        key = to_text(name).lower()
+        if key not in states:
+            states[key] = entry_state(kind, name)
+        if states[key] != precondition:
+            module.fail_json(
+                msg="Plan is stale, '%s' has been changed since the plan "
+                "has been created" % name)
+
+        for key_secret in PLAN_SECRETS:
+            if args.get(key_secret) == PLAN_SECRET_VALUE:
+                if secret is None:
+                    module.fail_json(
+                        msg="The plan needs the password for '%s'" % name)
+                args[key_secret] = secret
+
+        commands.append([name, command, args])
+    return commands
+
+
+# Object classes of entries added with LDIF output, see the default
+# object classes in the ipa config and the host and group plugins
+LDIF_OBJECTCLASSES = {
+    "user": ["top", "person", "organizationalperson", "inetorgperson",
+             "inetuser", "posixaccount", "krbprincipalaux",
+             "krbticketpolicyaux", "ipaobject", "ipasshuser",
+             "ipaSshGroupOfPubKeys", "mepOriginEntry"],
+    "group": ["top", "groupofnames", "nestedgroup", "ipausergroup",
+              "ipaobject"],
+    "host": ["top", "ipaobject", "nshost", "ipahost", "pkiuser",
+             "ipaservice", "krbprincipalaux", "krbprincipal",
+             "ieee802device", "ipasshhost", "ipaSshGroupOfPubKeys"],
+}
+
+# Magic value for the DNA plugin, uidNumber and gidNumber are assigned on
+# add from the ID range
+LDIF_DNA_MAGIC = "-1"
+
+# Args that are only used by the framework and have no LDAP attribute
+LDIF_IGNORED_ARGS = ["force", "no_reverse", "nomembers"]
+
+# Args that need the framework and can not be rendered as LDIF
+LDIF_UNSUPPORTED_ARGS = ["random", "ip_address", "updatedns"]
+
+
+class LDIFChangeWriter(ldif.LDIFWriter if HAS_IPALIB else object):
+    """
+    LDIFWriter that also writes delete and modrdn change records
+    """
+
+    def unparse_delete(self, dn):
+        self._unparseAttrTypeandValue("dn", to_bytes(dn))
+        self._unparseAttrTypeandValue("changetype", b"delete")
+        self._output_file.write(self._line_sep)
+        self.records_written += 1
+
+    def unparse_modrdn(self, dn, newrdn, newsuperior):
+        self._unparseAttrTypeandValue("dn", to_bytes(str(dn)))
+        self._unparseAttrTypeandValue("changetype", b"modrdn")
+        self._unparseAttrTypeandValue("newrdn", to_bytes(str(newrdn)))
+        self._unparseAttrTypeandValue("deleteoldrdn", b"1")
+        self._unparseAttrTypeandValue("newsuperior",
+                                      to_bytes(str(newsuperior)))
+        self._output_file.write(self._line_sep)
+        self.records_written += 1
+
+
+def _ldif_values(value):
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    result = []
+    for x in value:
+        if isinstance(x, datetime):
+            x = x.strftime(LDAP_GENERALIZED_TIME_FORMAT)
+        elif isinstance(x, bool):
+            x = "TRUE" if x else "FALSE"
+        result.append(to_bytes(to_text(x)))
+    return result
+
+
+def _ldif_attrs(command, args):
+    attrs = {}
+    for key, value in args.items():
+        if key in LDIF_IGNORED_ARGS or value is None:
+            continue
+        if key in LDIF_UNSUPPORTED_ARGS:
+            raise ValueError("%s: '%s' can not be rendered as LDIF" %
+                             (command, key))
+        attrs[key] = _ldif_values(value)
+    return attrs
+
+
+def _ldif_add_user(name, args):
+    attrs = _ldif_attrs("user_add", args)
+    principal = "%s@%s" % (name, api.env.realm)
+    first = to_text(args.get("givenname", ""))
+    last = to_text(args.get("sn", ""))
+    fullname = args.get("cn", ("%s %s" % (first, last)).strip())
+    defaults = {
+        "uid": name,
+        "cn": fullname,
+        "displayname": fullname,
+        "gecos": fullname,
+        "initials": "%s%s" % (first[:1], last[:1]),
+        "homedirectory": "/home/%s" % name,
+        "loginshell": "/bin/sh",
+        "krbprincipalname": principal,
+        "krbcanonicalname": principal,
+        "uidnumber": LDIF_DNA_MAGIC,
+        "gidnumber": LDIF_DNA_MAGIC,
+        "ipauniqueid": "autogenerate",
+    }
+    for key, value in defaults.items():
+        if key not in attrs:
+            attrs[key] = _ldif_values(value)
+    attrs["objectclass"] = _ldif_values(LDIF_OBJECTCLASSES["user"])
+    return attrs
+
+
+def _ldif_add_group(name, args):
+    attrs = _ldif_attrs("group_add", args)
+    objectclasses = list(LDIF_OBJECTCLASSES["group"])
+    if args.get("external"):
+        objectclasses.append("ipaexternalgroup")
+    elif not args.get("nonposix"):
+        objectclasses.append("posixgroup")
+        if "gidnumber" not in attrs:
+            attrs["gidnumber"] = _ldif_values(LDIF_DNA_MAGIC)
+    attrs.pop("nonposix", None)
+    attrs.pop("external", None)
+    attrs["cn"] = _ldif_values(name)
+    attrs["ipauniqueid"] = _ldif_values("autogenerate")
+    attrs["objectclass"] = _ldif_values(objectclasses)
+    return attrs
+
+
+def _ldif_mod_group(args):
+    """
+    Return the group_mod args without the group type flags and the
+    modifications of the flags. Like group_mod a non-POSIX group is
+    converted to an external group or to a POSIX group with a gidNumber,
+    a POSIX group can not be converted to a non-POSIX group.
+    """
+    args = dict(args)
+    nonposix = args.pop("nonposix", None)
+    external = args.pop("external", None)
+    modlist = []
+    if external:
+        modlist.append((_ldap.MOD_ADD, "objectclass",
+                        _ldif_values("ipaexternalgroup")))
+    elif nonposix:
+        raise ValueError("group_mod: a POSIX group can not be converted to "
+                         "a non-POSIX group")
+    elif nonposix is not None:
+        modlist.append((_ldap.MOD_ADD, "objectclass",
+                        _ldif_values("posixgroup")))
+        if args.get("gidnumber") is None:
+            args["gidnumber"] = LDIF_DNA_MAGIC
+    return args, modlist
+
+
+def _ldif_add_host(name, args):
+    attrs = _ldif_attrs("host_add", args)
+    principal = "host/%s@%s" % (name, api.env.realm)
+    attrs["fqdn"] = _ldif_values(name)
+    attrs["cn"] = _ldif_values(name)
+    attrs["serverhostname"] = _ldif_values(name.split(".")[0])
+    attrs["krbprincipalname"] = _ldif_values(principal)
+    attrs["krbcanonicalname"] = _ldif_values(principal)
+    attrs["managedby"] = _ldif_values(str(entry_dn("host", name)))
+    attrs["ipauniqueid"] = _ldif_values("autogenerate")
+    attrs["objectclass"] = _ldif_values(LDIF_OBJECTCLASSES["host"])
+    return attrs
+
+
+def _ldif_member_dns(args):
+    containers = {
+        "user": ("uid", api.env.container_user),
+        "group": ("cn", api.env.container_group),
+        "host": ("fqdn", api.env.container_host),
+        "service": ("krbprincipalname", api.env.container_service),
+    }
+    dns = []
+    for key in ["user", "group", "host", "service"]:
+        attr, container = containers[key]
+        for name in args.get(key) or []:
+            dns.append(str(DN((attr, to_text(name)), container,
+                              api.env.basedn)))
+    return _ldif_values(dns)
+
+
+def _ldif_record(writer, kind, name, command, args):
+    name = to_text(name)
+    if kind == "user" and command in ["user_undel"]:
+        dn = entry_dn("user_preserved", name)
+    else:
+        dn = entry_dn(kind, name)
+    dn = str(dn)
+    action = command[len(kind) + 1:]
+
+    if action == "add":
+        generate = {"user": _ldif_add_user, "group": _ldif_add_group,
+                    "host": _ldif_add_host}[kind]
+        attrs = generate(name, args)
+        writer.unparse(dn, [(key, attrs[key]) for key in sorted(attrs)])
+    elif action == "mod":
+        modlist = []
+        if kind == "group":
+            args, modlist = _ldif_mod_group(args)
+        attrs = _ldif_attrs(command, args)
+        modlist.extend((_ldap.MOD_REPLACE, key, attrs[key])
+                       for key in sorted(attrs))
+        if modlist:
+            writer.unparse(dn, modlist)
+    elif action == "del":
+        if args.get("preserve"):
+            writer.unparse_modrdn(
+                dn, DN(("uid", name)),
+                DN(api.env.container_deleteuser, api.env.basedn))
+        else:
+            writer.unparse_delete(dn)
+    elif action == "undel":
+        writer.unparse_modrdn(dn, DN(("uid", name)),
+                              DN(api.env.container_user, api.env.basedn))
+    elif command == "host_disable":
+        # Remove the keytab
+        writer.unparse(dn, [(_ldap.MOD_DELETE, "krbprincipalkey", [])])
+    elif action in ["enable", "disable"]:
+        writer.unparse(dn, [(_ldap.MOD_REPLACE, "nsaccountlock",
+                             _ldif_values(action == "disable"))])
+    elif action == "unlock":
+        now = datetime.utcnow()
+        writer.unparse(dn, [
+            (_ldap.MOD_REPLACE, "krbloginfailedcount", _ldif_values("0")),
+            (_ldap.MOD_REPLACE, "krblastadminunlock", _ldif_values(now)),
+        ])
+    elif action in ["add_member", "remove_member"]:
+        # All members are changed with one multi-valued modify operation
+        values = _ldif_member_dns(args)
+        if values:
+            op = _ldap.MOD_ADD if action == "add_member" \
+                else _ldap.MOD_DELETE
+            writer.unparse(dn, [(op, "member", values)])
+    else:
+        raise ValueError("%s can not be rendered as LDIF" % command)
+
+
+def gen_ldif(module, kind, commands, path):
+    """
+    Write commands as LDIF change records to path instead of executing
+    them, for example to apply them with ldapmodify -c. Added users are
+    added to the default user group like with user_add, the user private
+    groups are created by the Managed Entries plugin of the server. The
+    file can contain passwords, it is only readable by the owner. Return
+    the number of written records.
+    """
+    if _jsonrpc is not None:
+        raise ValueError("LDIF output needs the local server API, it can "
+                         "not be used with ipaapi_server")
+
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix=".ipaldif-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            writer = LDIFChangeWriter(f, cols=76)
+            default_members = []
+            for name, command, args in commands:
+                if not command.startswith("%s_" % kind):
+                    raise ValueError("Command '%s' is not a %s command" %
+                                     (command, kind))
+                _ldif_record(writer, kind, name, command, args)
+                if command == "user_add":
+                    default_members.append(
+                        str(entry_dn("user", to_text(name))))
+            if default_members:
+                # All new users are added with one modify operation
+                group = api.Command["config_show"]()["result"][
+                    "ipadefaultprimarygroup"][0]
+                writer.unparse(str(entry_dn("group", to_text(group))),
+                               [(_ldap.MOD_ADD, "member",
+                                 _ldif_values(default_members))])
+        module.atomic_move(temp_path, path)
+        # atomic_move keeps the mode of an existing file
+        os.chmod(path, 0o600)
+        temp_path = None
+        return writer.records_written
+    finally:
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
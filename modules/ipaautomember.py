@@ -0,0 +1,502 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Thomas Woerner <twoerner@redhat.com>
+#
+# Copyright (C) 2019 Red Hat
+# see file 'COPYING' for use and warranty information
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+ANSIBLE_METADATA = {
+    "metadata_version": "1.0",
+    "supported_by": "community",
+    "status": ["preview"],
+}
+
+DOCUMENTATION = """
+---
+module: ipaautomember
+short description: Manage FreeIPA automember rules
+description:
+  Manage automember rules and their inclusive and exclusive conditions.
+  The membership of the target group is computed by the server when an
+  entry is created, existing entries are updated with state rebuilt.
+options:
+  ipaadmin_principal:
+    description: The admin principal
+    default: admin
+  ipaadmin_password:
+    description: The admin password
+    required: false
+  name:
+    description: The automember rule, this is the name of the target group
+    required: false
+    aliases: ["cn"]
+    type: list
+  automember_type:
+    description: The type of the rule
+    required: true
+    choices: ["group", "hostgroup"]
+  description:
+    description: The rule description
+    required: false
+  inclusive:
+    description: List of inclusive conditions
+    required: false
+    type: list
+    options:
+      key:
+        description: The attribute, for example manager or fqdn
+        required: true
+      expression:
+        description: The regular expression for the attribute value
+        required: true
+  exclusive:
+    description: List of exclusive conditions
+    required: false
+    type: list
+    options:
+      key:
+        description: The attribute, for example manager or fqdn
+        required: true
+      expression:
+        description: The regular expression for the attribute value
+        required: true
+  users:
+    description: Rebuild the membership of these users only
+    required: false
+    type: list
+  hosts:
+    description: Rebuild the membership of these hosts only
+    required: false
+    type: list
+  rebuild_timeout:
+    description: Timeout in seconds for the rebuild task
+    default: 3600
+  rebuild_poll_interval:
+    description: Poll interval in seconds for the rebuild task progress
+    default: 5
+  action:
+    description:
+      Work on rule or condition level. With action rule the conditions of
+      the rule are set exactly to inclusive and exclusive if given, with
+      action member the conditions are only added or removed.
+    default: rule
+    choices: ["rule", "member"]
+  state:
+    description: State to ensure
+    default: present
+    choices: ["present", "absent", "rebuilt"]
+author:
+    - Thomas Woerner
+"""
+
+EXAMPLES = """
+# Ensure that all users with manager bob are members of group devel
+- ipaautomember:
+    ipaadmin_password: MyPassword123
+    name: devel
+    automember_type: group
+    description: Developers
+    inclusive:
+    - key: manager
+      expression: uid=bob
+    exclusive:
+    - key: title
+      expression: ^Intern$
+
+# Add an inclusive condition to the rule of hostgroup webservers
+- ipaautomember:
+    ipaadmin_password: MyPassword123
+    name: webservers
+    automember_type: hostgroup
+    inclusive:
+    - key: fqdn
+      expression: ^web[0-9]+\\.example\\.com$
+    action: member
+
+# Rebuild the group membership of all users and wait for the task
+- ipaautomember:
+    ipaadmin_password: MyPassword123
+    automember_type: group
+    state: rebuilt
+
+# Remove the rule for devel
+- ipaautomember:
+    ipaadmin_password: MyPassword123
+    name: devel
+    automember_type: group
+    state: absent
+"""
+
+RETURN = """
+rebuild:
+  description:
+    The rebuild task with dn, status, exit code, the number of polls and
+    the elapsed time. In check mode the task is not started, only the
+    status is returned.
+  returned: if state is rebuilt
+  type: dict
+"""
+
+import time
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_text
+from ansible.module_utils.ansible_freeipa_module import temp_kinit, \
+    temp_kdestroy, valid_creds, api_connect, api_command, \
+    execute_commands, api, errors, DN
+
+CONDITION_ATTRIBUTES = {
+    "inclusive": "automemberinclusiveregex",
+    "exclusive": "automemberexclusiveregex",
+}
+
+
+def find_automember(module, name, automember_type):
+    _args = {
+        "all": True,
+        "type": to_text(automember_type),
+        "cn": to_text(name),
+    }
+
+    _result = api_command(module, "automember_find", None, _args)
+
+    results = [x for x in _result["result"]
+               if to_text(x["cn"][0]).lower() == to_text(name).lower()]
+    if len(results) > 1:
+        module.fail_json(
+            msg="There is more than one automember rule '%s'" % (name))
+    elif len(results) == 1:
+        return results[0]
+    else:
+        return None
+
+
+def gen_args(automember_type, description):
+    _args = {"type": to_text(automember_type)}
+    if description is not None:
+        _args["description"] = description
+
+    return _args
+
+
+def gen_conditions(module, conditions):
+    """
+    Return the set of (key, expression) of a list of condition dicts
+    """
+    result = set()
+    for condition in conditions or []:
+        if not isinstance(condition, dict) or \
+           condition.get("key") is None or \
+           condition.get("expression") is None:
+            module.fail_json(
+                msg="Each condition needs to be a dict with key and "
+                "expression")
+        result.add((to_text(condition["key"]),
+                    to_text(condition["expression"])))
+    return result
+
+
+def find_conditions(res_find, kind):
+    """
+    Return the set of (key, expression) of a rule for inclusive or
+    exclusive, the values are stored as key=expression
+    """
+    result = set()
+    for value in res_find.get(CONDITION_ATTRIBUTES[kind], []):
+        key, _sep, expression = to_text(value).partition("=")
+        result.add((key, expression))
+    return result
+
+
+def gen_condition_commands(name, automember_type, command, conditions):
+    """
+    Return one command per key for the inclusive and exclusive conditions
+    """
+    keys = {}
+    for kind, values in conditions.items():
+        for key, expression in values:
+            keys.setdefault(key, {}).setdefault(
+                CONDITION_ATTRIBUTES[kind], []).append(expression)
+
+    commands = []
+    for key in sorted(keys):
+        args = {"type": to_text(automember_type), "key": key}
+        for attr, expressions in keys[key].items():
+            args[attr] = sorted(expressions)
+        commands.append([name, command, args])
+    return commands
+
+
+def rebuild(module, automember_type, users, hosts, timeout, poll_interval):
+    """
+    Start the automember_rebuild task and wait for it with progress
+    polling
+    """
+    _args = {"no_wait": True}
+    if users is not None:
+        _args["users"] = users
+    elif hosts is not None:
+        _args["hosts"] = hosts
+    else:
+        _args["type"] = to_text(automember_type)
+
+    start = time.time()
+    _result = api_command(module, "automember_rebuild", None, _args)
+    task_dn = DN(_result["result"]["dn"])
+
+    task = {"dn": str(task_dn), "polls": 0}
+    ldap2 = api.Backend.ldap2
+    while True:
+        time.sleep(poll_interval)
+        task["polls"] += 1
+        try:
+            entry = ldap2.get_entry(task_dn, ["nstaskstatus",
+                                              "nstaskexitcode", "ttl"])
+        except errors.NotFound:
+            # The task entry has been removed after it finished, the
+            # result is unknown
+            module.fail_json(
+                msg="Automember rebuild task entry has been removed before "
+                "the exit code could be read", rebuild=task)
+        task["status"] = to_text(entry.single_value.get("nstaskstatus"))
+        ttl = entry.single_value.get("ttl")
+        if ttl is not None:
+            # The entry is removed ttl seconds after the task finished
+            poll_interval = max(min(poll_interval, int(ttl) // 2), 1)
+        exitcode = entry.single_value.get("nstaskexitcode")
+        if exitcode is not None:
+            task["exitcode"] = int(exitcode)
+            break
+        if time.time() - start > timeout:
+            module.fail_json(
+                msg="Automember rebuild task did not finish within %d "
+                "seconds" % timeout, rebuild=task)
+        module.debug("Automember rebuild: %s" % task["status"])
+
+    task["elapsed"] = round(time.time() - start, 3)
+    if task["exitcode"] != 0:
+        module.fail_json(msg="Automember rebuild task failed: %s" %
+                         task["status"], rebuild=task)
+    return task
+
+
+def main():
+    ansible_module = AnsibleModule(
+        argument_spec=dict(
+            # general
+            ipaadmin_principal=dict(type="str", default="admin"),
+            ipaadmin_password=dict(type="str", required=False, no_log=True),
+
+            name=dict(type="list", aliases=["cn"], default=None,
+                      required=False),
+            automember_type=dict(type="str", required=True,
+                                 choices=["group", "hostgroup"]),
+            # present
+            description=dict(type="str", default=None),
+            inclusive=dict(type="list", default=None),
+            exclusive=dict(type="list", default=None),
+            # rebuilt
+            users=dict(type="list", default=None),
+            hosts=dict(type="list", default=None),
+            rebuild_timeout=dict(type="int", default=3600),
+            rebuild_poll_interval=dict(type="int", default=5),
+
+            action=dict(type="str", default="rule",
+                        choices=["member", "rule"]),
+            # state
+            state=dict(type="str", default="present",
+                       choices=["present", "absent", "rebuilt"]),
+        ),
+        supports_check_mode=True,
+    )
+
+    ansible_module._ansible_debug = True
+
+    # Get parameters
+
+    # general
+    ipaadmin_principal = ansible_module.params.get("ipaadmin_principal")
+    ipaadmin_password = ansible_module.params.get("ipaadmin_password")
+    names = ansible_module.params.get("name")
+    automember_type = ansible_module.params.get("automember_type")
+
+    # present
+    description = ansible_module.params.get("description")
+    inclusive = ansible_module.params.get("inclusive")
+    exclusive = ansible_module.params.get("exclusive")
+    # rebuilt
+    users = ansible_module.params.get("users")
+    hosts = ansible_module.params.get("hosts")
+    rebuild_timeout = ansible_module.params.get("rebuild_timeout")
+    rebuild_poll_interval = ansible_module.params.get(
+        "rebuild_poll_interval")
+    action = ansible_module.params.get("action")
+    # state
+    state = ansible_module.params.get("state")
+
+    # Check parameters
+
+    if state == "rebuilt":
+        invalid = ["names", "description", "inclusive", "exclusive"]
+        if users is not None and hosts is not None:
+            ansible_module.fail_json(
+                msg="users can not be used together with hosts")
+        if users is not None and automember_type != "group" or \
+           hosts is not None and automember_type != "hostgroup":
+            ansible_module.fail_json(
+                msg="users need automember_type group, hosts need "
+                "automember_type hostgroup")
+    else:
+        invalid = ["users", "hosts"]
+        if names is None or len(names) < 1:
+            ansible_module.fail_json(msg="No name given.")
+    if state == "absent":
+        invalid.append("description")
+        if action == "rule":
+            invalid.extend(["inclusive", "exclusive"])
+    if state == "present" and action == "member":
+        invalid.append("description")
+    for x in invalid:
+        if vars()[x] is not None:
+            ansible_module.fail_json(
+                msg="Argument '%s' can not be used with state '%s'" %
+                (x, state))
+
+    conditions = {
+        "inclusive": gen_conditions(ansible_module, inclusive),
+        "exclusive": gen_conditions(ansible_module, exclusive),
+    }
+
+    # Init
+
+    changed = False
+    exit_args = {}
+    ccache_dir = None
+    ccache_name = None
+    try:
+        if not valid_creds(ansible_module, ipaadmin_principal):
+            ccache_dir, ccache_name = temp_kinit(ipaadmin_principal,
+                                                 ipaadmin_password)
+        api_connect()
+
+        if state == "rebuilt":
+            if ansible_module.check_mode:
+                # The rebuild would be started, it is not run
+                exit_args["rebuild"] = {"status": "not started in check "
+                                                  "mode"}
+            else:
+                exit_args["rebuild"] = rebuild(
+                    ansible_module, automember_type, users, hosts,
+                    rebuild_timeout, rebuild_poll_interval)
+            changed = True
+            names = []
+
+        commands = []
+
+        for name in names:
+            # Make sure automember rule exists
+            res_find = find_automember(ansible_module, name,
+                                       automember_type)
+
+            # Create command
+            if state == "present":
+                if action == "rule":
+                    # Generate args
+                    args = gen_args(automember_type, description)
+
+                    if res_find is not None:
+                        if description is not None and \
+                           to_text(description) != to_text(
+                               res_find.get("description", [""])[0]):
+                            commands.append([name, "automember_mod", args])
+                    else:
+                        commands.append([name, "automember_add", args])
+                        res_find = {}
+
+                    # Set conditions exactly if given
+                    add = {}
+                    remove = {}
+                    for kind, _conditions in [("inclusive", inclusive),
+                                              ("exclusive", exclusive)]:
+                        if _conditions is None:
+                            continue
+                        current = find_conditions(res_find, kind)
+                        add[kind] = conditions[kind] - current
+                        remove[kind] = current - conditions[kind]
+                    commands.extend(gen_condition_commands(
+                        name, automember_type, "automember_remove_condition",
+                        remove))
+                    commands.extend(gen_condition_commands(
+                        name, automember_type, "automember_add_condition",
+                        add))
+
+                elif action == "member":
+                    if res_find is None:
+                        ansible_module.fail_json(
+                            msg="No automember rule '%s'" % name)
+
+                    add = dict(
+                        (kind, conditions[kind] -
+                         find_conditions(res_find, kind))
+                        for kind in conditions)
+                    commands.extend(gen_condition_commands(
+                        name, automember_type, "automember_add_condition",
+                        add))
+
+            elif state == "absent":
+                if action == "rule":
+                    if res_find is not None:
+                        commands.append(
+                            [name, "automember_del",
+                             {"type": to_text(automember_type)}])
+
+                elif action == "member":
+                    if res_find is None:
+                        ansible_module.fail_json(
+                            msg="No automember rule '%s'" % name)
+
+                    remove = dict(
+                        (kind, conditions[kind] &
+                         find_conditions(res_find, kind))
+                        for kind in conditions)
+                    commands.extend(gen_condition_commands(
+                        name, automember_type,
+                        "automember_remove_condition", remove))
+
+            else:
+                ansible_module.fail_json(msg="Unkown state '%s'" % state)
+
+        # Execute commands
+
+        if len(commands) > 0:
+            changed = True
+            if not ansible_module.check_mode:
+                execute_commands(ansible_module, commands)
+
+    except Exception as e:
+        ansible_module.fail_json(msg=str(e))
+
+    finally:
+        temp_kdestroy(ccache_dir, ccache_name)
+
+    # Done
+
+    ansible_module.exit_json(changed=changed, **exit_args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Thomas Woerner <twoerner@redhat.com>
+#
+# Copyright (C) 2019 Red Hat
+# see file 'COPYING' for use and warranty information
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+ANSIBLE_METADATA = {
+    "metadata_version": "1.0",
+    "supported_by": "community",
+    "status": ["preview"],
+}
+
+DOCUMENTATION = """
+---
+module: ipaexport
+short description: Export FreeIPA users, groups and hosts as NDJSON
+description:
+  Export users, groups and hosts to a NDJSON file on the managed node, one
+  JSON object per entry and line. The entries are read with paged searches
+  and written as they arrive, the memory usage does not depend on the
+  number of entries. The file is only replaced if the content changed.
+options:
+  ipaadmin_principal:
+    description: The admin principal
+    default: admin
+  ipaadmin_password:
+    description: The admin password
+    required: false
+  dest:
+    description: The NDJSON file to write
+    required: true
+  kind:
+    description: The kinds of entries to export
+    required: false
+    type: list
+    default: ["user", "group", "host"]
+    choices: ["user", "group", "host"]
+  attributes:
+    description:
+      The attributes to export, default is a basic set per kind. The key
+      attribute is always exported.
+    required: false
+    type: list
+  members:
+    description:
+      Export the group members as member_user, member_group and
+      member_host names instead of member DNs
+    type: bool
+    default: true
+  compress:
+    description: Compress the file with gzip
+    type: bool
+    default: false
+  page_size:
+    description: The number of entries per search page
+    default: 1000
+author:
+    - Thomas Woerner
+"""
+
+EXAMPLES = """
+- ipaexport:
+    ipaadmin_password: MyPassword123
+    dest: /var/tmp/ipa-export.ndjson.gz
+    compress: yes
+  register: result
+
+- fetch:
+    src: /var/tmp/ipa-export.ndjson.gz
+    dest: exports/
+"""
+
+RETURN = """
+entries:
+  description: Number of exported entries per kind
+  returned: always
+  type: dict
+checksum:
+  description: The SHA1 checksum of the written file
+  returned: always
+  type: str
+elapsed:
+  description: The export time in seconds
+  returned: always
+  type: float
+"""
+
+import os
+import json
+import gzip
+import base64
+import hashlib
+import tempfile
+import time
+from datetime import datetime
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_text, to_bytes
+from ansible.module_utils.ansible_freeipa_module import temp_kinit, \
+    temp_kdestroy, valid_creds, api_connect, api_paged_search, \
+    MIRROR_KINDS, LDAP_GENERALIZED_TIME_FORMAT, api, DN
+
+# Default attributes per kind
+EXPORT_ATTRIBUTES = {
+    "user": ["uid", "givenname", "sn", "cn", "displayname", "mail",
+             "uidnumber", "gidnumber", "homedirectory", "loginshell",
+             "krbprincipalname", "nsaccountlock", "memberof"],
+    "group": ["cn", "description", "gidnumber", "member"],
+    "host": ["fqdn", "description", "l", "nshostlocation",
+             "krbprincipalname", "memberof"],
+}
+
+# Member containers and the keys used for the member names
+MEMBER_CONTAINERS = [
+    ("container_user", "member_user"),
+    ("container_group", "member_group"),
+    ("container_host", "member_host"),
+]
+
+
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.strftime(LDAP_GENERALIZED_TIME_FORMAT)
+    if isinstance(value, bytes):
+        try:
+            return value.decode("utf-8")
+        except UnicodeDecodeError:
+            return base64.b64encode(value).decode("ascii")
+    if isinstance(value, DN):
+        return str(value)
+    return value
+
+
+def split_members(member_dns, containers):
+    """
+    Return the member DNs as member_user, member_group and member_host
+    names, unknown members as member DNs
+    """
+    result = {}
+    for dn in member_dns:
+        for container, key in containers:
+            if dn.endswith(container) and len(dn) == len(container) + 1:
+                result.setdefault(key, []).append(to_text(dn[0].value))
+                break
+        else:
+            result.setdefault("member", []).append(to_text(dn))
+    return result
+
+
+def export_entry(kind, entry, attributes, containers):
+    obj = {"kind": kind, "dn": str(entry.dn)}
+    for attr in attributes:
+        values = entry.get(attr)
+        if not values:
+            continue
+        if attr == "member" and containers is not None:
+            obj.update(split_members(values, containers))
+            continue
+        obj[attr] = [export_value(value) for value in values]
+    return obj
+
+
+def file_checksum(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def main():
+    ansible_module = AnsibleModule(
+        argument_spec=dict(
+            ipaadmin_principal=dict(type="str", default="admin"),
+            ipaadmin_password=dict(type="str", required=False, no_log=True),
+            dest=dict(type="path", required=True),
+            kind=dict(type="list", default=["user", "group", "host"]),
+            attributes=dict(type="list", default=None),
+            members=dict(type="bool", default=True),
+            compress=dict(type="bool", default=False),
+            page_size=dict(type="int", default=1000),
+        ),
+        supports_check_mode=True,
+    )
+
+    ansible_module._ansible_debug = True
+
+    # Get parameters
+
+    ipaadmin_principal = ansible_module.params.get("ipaadmin_principal")
+    ipaadmin_password = ansible_module.params.get("ipaadmin_password")
+    dest = ansible_module.params.get("dest")
+    kinds = ansible_module.params.get("kind")
+    attributes = ansible_module.params.get("attributes")
+    members = ansible_module.params.get("members")
+    compress = ansible_module.params.get("compress")
+    page_size = ansible_module.params.get("page_size")
+
+    # Check parameters
+
+    for kind in kinds:
+        if kind not in EXPORT_ATTRIBUTES:
+            ansible_module.fail_json(msg="Unknown kind '%s'" % kind)
+    if attributes is not None:
+        attributes = [attr.lower() for attr in attributes]
+
+    # Init
+
+    exit_args = {"entries": {}}
+    changed = False
+    ccache_dir = None
+    ccache_name = None
+    temp_path = None
+    start = time.time()
+    try:
+        if not valid_creds(ansible_module, ipaadmin_principal):
+            ccache_dir, ccache_name = temp_kinit(ipaadmin_principal,
+                                                 ipaadmin_password)
+        api_connect()
+
+        containers = None
+        if members:
+            containers = [(DN(api.env[container], api.env.basedn), key)
+                          for container, key in MEMBER_CONTAINERS]
+
+        # Write to a temporary file in the destination directory, it
+        # replaces dest only if the content changed.
+
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(dest)),
+            prefix=".ipaexport-")
+        with os.fdopen(fd, "wb") as raw:
+            if compress:
+                # mtime 0 keeps the checksum stable for unchanged content
+                out = gzip.GzipFile(filename="", mode="wb", fileobj=raw,
+                                    mtime=0)
+            else:
+                out = raw
+            for kind in kinds:
+                key, container, ldap_filter, _command, _args = \
+                    MIRROR_KINDS[kind]
+                attrs = attributes or EXPORT_ATTRIBUTES[kind]
+                if key not in attrs:
+                    attrs = [key] + attrs
+                count = 0
+                for entry in api_paged_search(
+                        DN(api.env[container], api.env.basedn), ldap_filter,
+                        attrs, page_size=page_size):
+                    obj = export_entry(kind, entry, attrs, containers)
+                    out.write(to_bytes(json.dumps(obj, sort_keys=True)))
+                    out.write(b"\n")
+                    count += 1
+                exit_args["entries"][kind] = count
+            if compress:
+                out.close()
+
+        checksum = file_checksum(temp_path)
+        exit_args["checksum"] = checksum
+        if not os.path.exists(dest) or file_checksum(dest) != checksum:
+            changed = True
+            if not ansible_module.check_mode:
+                ansible_module.atomic_move(temp_path, dest)
+                temp_path = None
+
+    except Exception as e:
+        ansible_module.fail_json(msg=str(e))
+
+    finally:
+        temp_kdestroy(ccache_dir, ccache_name)
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    # Done
+
+    exit_args["elapsed"] = round(time.time() - start, 3)
+    ansible_module.exit_json(changed=changed, **exit_args)
+
+
+if __name__ == "__main__":
+    main()
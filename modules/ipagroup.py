@@ -42,6 +42,16 @@ options:
     description: The group name
     required: false
     aliases: ["cn"]
+  groups:
+    description:
+      List of groups for bulk mode and the complete list of groups for
+      state exact. Each group is a dict with name and the group settings
+      (description, gid, nonposix, external, nomembers, user, group and
+      service). In state exact members are only managed for the member
+      types that are set.
+    required: false
+    type: list
+    elements: dict
   description:
     description: The group description
     required: false
@@ -77,10 +87,21 @@ options:
     description: Work on group or member level
     default: group
     choices: ["member", "group"]
+  exact_max_delete:
+    description:
+      The maximum number of groups that may be deleted in state exact
+    default: 100
+  exact_protect:
+    description: List of groups that will never be deleted in state exact
+    default: ["admins", "editors", "ipausers", "trust admins",
+              "default smb group"]
+    type: list
   state:
     description: State to ensure
     default: present
-    choices: ["present", "absent"]
+    choices: ["present", "absent", "exact"]
+extends_documentation_fragment:
+  - ipaapi
 author:
     - Thomas Woerner
 """
@@ -131,18 +152,77 @@ EXAMPLES = """
     ipaadmin_password: MyPassword123
     name: sysops,appops,ops
     state: absent
+
+# Ensure ops and sysops are the only groups besides the protected groups
+- ipagroup:
+    ipaadmin_password: MyPassword123
+    groups:
+    - name: ops
+      gid: 1234
+      group:
+      - sysops
+    - name: sysops
+      user:
+      - pinky
+      - brain
+    state: exact
 """
 
 RETURN = """
+commands:
+  description:
+    The planned commands in check mode. Each command has name, command,
+    args and the entry state as precondition, it can be applied with the
+    plan option.
+  returned: in check mode
+  type: list
+ldif_records:
+  description: The number of change records written to the LDIF file
+  returned: if ldif is set
+  type: int
+retries:
+  description:
+    The retry statistics, number of retries, retried commands, recovered
+    and already applied commands, gave up commands and the backoff delay
+  returned: always
+  type: dict
+throttle:
+  description:
+    The throttle statistics, commands, average and maximum latency per
+    command, the final and maximum limit, the number of decreases and the
+    wait time
+  returned: if the throttle is used
+  type: dict
+ipaapi_server:
+  description: The server selected with ipaapi_server auto
+  returned: if ipaapi_server is auto
+  type: str
+shards:
+  description:
+    The shard statistics, commands and elapsed time per server, the wait
+    times for replication and the servers that get a DNA range on demand
+  returned: if ipaapi_shards is used
+  type: dict
+results:
+  description: The per group results in bulk mode
+  returned: if groups is set
+  type: list
 """
 
 from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils._text import to_text
-from ansible.module_utils.ansible_freeipa_module import temp_kinit, \
-    temp_kdestroy, valid_creds, api_connect, api_command, compare_args_ipa
+from ansible.module_utils.ansible_freeipa_module import api_command, \
+    compare_args_ipa, mirror_open, api_paged_index, exact_delete_names, \
+    check_items, item_argument_spec, check_plan, ipaapi_argument_spec, \
+    ipaapi_connect, ipaapi_execute, ipaapi_disconnect, ipaapi_stats
 
 
-def find_group(module, name):
+def find_group(module, name, mirror=None):
+    if mirror is not None:
+        found, entry = mirror.lookup("group", name)
+        if found:
+            return entry
+
     _args = {
         "all": True,
         "cn": to_text(name),
@@ -187,15 +267,107 @@ def gen_member_args(user, group, service):
     return _args
 
 
+# The attributes compared in state exact, member is returned as
+# member_user, member_group and member_service
+EXACT_ATTRS = ["description", "gidnumber", "member", "objectclass"]
+
+GROUP_KEYS = {
+    "description": "str",
+    "gid": "int",
+    "nonposix": "bool",
+    "external": "bool",
+    "nomembers": "bool",
+    "user": "list",
+    "group": "list",
+    "service": "list",
+}
+
+
+def gen_exact_member_commands(name, item, res_find):
+    commands = []
+    add_args = {}
+    del_args = {}
+    for key in ["user", "group", "service"]:
+        if item.get(key) is None:
+            continue
+        # Service principals are case sensitive
+        if key == "service":
+            desired = set(to_text(x) for x in item[key])
+            current = set(to_text(x)
+                          for x in res_find.get("member_%s" % key, []))
+        else:
+            desired = set(to_text(x).lower() for x in item[key])
+            current = set(to_text(x).lower()
+                          for x in res_find.get("member_%s" % key, []))
+        if desired - current:
+            add_args[key] = sorted(desired - current)
+        if current - desired:
+            del_args[key] = sorted(current - desired)
+
+    if add_args:
+        commands.append([name, "group_add_member", add_args])
+    if del_args:
+        commands.append([name, "group_remove_member", del_args])
+    return commands
+
+
+def exact_mod_args(args, res_find):
+    """
+    Return the args to compare with an existing group in state exact.
+    nomembers is only used on add, the group type flags are compared with
+    the object classes of the group and left out if these are unknown.
+    """
+    args = dict(args)
+    args.pop("nomembers", None)
+    objectclass = [to_text(x).lower() for x in res_find.get("objectclass",
+                                                            [])]
+    for key, value in [("nonposix", "posixgroup" not in objectclass),
+                       ("external", "ipaexternalgroup" in objectclass)]:
+        if key in args and (not objectclass or args[key] == value):
+            del args[key]
+    return args
+
+
+def gen_exact_commands(module, groups, max_delete, protect):
+    """
+    Compute the commands to make the groups match groups exactly
+    """
+    desired = check_items(module, groups, GROUP_KEYS)
+    current = api_paged_index(module, "group", EXACT_ATTRS)
+
+    commands = []
+    for name, item in desired.items():
+        args = gen_args(item.get("description"), item.get("gid"),
+                        item.get("nonposix"), item.get("external"),
+                        item.get("nomembers"))
+        res_find = current.get(name)
+        if res_find is not None:
+            args = exact_mod_args(args, res_find)
+            if not compare_args_ipa(module, args, res_find):
+                commands.append([item["name"], "group_mod", args])
+        else:
+            commands.append([item["name"], "group_add", args])
+            res_find = {}
+        commands.extend(gen_exact_member_commands(item["name"], item,
+                                                  res_find))
+
+    for name in exact_delete_names(module, current, desired, protect,
+                                   max_delete):
+        commands.append([current[name]["cn"][0], "group_del", {}])
+
+    return commands
+
+
 def main():
     ansible_module = AnsibleModule(
         argument_spec=dict(
+            ipaapi_argument_spec(),
             # general
             ipaadmin_principal=dict(type="str", default="admin"),
             ipaadmin_password=dict(type="str", required=False, no_log=True),
-
             name=dict(type="list", aliases=["cn"], default=None,
-                      required=True),
+                      required=False),
+            groups=item_argument_spec(GROUP_KEYS),
             # present
             description=dict(type="str", default=None),
             gid=dict(type="int", aliases=["gidnumber"], default=None),
@@ -207,10 +379,16 @@ def main():
             service=dict(required=False, type='list', default=None),
             action=dict(type="str", default="group",
                         choices=["member", "group"]),
+            # exact
+            exact_max_delete=dict(type="int", default=100),
+            exact_protect=dict(type="list",
+                               default=["admins", "editors", "ipausers",
+                                        "trust admins", "default smb group"]),
             # state
             state=dict(type="str", default="present",
                        choices=["present", "absent",
-                                "member_present", "member_absent"]),
+                                "member_present", "member_absent",
+                                "exact"]),
         ),
         supports_check_mode=True,
     )
@@ -223,6 +401,7 @@ def main():
     ipaadmin_principal = ansible_module.params.get("ipaadmin_principal")
     ipaadmin_password = ansible_module.params.get("ipaadmin_password")
     names = ansible_module.params.get("name")
+    groups = ansible_module.params.get("groups")
 
     # present
     description = ansible_module.params.get("description")
@@ -234,12 +413,57 @@ def main():
     group = ansible_module.params.get("group")
     service = ansible_module.params.get("service")
     action = ansible_module.params.get("action")
+    # exact
+    exact_max_delete = ansible_module.params.get("exact_max_delete")
+    exact_protect = ansible_module.params.get("exact_protect")
+    # plan
+    plan = ansible_module.params.get("plan")
+    # mirror
+    mirror_path = ansible_module.params.get("mirror")
+    mirror_max_age = ansible_module.params.get("mirror_max_age")
     # state
     state = ansible_module.params.get("state")
 
     # Check parameters
 
-    if state == "present":
+    if plan is not None:
+        if names is not None or groups is not None:
+            ansible_module.fail_json(
+                msg="plan can not be used together with name or groups")
+        names = []
+    elif groups is not None:
+        if names is not None:
+            ansible_module.fail_json(
+                msg="name can not be used together with groups")
+        for x in ["description", "gid", "nonposix", "external", "nomembers",
+                  "user", "group", "service"]:
+            if vars()[x] is not None:
+                ansible_module.fail_json(
+                    msg="Argument '%s' can not be used together with groups, "
+                    "set it in groups" % x)
+        items = check_items(ansible_module, groups, GROUP_KEYS)
+        invalid = []
+        if state == "present" and action == "member":
+            invalid = ["description", "gid", "nonposix", "external",
+                       "nomembers"]
+        elif state == "absent":
+            invalid = ["description", "gid", "nonposix", "external",
+                       "nomembers"]
+            if action == "group":
+                invalid.extend(["user", "group", "service"])
+        for item in items.values():
+            for x in invalid:
+                if item.get(x) is not None:
+                    ansible_module.fail_json(
+                        msg="Argument '%s' can not be used with state '%s' "
+                        "and action '%s'" % (x, state, action))
+        names = []
+    elif state == "exact":
+        ansible_module.fail_json(msg="groups is needed for state exact")
+    elif names is None:
+        ansible_module.fail_json(msg="name is needed")
+
+    if state == "present" and groups is None and plan is None:
         if len(names) != 1:
             ansible_module.fail_json(
                 msg="Only one group can be added at a time.")
@@ -252,7 +476,7 @@ def main():
                         msg="Argument '%s' can not be used with action "
                         "'%s'" % (x, action))
 
-    if state == "absent":
+    if state == "absent" and groups is None and plan is None:
         if len(names) < 1:
             ansible_module.fail_json(
                 msg="No name given.")
@@ -271,17 +495,40 @@ def main():
     exit_args = {}
     ccache_dir = None
     ccache_name = None
+    mirror = None
     try:
-        if not valid_creds(ansible_module, ipaadmin_principal):
-            ccache_dir, ccache_name = temp_kinit(ipaadmin_principal,
-                                                 ipaadmin_password)
-        api_connect()
+        mirror = mirror_open(ansible_module, mirror_path, mirror_max_age)
+        ccache_dir, ccache_name, exit_args = ipaapi_connect(
+            ansible_module, ipaadmin_principal, ipaadmin_password)
 
         commands = []
 
-        for name in names:
+        if plan is not None:
+            commands = check_plan(ansible_module, "group", plan)
+            bulk = []
+        elif state == "exact":
+            commands = gen_exact_commands(ansible_module, groups,
+                                          exact_max_delete, exact_protect)
+            bulk = []
+        elif groups is not None:
+            bulk = [(item["name"], item) for item in groups]
+        else:
+            bulk = [(name, None) for name in names]
+
+        for name, item in bulk:
+            if item is not None:
+                # Bulk mode: the settings are given per group
+                description = item.get("description")
+                gid = item.get("gid")
+                nonposix = item.get("nonposix")
+                external = item.get("external")
+                nomembers = item.get("nomembers")
+                user = item.get("user")
+                group = item.get("group")
+                service = item.get("service")
+
             # Make sure group exists
-            res_find = find_group(ansible_module, name)
+            res_find = find_group(ansible_module, name, mirror=mirror)
 
             # Create command
             if state == "present":
@@ -402,22 +649,29 @@ def main():
 
         # Execute commands
 
-        for name, command, args in commands:
-            try:
-                api_command(ansible_module, command, to_text(name), args)
-                changed = True
-            except Exception as e:
-                ansible_module.fail_json(msg="%s: %s: %s" % (command, name,
-                                                             str(e)))
+        changed_names, _exit_args = ipaapi_execute(ansible_module, "group",
+                                                   commands, mirror)
+        exit_args.update(_exit_args)
+        if len(changed_names) > 0:
+            changed = True
+
+        if groups is not None:
+            exit_args["results"] = [
+                {"name": item["name"],
+                 "changed": to_text(item["name"]).lower() in changed_names}
+                for item in groups]
 
     except Exception as e:
         ansible_module.fail_json(msg=str(e))
 
     finally:
-        temp_kdestroy(ccache_dir, ccache_name)
+        ipaapi_disconnect(ccache_dir, ccache_name)
+        if mirror is not None:
+            mirror.close()
 
     # Done
 
+    exit_args.update(ipaapi_stats())
     ansible_module.exit_json(changed=changed, **exit_args)
 
 
@@ -41,7 +41,17 @@ options:
   name:
     description: The full qualified domain name.
     aliases: ["fqdn"]
-    required: true
+    required: false
+  hosts:
+    description:
+      List of hosts for bulk mode and the complete list of hosts for state
+      exact. Each host is a dict with name and the host settings
+      (description, locality, location, platform, os, password, random,
+      mac_address, force, reverse, ip_address and update_dns). The settings
+      can only be used with states present and exact.
+    required: false
+    type: list
+    elements: dict
   description:
     description: The host description
     required: false
@@ -94,11 +104,23 @@ options:
       Set password for a host in present state only on creation or always
     default: 'always'
     choices: ["always", "on_create"]
+  exact_max_delete:
+    description:
+      The maximum number of hosts that may be deleted in state exact
+    default: 100
+  exact_protect:
+    description:
+      List of hosts that will never be deleted in state exact. The IPA
+      servers are always protected.
+    default: []
+    type: list
   state:
     description: State to ensure
     default: present
     choices: ["present", "absent",
-              "disabled"]
+              "disabled", "exact"]
+extends_documentation_fragment:
+  - ipaapi
 author:
     - Thomas Woerner
 """
@@ -146,18 +168,74 @@ EXAMPLES = """
     ipaadmin_password: password1
     name: host01.example.com
     state: absent
+
+# Ensure host01 and host02 are the only hosts besides the IPA servers
+- ipahost:
+    ipaadmin_password: MyPassword123
+    hosts:
+    - name: host01.example.com
+      description: Example host
+    - name: host02.example.com
+      force: yes
+    state: exact
 """
 
 RETURN = """
+commands:
+  description:
+    The planned commands in check mode. Each command has name, command,
+    args and the entry state as precondition, it can be applied with the
+    plan option.
+  returned: in check mode
+  type: list
+ldif_records:
+  description: The number of change records written to the LDIF file
+  returned: if ldif is set
+  type: int
+retries:
+  description:
+    The retry statistics, number of retries, retried commands, recovered
+    and already applied commands, gave up commands and the backoff delay
+  returned: always
+  type: dict
+throttle:
+  description:
+    The throttle statistics, commands, average and maximum latency per
+    command, the final and maximum limit, the number of decreases and the
+    wait time
+  returned: if the throttle is used
+  type: dict
+ipaapi_server:
+  description: The server selected with ipaapi_server auto
+  returned: if ipaapi_server is auto
+  type: str
+shards:
+  description:
+    The shard statistics, commands and elapsed time per server, the wait
+    times for replication and the servers that get a DNA range on demand
+  returned: if ipaapi_shards is used
+  type: dict
+results:
+  description: The per host results in bulk mode
+  returned: if hosts is set
+  type: list
 """
 
 from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils._text import to_text
-from ansible.module_utils.ansible_freeipa_module import temp_kinit, \
-    temp_kdestroy, valid_creds, api_connect, api_command, compare_args_ipa
+from ansible.module_utils.ansible_freeipa_module import api_command, \
+    compare_args_ipa, mirror_open, api_paged_index, exact_delete_names, \
+    check_items, item_argument_spec, check_plan, ipaapi_argument_spec, \
+    ipaapi_connect, ipaapi_execute, ipaapi_disconnect, ipaapi_stats, \
+    get_masters
 
 
-def find_host(module, name):
+def find_host(module, name, mirror=None):
+    if mirror is not None:
+        found, entry = mirror.lookup("host", name)
+        if found:
+            return entry
+
     _args = {
         "all": True,
         "fqdn": to_text(name),
@@ -210,15 +288,75 @@ def gen_args(description, force, locality, location, platform, os, password,
     return _args
 
 
+# The attributes compared in state exact
+EXACT_ATTRS = ["description", "l", "nshostlocation", "nshardwareplatform",
+               "nsosversion", "macaddress"]
+
+HOST_KEYS = {
+    "description": "str",
+    "locality": "str",
+    "location": "str",
+    "platform": "str",
+    "os": "str",
+    "password": "str",
+    "random": "bool",
+    "mac_address": "list",
+    "force": "bool",
+    "reverse": "bool",
+    "ip_address": "str",
+    "update_dns": "bool",
+}
+
+
+def gen_exact_commands(module, hosts, update_password, max_delete, protect):
+    """
+    Compute the commands to make the hosts match hosts exactly
+    """
+    desired = check_items(module, hosts, HOST_KEYS)
+    current = api_paged_index(module, "host", EXACT_ATTRS)
+
+    commands = []
+    for name, item in desired.items():
+        args = gen_args(
+            item.get("description"), item.get("force"), item.get("locality"),
+            item.get("location"), item.get("platform"), item.get("os"),
+            item.get("password"), item.get("random"),
+            item.get("mac_address"), item.get("ip_address"),
+            item.get("update_dns"), item.get("reverse", True))
+        res_find = current.get(name)
+        if res_find is not None:
+            if update_password == "on_create" and "userpassword" in args:
+                del args["userpassword"]
+            for x in ["force", "ip_address", "no_reverse"]:
+                if x in args:
+                    del args[x]
+            # random and updatedns are not returned by host_show, they
+            # are only used if there are other changes
+            compare = dict((key, value) for key, value in args.items()
+                           if key not in ["random", "updatedns"])
+            if not compare_args_ipa(module, compare, res_find):
+                commands.append([item["name"], "host_mod", args])
+        else:
+            commands.append([item["name"], "host_add", args])
+
+    protect = list(protect or []) + get_masters(module)
+    for name in exact_delete_names(module, current, desired, protect,
+                                   max_delete):
+        commands.append([current[name]["fqdn"][0], "host_del", {}])
+
+    return commands
+
+
 def main():
     ansible_module = AnsibleModule(
         argument_spec=dict(
+            ipaapi_argument_spec(),
             # general
             ipaadmin_principal=dict(type="str", default="admin"),
             ipaadmin_password=dict(type="str", no_log=True),
-
             name=dict(type="list", aliases=["fqdn"], default=None,
-                      required=True),
+                      required=False),
+            hosts=item_argument_spec(HOST_KEYS),
             # present
             description=dict(type="str", default=None),
             locality=dict(type="str", default=None),
@@ -259,9 +397,12 @@ def main():
 
             # disabled
 
+            # exact
+            exact_max_delete=dict(type="int", default=100),
+            exact_protect=dict(type="list", default=[]),
             # state
             state=dict(type="str", default="present",
-                       choices=["present", "absent", "disabled"]),
+                       choices=["present", "absent", "disabled", "exact"]),
         ),
         supports_check_mode=True,
     )
@@ -274,6 +415,7 @@ def main():
     ipaadmin_principal = ansible_module.params.get("ipaadmin_principal")
     ipaadmin_password = ansible_module.params.get("ipaadmin_password")
     names = ansible_module.params.get("name")
+    hosts = ansible_module.params.get("hosts")
 
     # present
     description = ansible_module.params.get("description")
@@ -291,18 +433,54 @@ def main():
     update_password = ansible_module.params.get("update_password")
     # absent
     # disabled
+    # exact
+    exact_max_delete = ansible_module.params.get("exact_max_delete")
+    exact_protect = ansible_module.params.get("exact_protect")
+    # plan
+    plan = ansible_module.params.get("plan")
+    # mirror
+    mirror_path = ansible_module.params.get("mirror")
+    mirror_max_age = ansible_module.params.get("mirror_max_age")
     # state
     state = ansible_module.params.get("state")
 
     # Check parameters
 
-    if state == "present":
+    if plan is not None:
+        if names is not None or hosts is not None:
+            ansible_module.fail_json(
+                msg="plan can not be used together with name or hosts")
+        names = []
+    elif hosts is not None:
+        if names is not None:
+            ansible_module.fail_json(
+                msg="name can not be used together with hosts")
+        for x in ["description", "locality", "location", "platform", "os",
+                  "password", "random", "mac_address", "force",
+                  "ip_address", "update_dns"]:
+            if vars()[x] is not None:
+                ansible_module.fail_json(
+                    msg="Argument '%s' can not be used together with hosts, "
+                    "set it in hosts" % x)
+        items = check_items(ansible_module, hosts, HOST_KEYS)
+        for item in items.values():
+            if state not in ["present", "exact"] and len(item) > 1:
+                ansible_module.fail_json(
+                    msg="Only name can be set in hosts with state '%s'" %
+                    state)
+        names = []
+    elif state == "exact":
+        ansible_module.fail_json(msg="hosts is needed for state exact")
+    elif names is None:
+        ansible_module.fail_json(msg="name is needed")
+
+    if state == "present" and hosts is None and plan is None:
         if len(names) != 1:
             ansible_module.fail_json(
                 msg="Only one host can be added at a time.")
 
     if state == "absent":
-        if len(names) < 1:
+        if len(names) < 1 and hosts is None and plan is None:
             ansible_module.fail_json(
                 msg="No name given.")
         for x in ["description", "password", "random", "mac_address",
@@ -321,17 +499,46 @@ def main():
     exit_args = {}
     ccache_dir = None
     ccache_name = None
+    mirror = None
     try:
-        if not valid_creds(ansible_module, ipaadmin_principal):
-            ccache_dir, ccache_name = temp_kinit(ipaadmin_principal,
-                                                 ipaadmin_password)
-        api_connect()
+        mirror = mirror_open(ansible_module, mirror_path, mirror_max_age)
+        ccache_dir, ccache_name, exit_args = ipaapi_connect(
+            ansible_module, ipaadmin_principal, ipaadmin_password)
 
         commands = []
 
-        for name in names:
+        if plan is not None:
+            commands = check_plan(ansible_module, "host", plan,
+                                  password)
+            bulk = []
+        elif state == "exact":
+            commands = gen_exact_commands(ansible_module, hosts,
+                                          update_password, exact_max_delete,
+                                          exact_protect)
+            bulk = []
+        elif hosts is not None:
+            bulk = [(item["name"], item) for item in hosts]
+        else:
+            bulk = [(name, None) for name in names]
+
+        for name, item in bulk:
+            if item is not None:
+                # Bulk mode: the settings are given per host
+                description = item.get("description")
+                locality = item.get("locality")
+                location = item.get("location")
+                platform = item.get("platform")
+                os = item.get("os")
+                password = item.get("password")
+                random = item.get("random")
+                mac_address = item.get("mac_address")
+                force = item.get("force")
+                reverse = item.get("reverse", True)
+                ip_address = item.get("ip_address")
+                update_dns = item.get("update_dns")
+
             # Make sure host exists
-            res_find = find_host(ansible_module, name)
+            res_find = find_host(ansible_module, name, mirror=mirror)
 
             # Create command
             if state == "present":
@@ -377,22 +584,29 @@ def main():
                 ansible_module.fail_json(msg="Unkown state '%s'" % state)
 
         # Execute commands
-        for name, command, args in commands:
-            try:
-                api_command(ansible_module, command, to_text(name), args)
-                changed = True
-            except Exception as e:
-                ansible_module.fail_json(msg="%s: %s: %s" % (command, name,
-                                                             str(e)))
+        changed_names, _exit_args = ipaapi_execute(ansible_module, "host",
+                                                   commands, mirror)
+        exit_args.update(_exit_args)
+        if len(changed_names) > 0:
+            changed = True
+
+        if hosts is not None:
+            exit_args["results"] = [
+                {"name": item["name"],
+                 "changed": to_text(item["name"]).lower() in changed_names}
+                for item in hosts]
 
     except Exception as e:
         ansible_module.fail_json(msg=str(e))
 
     finally:
-        temp_kdestroy(ccache_dir, ccache_name)
+        ipaapi_disconnect(ccache_dir, ccache_name)
+        if mirror is not None:
+            mirror.close()
 
     # Done
 
+    exit_args.update(ipaapi_stats())
     ansible_module.exit_json(changed=changed, **exit_args)
 
 
@@ -0,0 +1,415 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Thomas Woerner <twoerner@redhat.com>
+#
+# Copyright (C) 2019 Red Hat
+# see file 'COPYING' for use and warranty information
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+ANSIBLE_METADATA = {
+    "metadata_version": "1.0",
+    "supported_by": "community",
+    "status": ["preview"],
+}
+
+DOCUMENTATION = """
+---
+module: ipamembership
+short description: Query the effective membership of nested FreeIPA groups
+description:
+  Read all groups and their direct members in one paged search and compute
+  the effective (transitive) membership. Cycles of nested groups are
+  collapsed to strongly connected components, the closures are computed
+  once per component with integer bitsets. The group graph can be cached
+  in a file, the cache is used as long as it has been written for the
+  same server and the lastusn of the server has not changed.
+options:
+  ipaadmin_principal:
+    description: The admin principal
+    default: admin
+  ipaadmin_password:
+    description: The admin password
+    required: false
+  group:
+    description:
+      List of groups to return the effective user members and nested
+      groups for
+    required: false
+    type: list
+  user:
+    description: List of users to return the effective groups for
+    required: false
+    type: list
+  cache:
+    description:
+      Path of the cache file for the group graph, it is not written in
+      check mode
+    required: false
+author:
+    - Thomas Woerner
+"""
+
+EXAMPLES = """
+# Which users end up in group admins, which groups does pinky inherit
+- ipamembership:
+    ipaadmin_password: MyPassword123
+    group:
+    - admins
+    user:
+    - pinky
+    cache: /var/tmp/ipa-membership.json
+  register: result
+"""
+
+RETURN = """
+groups:
+  description:
+    Per requested group the effective user members and the nested groups
+  returned: if group is set
+  type: dict
+users:
+  description: Per requested user the effective groups
+  returned: if user is set
+  type: dict
+summary:
+  description:
+    Number of groups, users, nested group edges, strongly connected
+    components, the groups that are part of membership cycles and if the
+    cache has been used
+  returned: always
+  type: dict
+"""
+
+import os
+import json
+import binascii
+import tempfile
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_text
+from ansible.module_utils.ansible_freeipa_module import temp_kinit, \
+    temp_kdestroy, valid_creds, api_connect, api_paged_search, api, DN
+
+
+def get_lastusn():
+    """
+    Return the lastusn of the root DSE, None if the USN plugin is not
+    enabled
+    """
+    entry = api.Backend.ldap2.get_entry(DN(""), ["lastusn"])
+    usns = {}
+    for key in entry.keys():
+        if to_text(key).lower().startswith("lastusn"):
+            usns[to_text(key).lower()] = [to_text(x) for x in entry[key]]
+    return usns or None
+
+
+def get_server():
+    """
+    Return the LDAP server of the API connection, the host name for the
+    local ldapi socket
+    """
+    ldap_uri = to_text(api.env.ldap_uri)
+    if ldap_uri.startswith("ldapi://"):
+        return to_text(api.env.host)
+    return ldap_uri
+
+
+class GroupGraph(object):
+    """
+    Groups and users as integer ids with direct member adjacency lists
+    """
+
+    def __init__(self):
+        self.groups = []
+        self.users = []
+        self.group_ids = {}
+        self.user_ids = {}
+        self.children = []
+        self.members = []
+
+    def group_id(self, name):
+        key = name.lower()
+        if key not in self.group_ids:
+            self.group_ids[key] = len(self.groups)
+            self.groups.append(name)
+            self.children.append([])
+            self.members.append([])
+        return self.group_ids[key]
+
+    def user_id(self, name):
+        key = name.lower()
+        if key not in self.user_ids:
+            self.user_ids[key] = len(self.users)
+            self.users.append(name)
+        return self.user_ids[key]
+
+    def load(self):
+        users_dn = DN(api.env.container_user, api.env.basedn)
+        groups_dn = DN(api.env.container_group, api.env.basedn)
+        for entry in api_paged_search(
+                groups_dn, "(objectclass=ipausergroup)", ["cn", "member"]):
+            group = self.group_id(to_text(entry.single_value["cn"]))
+            for member in entry.get("member", []):
+                if member[1:] == users_dn:
+                    self.members[group].append(
+                        self.user_id(to_text(member[0].value)))
+                elif member[1:] == groups_dn:
+                    self.children[group].append(
+                        self.group_id(to_text(member[0].value)))
+
+    def to_dict(self):
+        return {"groups": self.groups, "users": self.users,
+                "children": self.children, "members": self.members}
+
+    @classmethod
+    def from_dict(cls, data):
+        graph = cls()
+        graph.groups = data["groups"]
+        graph.users = data["users"]
+        graph.children = data["children"]
+        graph.members = data["members"]
+        graph.group_ids = dict((name.lower(), i)
+                               for i, name in enumerate(graph.groups))
+        graph.user_ids = dict((name.lower(), i)
+                              for i, name in enumerate(graph.users))
+        return graph
+
+
+def strongly_connected_components(adjacency):
+    """
+    Return the strongly connected components of the graph in reverse
+    topological order (iterative Tarjan), every component is emitted after
+    all components that are reachable from it.
+    """
+    index = [None] * len(adjacency)
+    low = [0] * len(adjacency)
+    on_stack = [False] * len(adjacency)
+    stack = []
+    components = []
+    counter = 0
+    for root in range(len(adjacency)):
+        if index[root] is not None:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [(root, 0)]
+        while work:
+            v, i = work[-1]
+            if i < len(adjacency[v]):
+                work[-1] = (v, i + 1)
+                w = adjacency[v][i]
+                if index[w] is None:
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack[w] = True
+                    work.append((w, 0))
+                elif on_stack[w]:
+                    low[v] = min(low[v], index[w])
+                continue
+            work.pop()
+            if work:
+                u = work[-1][0]
+                low[u] = min(low[u], low[v])
+            if low[v] == index[v]:
+                component = []
+                while True:
+                    w = stack.pop()
+                    on_stack[w] = False
+                    component.append(w)
+                    if w == v:
+                        break
+                components.append(component)
+    return components
+
+
+def bitset(ids):
+    """
+    Return an integer with the bits of ids set
+    """
+    if not ids:
+        return 0
+    size = max(ids) // 8 + 1
+    data = bytearray(size)
+    for i in ids:
+        data[size - 1 - i // 8] |= 1 << (i % 8)
+    return int(binascii.hexlify(data), 16)
+
+
+def bits(value):
+    """
+    Return the ids of the bits set in value
+    """
+    return [i for i, c in enumerate(reversed(bin(value)[2:])) if c == "1"]
+
+
+def closure(graph):
+    """
+    Return per group the bitsets of the nested groups and of the effective
+    users and the list of the components
+    """
+    components = strongly_connected_components(graph.children)
+    component_of = [0] * len(graph.groups)
+    for c, component in enumerate(components):
+        for v in component:
+            component_of[v] = c
+
+    group_bits = [0] * len(components)
+    user_bits = [0] * len(components)
+    for c, component in enumerate(components):
+        # All components reachable from c have already been computed
+        groups = bitset(component) if len(component) > 1 else 0
+        users = bitset([u for v in component for u in graph.members[v]])
+        for v in component:
+            groups |= bitset(graph.children[v])
+            for w in graph.children[v]:
+                if component_of[w] != c:
+                    groups |= group_bits[component_of[w]]
+                    users |= user_bits[component_of[w]]
+        group_bits[c] = groups
+        user_bits[c] = users
+
+    return ([group_bits[component_of[v]] for v in range(len(graph.groups))],
+            [user_bits[component_of[v]] for v in range(len(graph.groups))],
+            components)
+
+
+def load_cache(path, server, lastusn):
+    if path is None or lastusn is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except ValueError:
+        return None
+    # The lastusn values of different servers are not comparable
+    if data.get("server") != server or data.get("lastusn") != lastusn:
+        return None
+    return GroupGraph.from_dict(data["graph"])
+
+
+def write_cache(path, server, lastusn, graph):
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix=".ipamembership-")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"server": server, "lastusn": lastusn,
+                   "graph": graph.to_dict()}, f)
+    os.rename(temp_path, path)
+
+
+def main():
+    ansible_module = AnsibleModule(
+        argument_spec=dict(
+            # general
+            ipaadmin_principal=dict(type="str", default="admin"),
+            ipaadmin_password=dict(type="str", required=False, no_log=True),
+
+            group=dict(type="list", default=None),
+            user=dict(type="list", default=None),
+            cache=dict(type="path", default=None),
+        ),
+        supports_check_mode=True,
+    )
+
+    ansible_module._ansible_debug = True
+
+    # Get parameters
+
+    ipaadmin_principal = ansible_module.params.get("ipaadmin_principal")
+    ipaadmin_password = ansible_module.params.get("ipaadmin_password")
+    groups = ansible_module.params.get("group")
+    users = ansible_module.params.get("user")
+    cache = ansible_module.params.get("cache")
+
+    # Init
+
+    exit_args = {}
+    ccache_dir = None
+    ccache_name = None
+    try:
+        if not valid_creds(ansible_module, ipaadmin_principal):
+            ccache_dir, ccache_name = temp_kinit(ipaadmin_principal,
+                                                 ipaadmin_password)
+        api_connect()
+
+        server = get_server()
+        lastusn = get_lastusn()
+        graph = load_cache(cache, server, lastusn)
+        cached = graph is not None
+        if graph is None:
+            graph = GroupGraph()
+            graph.load()
+            if cache is not None and lastusn is not None and \
+               not ansible_module.check_mode:
+                write_cache(cache, server, lastusn, graph)
+
+    except Exception as e:
+        ansible_module.fail_json(msg=str(e))
+
+    finally:
+        temp_kdestroy(ccache_dir, ccache_name)
+
+    # Compute closures
+
+    group_bits, user_bits, components = closure(graph)
+
+    if groups is not None:
+        exit_args["groups"] = {}
+        for name in groups:
+            group = graph.group_ids.get(to_text(name).lower())
+            if group is None:
+                ansible_module.fail_json(msg="No group '%s'" % name)
+            exit_args["groups"][name] = {
+                "users": sorted(graph.users[x]
+                                for x in bits(user_bits[group])),
+                "groups": sorted(graph.groups[x]
+                                 for x in bits(group_bits[group])),
+            }
+
+    if users is not None:
+        exit_args["users"] = {}
+        for name in users:
+            user = graph.user_ids.get(to_text(name).lower())
+            if user is None:
+                exit_args["users"][name] = {"groups": []}
+                continue
+            mask = 1 << user
+            exit_args["users"][name] = {
+                "groups": sorted(graph.groups[g]
+                                 for g in range(len(graph.groups))
+                                 if user_bits[g] & mask),
+            }
+
+    exit_args["summary"] = {
+        "groups": len(graph.groups),
+        "users": len(graph.users),
+        "nested": sum(len(x) for x in graph.children),
+        "components": len(components),
+        "cycles": sorted(graph.groups[v] for component in components
+                         if len(component) > 1 for v in component),
+        "cached": cached,
+    }
+
+    # Done
+
+    ansible_module.exit_json(changed=False, **exit_args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Thomas Woerner <twoerner@redhat.com>
+#
+# Copyright (C) 2019 Red Hat
+# see file 'COPYING' for use and warranty information
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+ANSIBLE_METADATA = {
+    "metadata_version": "1.0",
+    "supported_by": "community",
+    "status": ["preview"],
+}
+
+DOCUMENTATION = """
+---
+module: ipamirror
+short description: Manage a local FreeIPA directory mirror
+description:
+  Manage a local SQLite mirror of users, groups, hosts and topology segments.
+  The mirror is used by ipauser, ipagroup, ipahost and ipatopologysegment for
+  lookups if their mirror option is set. A refresh only fetches entries
+  with a changed entryusn, run it periodically to keep the mirror current.
+options:
+  ipaadmin_principal:
+    description: The admin principal
+    default: admin
+  ipaadmin_password:
+    description: The admin password
+    required: false
+  path:
+    description: Path of the mirror database
+    required: true
+  kind:
+    description: The kinds of entries to mirror
+    required: false
+    type: list
+    default: ["user", "user_preserved", "group", "host", "topologysegment"]
+    choices: ["user", "user_preserved", "group", "host", "topologysegment"]
+  state:
+    description: State to ensure
+    default: refreshed
+    choices: ["refreshed", "absent"]
+author:
+    - Thomas Woerner
+"""
+
+EXAMPLES = """
+# Refresh the mirror
+- ipamirror:
+    ipaadmin_password: MyPassword123
+    path: /var/lib/ipa/ansible-mirror.db
+
+# Use the mirror for lookups
+- ipauser:
+    ipaadmin_password: MyPassword123
+    name: pinky
+    first: pinky
+    last: Acme
+    mirror: /var/lib/ipa/ansible-mirror.db
+    mirror_max_age: 900
+
+# Remove the mirror
+- ipamirror:
+    path: /var/lib/ipa/ansible-mirror.db
+    state: absent
+"""
+
+RETURN = """
+updated:
+  description: Number of updated entries per kind
+  returned: if state is refreshed
+  type: dict
+deleted:
+  description: Number of deleted entries per kind
+  returned: if state is refreshed
+  type: dict
+"""
+
+import os
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.ansible_freeipa_module import temp_kinit, \
+    temp_kdestroy, valid_creds, api_connect, IPAMirror, MIRROR_KINDS
+
+
+def main():
+    ansible_module = AnsibleModule(
+        argument_spec=dict(
+            # general
+            ipaadmin_principal=dict(type="str", default="admin"),
+            ipaadmin_password=dict(type="str", required=False, no_log=True),
+
+            path=dict(type="path", required=True),
+            kind=dict(type="list", default=list(sorted(MIRROR_KINDS)),
+                      required=False),
+            # state
+            state=dict(type="str", default="refreshed",
+                       choices=["refreshed", "absent"]),
+        ),
+        supports_check_mode=True,
+    )
+
+    ansible_module._ansible_debug = True
+
+    # Get parameters
+
+    ipaadmin_principal = ansible_module.params.get("ipaadmin_principal")
+    ipaadmin_password = ansible_module.params.get("ipaadmin_password")
+    path = ansible_module.params.get("path")
+    kinds = ansible_module.params.get("kind")
+    state = ansible_module.params.get("state")
+
+    # Check parameters
+
+    for kind in kinds:
+        if kind not in MIRROR_KINDS:
+            ansible_module.fail_json(msg="Unknown kind '%s'" % kind)
+
+    if state == "absent":
+        changed = os.path.exists(path)
+        if changed and not ansible_module.check_mode:
+            os.remove(path)
+        ansible_module.exit_json(changed=changed)
+
+    if ansible_module.check_mode:
+        ansible_module.exit_json(changed=False)
+
+    # Init
+
+    changed = False
+    exit_args = {"updated": {}, "deleted": {}}
+    ccache_dir = None
+    ccache_name = None
+    mirror = None
+    try:
+        if not valid_creds(ansible_module, ipaadmin_principal):
+            ccache_dir, ccache_name = temp_kinit(ipaadmin_principal,
+                                                 ipaadmin_password)
+        api_connect()
+
+        mirror = IPAMirror(path)
+        for kind in kinds:
+            updated, deleted = mirror.refresh(ansible_module, kind)
+            exit_args["updated"][kind] = updated
+            exit_args["deleted"][kind] = deleted
+            if updated > 0 or deleted > 0:
+                changed = True
+
+    except Exception as e:
+        ansible_module.fail_json(msg=str(e))
+
+    finally:
+        temp_kdestroy(ccache_dir, ccache_name)
+        if mirror is not None:
+            mirror.close()
+
+    # Done
+
+    ansible_module.exit_json(changed=changed, **exit_args)
+
+
+if __name__ == "__main__":
+    main()
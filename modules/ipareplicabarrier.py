@@ -0,0 +1,359 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Thomas Woerner <twoerner@redhat.com>
+#
+# Copyright (C) 2019 Red Hat
+# see file 'COPYING' for use and warranty information
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+ANSIBLE_METADATA = {
+    "metadata_version": "1.0",
+    "supported_by": "community",
+    "status": ["preview"],
+}
+
+DOCUMENTATION = """
+---
+module: ipareplicabarrier
+short description: Wait until changes have been replicated to all replicas
+description:
+  Wait until all replicas have received the changes made on a reference
+  server. The replicas are polled concurrently with exponential backoff
+  until they have converged or the timeout expires.
+
+  With entries, user, group or host the entries are read from the
+  reference server and the replicas have converged if they have the same
+  nsUniqueId and modifyTimestamp, or also have no entry. Otherwise the
+  replica update vectors (nsds50ruv) are compared. The reference is the
+  given csn, or the newest CSN of the reference server in its own RUV,
+  that is everything written on the reference server up to now. Reading
+  the RUV needs dm_password.
+options:
+  ipaadmin_principal:
+    description: The admin principal
+    default: admin
+  ipaadmin_password:
+    description: The admin password
+    required: false
+  dm_password:
+    description: Directory Manager password, needed to read the RUVs
+    required: false
+  server:
+    description:
+      The reference server the changes have been made on (default the
+      server of the IPA API)
+    required: false
+  servers:
+    description: The replicas to wait for (default all masters)
+    required: false
+    type: list
+  suffix:
+    description: Topology suffix of the RUVs
+    default: domain
+    choices: ["domain", "ca"]
+  csn:
+    description: The reference CSN the replicas need to have
+    required: false
+  entries:
+    description: List of entry DNs to wait for
+    required: false
+    type: list
+  user:
+    description: List of user names to wait for
+    required: false
+    type: list
+  group:
+    description: List of group names to wait for
+    required: false
+    type: list
+  host:
+    description: List of host names to wait for
+    required: false
+    type: list
+  interval:
+    description: Initial seconds between the polls of a replica
+    default: 0.5
+  max_interval:
+    description: Maximum seconds between the polls of a replica
+    default: 10
+  concurrency:
+    description: Maximum number of replicas polled at the same time
+    default: 10
+  timeout:
+    description: Timeout in seconds
+    default: 300
+author:
+    - Thomas Woerner
+"""
+
+EXAMPLES = """
+# Wait until pinky and sysops have been replicated everywhere
+- ipareplicabarrier:
+    ipaadmin_password: MyPassword123
+    server: ipaserver.test.local
+    user:
+    - pinky
+    group:
+    - sysops
+
+# Wait until everything written on ipaserver has been replicated
+- ipareplicabarrier:
+    ipaadmin_password: MyPassword123
+    dm_password: SomeDMpassword
+    server: ipaserver.test.local
+    timeout: 600
+"""
+
+RETURN = """
+converged:
+  description: True if all replicas have converged
+  returned: always
+  type: bool
+csn:
+  description: The reference CSN
+  returned: if no entries are given
+  type: str
+replicas:
+  description:
+    Per replica if it has converged, the seconds until convergence, the
+    lag in seconds behind the reference CSN or the entries not converged
+    yet, the number of polls and the error if any
+  returned: always
+  type: dict
+"""
+
+import os
+import re
+import time
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_text
+from ansible.module_utils.ansible_freeipa_module import temp_kinit, \
+    temp_kdestroy, valid_creds, api_connect, get_masters, \
+    ldap_server_connect, run_concurrently, replica_root, replica_entry, \
+    parse_ruv, csn_rid, csn_time, entry_dn, errors, api, DN
+
+RUV_TOMBSTONE = "ffffffff-ffffffff-ffffffff-ffffffff"
+
+
+def read_ruv(conn, suffix):
+    """
+    Return the max CSN per replica ID of the RUV of suffix
+    """
+    entries = conn.get_entries(
+        replica_root(suffix), conn.SCOPE_SUBTREE,
+        "(&(nsuniqueid=%s)(objectclass=nstombstone))" % RUV_TOMBSTONE,
+        ["nsds50ruv"])
+    return parse_ruv(entries[0].get("nsds50ruv", []))
+
+
+def read_entries(conn, dns):
+    """
+    Return per DN the nsUniqueId and modifyTimestamp, None if there is no
+    entry
+    """
+    result = {}
+    for dn in dns:
+        try:
+            entry = conn.get_entry(DN(dn), ["nsuniqueid", "modifytimestamp"])
+        except errors.NotFound:
+            result[dn] = None
+        else:
+            result[dn] = [to_text(entry.single_value.get(attr))
+                          for attr in ["nsuniqueid", "modifytimestamp"]]
+    return result
+
+
+def reference_csn(conn, suffix):
+    """
+    Return the newest CSN of the server of conn in its own RUV
+    """
+    rid = int(to_text(replica_entry(conn, suffix, ["nsds5replicaid"])
+                      .single_value["nsds5replicaid"]))
+    return read_ruv(conn, suffix).get(rid)
+
+
+def wait_replica(host, dm_password, suffix, csn, reference, interval,
+                 max_interval, deadline):
+    """
+    Poll host with exponential backoff until it has converged or the
+    deadline has been reached
+    """
+    start = time.time()
+    result = {"converged": False, "polls": 0}
+    conn = ldap_server_connect(host, dm_password)
+    try:
+        while True:
+            result["polls"] += 1
+            if csn is not None:
+                have = read_ruv(conn, suffix).get(csn_rid(csn))
+                if have is not None and have >= csn:
+                    result["converged"] = True
+                    result["lag"] = 0
+                else:
+                    result["lag"] = csn_time(csn) - \
+                        (csn_time(have) if have is not None else 0)
+            else:
+                entries = read_entries(conn, list(reference))
+                pending = sorted(dn for dn in reference
+                                 if entries[dn] != reference[dn])
+                result["converged"] = not pending
+                result["pending"] = pending
+            result["elapsed"] = round(time.time() - start, 3)
+            if result["converged"] or time.time() + interval > deadline:
+                return result
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+    finally:
+        conn.close()
+
+
+def main():
+    ansible_module = AnsibleModule(
+        argument_spec=dict(
+            ipaadmin_principal=dict(type="str", default="admin"),
+            ipaadmin_password=dict(type="str", required=False, no_log=True),
+            dm_password=dict(type="str", required=False, no_log=True),
+            server=dict(type="str", default=None),
+            servers=dict(type="list", default=None),
+            suffix=dict(choices=["domain", "ca"], default="domain"),
+            csn=dict(type="str", default=None),
+            entries=dict(type="list", default=None),
+            user=dict(type="list", default=None),
+            group=dict(type="list", default=None),
+            host=dict(type="list", default=None),
+            interval=dict(type="float", default=0.5),
+            max_interval=dict(type="float", default=10),
+            concurrency=dict(type="int", default=10),
+            timeout=dict(type="int", default=300),
+        ),
+        supports_check_mode=True,
+    )
+
+    ansible_module._ansible_debug = True
+
+    # Get parameters
+
+    ipaadmin_principal = ansible_module.params.get("ipaadmin_principal")
+    ipaadmin_password = ansible_module.params.get("ipaadmin_password")
+    dm_password = ansible_module.params.get("dm_password")
+    server = ansible_module.params.get("server")
+    servers = ansible_module.params.get("servers")
+    suffix = ansible_module.params.get("suffix")
+    csn = ansible_module.params.get("csn")
+    entries = ansible_module.params.get("entries")
+    users = ansible_module.params.get("user")
+    groups = ansible_module.params.get("group")
+    hosts = ansible_module.params.get("host")
+    interval = ansible_module.params.get("interval")
+    max_interval = ansible_module.params.get("max_interval")
+    concurrency = ansible_module.params.get("concurrency")
+    timeout = ansible_module.params.get("timeout")
+
+    # Check parameters
+
+    use_entries = any([entries, users, groups, hosts])
+    if csn is not None:
+        if use_entries:
+            ansible_module.fail_json(
+                msg="csn can not be used with entries, user, group or host")
+        if not re.match(r"^[0-9a-fA-F]{20}$", csn):
+            ansible_module.fail_json(msg="Invalid CSN '%s'" % csn)
+        csn = csn.lower()
+    if not use_entries and dm_password is None:
+        ansible_module.fail_json(
+            msg="dm_password is needed to read the RUVs")
+
+    # Init
+
+    exit_args = {}
+    ccache_dir = None
+    ccache_name = None
+    try:
+        if not valid_creds(ansible_module, ipaadmin_principal):
+            ccache_dir, ccache_name = temp_kinit(ipaadmin_principal,
+                                                 ipaadmin_password)
+            # The LDAP connections to the servers use the ccache
+            os.environ["KRB5CCNAME"] = ccache_name
+        api_connect()
+
+        if server is None:
+            server = api.env.server
+        if servers is None:
+            servers = get_masters(ansible_module)
+        start = time.time()
+
+        # Reference state
+
+        reference = None
+        conn = ldap_server_connect(server, dm_password)
+        try:
+            if use_entries:
+                dns = [to_text(DN(dn)) for dn in entries or []]
+                for kind, names in [("user", users), ("group", groups),
+                                    ("host", hosts)]:
+                    dns.extend(to_text(entry_dn(kind, name))
+                               for name in names or [])
+                reference = read_entries(conn, dns)
+            elif csn is None:
+                csn = reference_csn(conn, suffix)
+                if csn is None:
+                    ansible_module.fail_json(
+                        msg="No RUV element for '%s'" % server)
+        finally:
+            conn.close()
+        if csn is not None:
+            exit_args["csn"] = csn
+
+        # Poll the replicas concurrently
+
+        deadline = start + timeout
+        results = run_concurrently(
+            lambda host: wait_replica(host, dm_password, suffix, csn,
+                                      reference, interval, max_interval,
+                                      deadline),
+            servers, concurrency, timeout + max_interval + 10)
+
+        exit_args["replicas"] = {}
+        for host in servers:
+            result, error, _elapsed = results[host]
+            if error is not None:
+                result = {"converged": False, "error": error}
+            exit_args["replicas"][host] = result
+        exit_args["converged"] = all(
+            x["converged"] for x in exit_args["replicas"].values())
+
+    except Exception as e:
+        ansible_module.fail_json(msg=str(e))
+
+    finally:
+        temp_kdestroy(ccache_dir, ccache_name)
+
+    # Done
+
+    if not exit_args["converged"]:
+        ansible_module.fail_json(
+            msg="Replicas not converged after %ss: %s" %
+            (timeout, ", ".join(sorted(
+                host for host, x in exit_args["replicas"].items()
+                if not x["converged"]))),
+            **exit_args)
+
+    ansible_module.exit_json(changed=False, **exit_args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Thomas Woerner <twoerner@redhat.com>
+#
+# Copyright (C) 2019 Red Hat
+# see file 'COPYING' for use and warranty information
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+ANSIBLE_METADATA = {
+    "metadata_version": "1.0",
+    "supported_by": "community",
+    "status": ["preview"],
+}
+
+DOCUMENTATION = """
+---
+module: ipareplicacheck
+short description: Check entries for consistency on all FreeIPA replicas
+description:
+  Read entries from all masters concurrently and report the entries that
+  differ. nsUniqueId, modifyTimestamp and the given attributes are
+  compared. With dm_password also the per attribute CSNs are compared.
+  entryUSN is local to every server, it is returned but not compared.
+options:
+  ipaadmin_principal:
+    description: The admin principal
+    default: admin
+  ipaadmin_password:
+    description: The admin password
+    required: false
+  dm_password:
+    description:
+      Directory Manager password. If set, the servers are accessed as
+      Directory Manager and the attribute CSNs are compared.
+    required: false
+  servers:
+    description: The servers to check (default all masters)
+    required: false
+    type: list
+  entries:
+    description: List of entry DNs to check
+    required: false
+    type: list
+  user:
+    description: List of user names to check
+    required: false
+    type: list
+  group:
+    description: List of group names to check
+    required: false
+    type: list
+  host:
+    description: List of host names to check
+    required: false
+    type: list
+  attributes:
+    description: Additional attributes to compare
+    required: false
+    type: list
+    default: []
+  concurrency:
+    description: Maximum number of servers queried at the same time
+    default: 10
+  timeout:
+    description: Timeout in seconds per server
+    default: 30
+author:
+    - Thomas Woerner
+"""
+
+EXAMPLES = """
+# Check that pinky and the group sysops are the same on all replicas
+- ipareplicacheck:
+    ipaadmin_password: MyPassword123
+    user:
+    - pinky
+    group:
+    - sysops
+    attributes:
+    - memberof
+  register: result
+  failed_when: result.divergent | length > 0
+"""
+
+RETURN = """
+divergent:
+  description: List of DNs that differ between the servers
+  returned: always
+  type: list
+entries:
+  description:
+    Per DN the consistent flag and per server the compared values, the
+    entryusn or the error
+  returned: always
+  type: dict
+servers:
+  description: Per server the elapsed time and the error if any
+  returned: always
+  type: dict
+"""
+
+import os
+import re
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_text
+from ansible.module_utils.ansible_freeipa_module import temp_kinit, \
+    temp_kdestroy, valid_creds, api_connect, get_masters, \
+    ldap_server_connect, run_concurrently, entry_dn, errors, DN
+
+# Attribute state lines in nscpentrywsi, for example
+# "sn;adcsn-5d1b4f5c000000040000: Acme"
+CSN_RE = re.compile(r"^([^;:]+)(?:;[^:]*?)?;[a-z]*csn-([0-9a-f]{20})",
+                    re.IGNORECASE)
+
+
+def parse_csns(wsi_lines):
+    csns = {}
+    for line in wsi_lines:
+        for match in CSN_RE.finditer(to_text(line)):
+            attr = match.group(1).lower()
+            csn = match.group(2).lower()
+            if csn > csns.get(attr, ""):
+                csns[attr] = csn
+    return csns
+
+
+def read_entries(host, dns, attributes, dm_password, timeout):
+    attrs = ["nsuniqueid", "entryusn", "modifytimestamp"] + attributes
+    if dm_password is not None:
+        attrs.append("nscpentrywsi")
+
+    conn = ldap_server_connect(host, dm_password, timeout)
+    try:
+        result = {}
+        for dn in dns:
+            try:
+                entry = conn.get_entry(DN(dn), attrs)
+            except errors.NotFound:
+                result[dn] = None
+                continue
+            values = {}
+            for attr in attrs:
+                if attr in ["entryusn", "nscpentrywsi"]:
+                    continue
+                values[attr] = sorted(to_text(x)
+                                      for x in entry.get(attr, []))
+            if dm_password is not None:
+                values["csns"] = parse_csns(entry.get("nscpentrywsi", []))
+            result[dn] = {
+                "values": values,
+                "entryusn": to_text(entry.single_value.get("entryusn")),
+            }
+        return result
+    finally:
+        conn.close()
+
+
+def main():
+    ansible_module = AnsibleModule(
+        argument_spec=dict(
+            ipaadmin_principal=dict(type="str", default="admin"),
+            ipaadmin_password=dict(type="str", required=False, no_log=True),
+            dm_password=dict(type="str", required=False, no_log=True),
+            servers=dict(type="list", default=None),
+            entries=dict(type="list", default=None),
+            user=dict(type="list", default=None),
+            group=dict(type="list", default=None),
+            host=dict(type="list", default=None),
+            attributes=dict(type="list", default=[]),
+            concurrency=dict(type="int", default=10),
+            timeout=dict(type="int", default=30),
+        ),
+        supports_check_mode=True,
+    )
+
+    ansible_module._ansible_debug = True
+
+    # Get parameters
+
+    ipaadmin_principal = ansible_module.params.get("ipaadmin_principal")
+    ipaadmin_password = ansible_module.params.get("ipaadmin_password")
+    dm_password = ansible_module.params.get("dm_password")
+    servers = ansible_module.params.get("servers")
+    entries = ansible_module.params.get("entries")
+    users = ansible_module.params.get("user")
+    groups = ansible_module.params.get("group")
+    hosts = ansible_module.params.get("host")
+    attributes = [x.lower() for x in ansible_module.params.get("attributes")]
+    concurrency = ansible_module.params.get("concurrency")
+    timeout = ansible_module.params.get("timeout")
+
+    # Check parameters
+
+    if not any([entries, users, groups, hosts]):
+        ansible_module.fail_json(
+            msg="One of entries, user, group or host needs to be set.")
+
+    # Init
+
+    exit_args = {}
+    ccache_dir = None
+    ccache_name = None
+    try:
+        if not valid_creds(ansible_module, ipaadmin_principal):
+            ccache_dir, ccache_name = temp_kinit(ipaadmin_principal,
+                                                 ipaadmin_password)
+            # The LDAP connections to the servers use the ccache
+            os.environ["KRB5CCNAME"] = ccache_name
+        api_connect()
+
+        if servers is None:
+            servers = get_masters(ansible_module)
+
+        dns = [to_text(DN(dn)) for dn in entries or []]
+        for kind, names in [("user", users), ("group", groups),
+                            ("host", hosts)]:
+            dns.extend(to_text(entry_dn(kind, name)) for name in names or [])
+
+        # Query all servers concurrently
+
+        results = run_concurrently(
+            lambda host: read_entries(host, dns, attributes, dm_password,
+                                      timeout),
+            servers, concurrency, timeout)
+
+        # Compare
+
+        exit_args["servers"] = dict(
+            (host, {"elapsed": round(elapsed, 3), "error": error})
+            for host, (_result, error, elapsed) in results.items())
+        exit_args["entries"] = {}
+        exit_args["divergent"] = []
+        for dn in dns:
+            per_server = {}
+            signatures = set()
+            for host in servers:
+                result, error, _elapsed = results[host]
+                if error is not None:
+                    per_server[host] = {"error": error}
+                    signatures.add(None)
+                elif result[dn] is None:
+                    per_server[host] = {"missing": True}
+                    signatures.add("missing")
+                else:
+                    per_server[host] = result[dn]
+                    signatures.add(repr(sorted(
+                        result[dn]["values"].items())))
+            consistent = len(signatures) == 1 and None not in signatures
+            exit_args["entries"][dn] = {
+                "consistent": consistent,
+                "servers": per_server,
+            }
+            if not consistent:
+                exit_args["divergent"].append(dn)
+
+    except Exception as e:
+        ansible_module.fail_json(msg=str(e))
+
+    finally:
+        temp_kdestroy(ccache_dir, ccache_name)
+
+    # Done
+
+    ansible_module.exit_json(changed=False, **exit_args)
+
+
+if __name__ == "__main__":
+    main()
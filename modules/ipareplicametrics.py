@@ -0,0 +1,393 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Thomas Woerner <twoerner@redhat.com>
+#
+# Copyright (C) 2019 Red Hat
+# see file 'COPYING' for use and warranty information
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+ANSIBLE_METADATA = {
+    "metadata_version": "1.0",
+    "supported_by": "community",
+    "status": ["preview"],
+}
+
+DOCUMENTATION = """
+---
+module: ipareplicametrics
+short description: Export FreeIPA replication agreement metrics
+description:
+  Read the replication agreements of all masters concurrently and export
+  the agreement status, the last update start and end times, the changes
+  sent and skipped since startup and the lag per agreement. The lag is
+  the difference of the newest CSN of the supplier and the newest CSN of
+  the supplier that the consumer is known to have. The metrics are
+  written as Prometheus text format file for the textfile collector of
+  the node exporter and as JSON file.
+options:
+  ipaadmin_principal:
+    description: The admin principal
+    default: admin
+  ipaadmin_password:
+    description: The admin password
+    required: false
+  dm_password:
+    description:
+      Directory Manager password. If set, the servers are accessed as
+      Directory Manager.
+    required: false
+  servers:
+    description: The servers to read (default all masters)
+    required: false
+    type: list
+  suffix:
+    description: Topology suffix
+    default: domain+ca
+    choices: ["domain", "ca", "domain+ca"]
+  prometheus_file:
+    description:
+      Path of the Prometheus text format file, it should end with .prom
+    required: false
+  json_file:
+    description: Path of the JSON file
+    required: false
+  concurrency:
+    description: Maximum number of servers queried at the same time
+    default: 10
+  timeout:
+    description: Timeout in seconds per server
+    default: 30
+author:
+    - Thomas Woerner
+"""
+
+EXAMPLES = """
+- ipareplicametrics:
+    ipaadmin_password: MyPassword123
+    prometheus_file: /var/lib/node_exporter/textfile/ipa_replication.prom
+    json_file: /var/tmp/ipa-replication.json
+"""
+
+RETURN = """
+agreements:
+  description:
+    List of agreements with supplier, consumer, suffix, enabled, status
+    code and message, update in progress, last update start and end
+    timestamps, changes sent and skipped and lag in seconds
+  returned: always
+  type: list
+servers:
+  description: Per server the elapsed time and the error if any
+  returned: always
+  type: dict
+"""
+
+import os
+import json
+import time
+import calendar
+import tempfile
+from datetime import datetime
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_text
+from ansible.module_utils.ansible_freeipa_module import temp_kinit, \
+    temp_kdestroy, valid_creds, api_connect, get_masters, \
+    ldap_server_connect, run_concurrently, get_agreements, replica_entry, \
+    replica_status, parse_ruv, csn_time
+
+AGREEMENT_ATTRS = ["nsds5replicahost", "nsds5replicaenabled",
+                   "nsds5replicalastupdatestart", "nsds5replicalastupdateend",
+                   "nsds5replicalastupdatestatus",
+                   "nsds5replicaupdateinprogress",
+                   "nsds5replicachangessentsincestartup", "nsds50ruv"]
+
+# Metric name, type, help and agreement key
+METRICS = [
+    ("ipa_replication_agreement_up", "gauge",
+     "1 if the last update of the agreement succeeded", "up"),
+    ("ipa_replication_agreement_enabled", "gauge",
+     "1 if the agreement is enabled", "enabled"),
+    ("ipa_replication_update_in_progress", "gauge",
+     "1 if an update is in progress", "update_in_progress"),
+    ("ipa_replication_last_update_status_code", "gauge",
+     "Status code of the last update", "status_code"),
+    ("ipa_replication_last_update_start_timestamp_seconds", "gauge",
+     "Start time of the last update", "last_update_start"),
+    ("ipa_replication_last_update_end_timestamp_seconds", "gauge",
+     "End time of the last update", "last_update_end"),
+    ("ipa_replication_changes_sent_total", "counter",
+     "Changes sent since startup", "changes_sent"),
+    ("ipa_replication_changes_skipped_total", "counter",
+     "Changes skipped since startup", "changes_skipped"),
+    ("ipa_replication_lag_seconds", "gauge",
+     "Seconds the consumer is behind the supplier", "lag"),
+]
+
+
+def generalized_time(value):
+    """
+    Return a generalized time as seconds since the epoch, None if unset
+    """
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple())
+    value = to_text(value or "")
+    if not value or value.startswith("1970") or value == "0":
+        return None
+    return calendar.timegm(time.strptime(value[:14], "%Y%m%d%H%M%S"))
+
+
+def parse_changes(value):
+    """
+    Return the sum of the sent and skipped changes of
+    nsds5replicaChangesSentSinceStartup, for example "4:120/3 3:7/0"
+    """
+    sent = 0
+    skipped = 0
+    for part in to_text(value or "").split():
+        counts = part.split(":", 1)[-1].split("/")
+        sent += int(counts[0])
+        if len(counts) > 1:
+            skipped += int(counts[1])
+    return sent, skipped
+
+
+def read_agreements(host, suffixes, dm_password, timeout):
+    conn = ldap_server_connect(host, dm_password, timeout)
+    try:
+        result = []
+        for suffix in suffixes:
+            replica = replica_entry(conn, suffix,
+                                    ["nsds5replicaid", "nsds50ruv"])
+            rid = int(to_text(replica.single_value["nsds5replicaid"]))
+            newest = parse_ruv(replica.get("nsds50ruv", [])).get(rid)
+            for entry in get_agreements(conn, suffix, AGREEMENT_ATTRS):
+                value = entry.single_value.get
+                code, message = replica_status(
+                    value("nsds5replicalastupdatestatus"))
+                sent, skipped = parse_changes(
+                    value("nsds5replicachangessentsincestartup"))
+                consumer = parse_ruv(entry.get("nsds50ruv", [])).get(rid)
+                enabled = to_text(value("nsds5replicaenabled", "on"))
+                in_progress = to_text(
+                    value("nsds5replicaupdateinprogress", "false"))
+                lag = None
+                if newest is not None and consumer is not None:
+                    lag = max(csn_time(newest) - csn_time(consumer), 0)
+                result.append({
+                    "supplier": host,
+                    "consumer": to_text(value("nsds5replicahost")),
+                    "suffix": suffix,
+                    "enabled": enabled.lower() != "off",
+                    "up": code == 0,
+                    "status_code": code,
+                    "status": message,
+                    "update_in_progress": in_progress.lower() == "true",
+                    "last_update_start": generalized_time(
+                        value("nsds5replicalastupdatestart")),
+                    "last_update_end": generalized_time(
+                        value("nsds5replicalastupdateend")),
+                    "changes_sent": sent,
+                    "changes_skipped": skipped,
+                    "lag": lag,
+                })
+        return result
+    finally:
+        conn.close()
+
+
+def metric_value(value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return str(value)
+
+
+def label_value(value):
+    """
+    Return value escaped for a label of the Prometheus text format
+    """
+    return to_text(value).replace("\\", "\\\\").replace(
+        '"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text(agreements, servers):
+    lines = []
+    for name, _type, _help, key in METRICS:
+        lines.append("# HELP %s %s" % (name, _help))
+        lines.append("# TYPE %s %s" % (name, _type))
+        for agreement in agreements:
+            if agreement[key] is None:
+                continue
+            lines.append('%s{supplier="%s",consumer="%s",suffix="%s"} %s' % (
+                name, label_value(agreement["supplier"]),
+                label_value(agreement["consumer"]),
+                label_value(agreement["suffix"]),
+                metric_value(agreement[key])))
+    for name, _help, key in [
+            ("ipa_replication_scrape_error",
+             "1 if the server could not be read", "error"),
+            ("ipa_replication_scrape_duration_seconds",
+             "Seconds to read the server", "elapsed")]:
+        lines.append("# HELP %s %s" % (name, _help))
+        lines.append("# TYPE %s gauge" % name)
+        for host in sorted(servers):
+            value = servers[host][key]
+            if key == "error":
+                value = value is not None
+            lines.append('%s{server="%s"} %s' % (name, label_value(host),
+                                                 metric_value(value)))
+    return "\n".join(lines) + "\n"
+
+
+def prometheus_stable(text):
+    """
+    Return the Prometheus text without the scrape durations of the run
+    """
+    return [line for line in text.splitlines()
+            if not line.startswith("ipa_replication_scrape_duration_seconds{")]
+
+
+def json_stable(text):
+    """
+    Return the JSON data without the elapsed times of the run
+    """
+    data = json.loads(text)
+    for server in data.get("servers", {}).values():
+        server.pop("elapsed", None)
+    return data
+
+
+def write_file(module, path, content, stable):
+    """
+    Write content atomically to path if it changed, return True if it
+    changed. The content is compared with stable, which leaves out the
+    values that change with every run.
+    """
+    if os.path.exists(path):
+        with open(path) as f:
+            current = f.read()
+        try:
+            if stable(current) == stable(content):
+                return False
+        except ValueError:
+            # Not readable, the file is replaced
+            pass
+    if module.check_mode:
+        return True
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix=".ipametrics-")
+    with os.fdopen(fd, "w") as f:
+        f.write(content)
+    os.chmod(temp_path, 0o644)
+    os.rename(temp_path, path)
+    return True
+
+
+def main():
+    ansible_module = AnsibleModule(
+        argument_spec=dict(
+            ipaadmin_principal=dict(type="str", default="admin"),
+            ipaadmin_password=dict(type="str", required=False, no_log=True),
+            dm_password=dict(type="str", required=False, no_log=True),
+            servers=dict(type="list", default=None),
+            suffix=dict(choices=["domain", "ca", "domain+ca"],
+                        default="domain+ca"),
+            prometheus_file=dict(type="path", default=None),
+            json_file=dict(type="path", default=None),
+            concurrency=dict(type="int", default=10),
+            timeout=dict(type="int", default=30),
+        ),
+        supports_check_mode=True,
+    )
+
+    ansible_module._ansible_debug = True
+
+    # Get parameters
+
+    ipaadmin_principal = ansible_module.params.get("ipaadmin_principal")
+    ipaadmin_password = ansible_module.params.get("ipaadmin_password")
+    dm_password = ansible_module.params.get("dm_password")
+    servers = ansible_module.params.get("servers")
+    suffixes = ansible_module.params.get("suffix").split("+")
+    prometheus_file = ansible_module.params.get("prometheus_file")
+    json_file = ansible_module.params.get("json_file")
+    concurrency = ansible_module.params.get("concurrency")
+    timeout = ansible_module.params.get("timeout")
+
+    # Init
+
+    changed = False
+    exit_args = {}
+    ccache_dir = None
+    ccache_name = None
+    try:
+        if not valid_creds(ansible_module, ipaadmin_principal):
+            ccache_dir, ccache_name = temp_kinit(ipaadmin_principal,
+                                                 ipaadmin_password)
+            # The LDAP connections to the servers use the ccache
+            os.environ["KRB5CCNAME"] = ccache_name
+        api_connect()
+
+        if servers is None:
+            servers = get_masters(ansible_module)
+
+        # Query all servers concurrently
+
+        results = run_concurrently(
+            lambda host: read_agreements(host, suffixes, dm_password,
+                                         timeout),
+            servers, concurrency, timeout)
+
+    except Exception as e:
+        ansible_module.fail_json(msg=str(e))
+
+    finally:
+        temp_kdestroy(ccache_dir, ccache_name)
+
+    agreements = []
+    exit_args["servers"] = {}
+    for host in servers:
+        result, error, elapsed = results[host]
+        exit_args["servers"][host] = {"elapsed": round(elapsed, 3),
+                                      "error": error}
+        agreements.extend(result or [])
+    exit_args["agreements"] = sorted(
+        agreements, key=lambda x: (x["suffix"], x["supplier"],
+                                   x["consumer"]))
+
+    # Write the files
+
+    try:
+        if prometheus_file is not None:
+            changed |= write_file(
+                ansible_module, prometheus_file,
+                prometheus_text(exit_args["agreements"],
+                                exit_args["servers"]), prometheus_stable)
+        if json_file is not None:
+            changed |= write_file(
+                ansible_module, json_file,
+                json.dumps(exit_args, indent=2, sort_keys=True) + "\n",
+                json_stable)
+    except (IOError, OSError) as e:
+        ansible_module.fail_json(msg=str(e))
+
+    # Done
+
+    ansible_module.exit_json(changed=changed, **exit_args)
+
+
+if __name__ == "__main__":
+    main()
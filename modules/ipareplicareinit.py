@@ -0,0 +1,359 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Thomas Woerner <twoerner@redhat.com>
+#
+# Copyright (C) 2019 Red Hat
+# see file 'COPYING' for use and warranty information
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+ANSIBLE_METADATA = {
+    "metadata_version": "1.0",
+    "supported_by": "community",
+    "status": ["preview"],
+}
+
+DOCUMENTATION = """
+---
+module: ipareplicareinit
+short description: Reinitialize FreeIPA replicas and wait for completion
+description:
+  Reinitialize the consumers of a list of topology segments. The
+  reinitializations are started with topologysegment_reinitialize with at
+  most concurrency running at a time and at most supplier_concurrency per
+  supplier. A server that is being reinitialized is not used as a supplier
+  at the same time. The agreements on the suppliers are polled until
+  nsds5BeginReplicaRefresh is gone, the result is taken from
+  nsds5replicaLastInitStatus.
+options:
+  ipaadmin_principal:
+    description: The admin principal
+    default: admin
+  ipaadmin_password:
+    description: The admin password
+    required: false
+  dm_password:
+    description:
+      Directory Manager password. If set, the agreements are read as
+      Directory Manager.
+    required: false
+  suffix:
+    description: Topology suffix
+    default: domain
+    choices: ["domain", "ca", "domain+ca"]
+  segments:
+    description:
+      List of segments to reinitialize. Each segment is a dict with left
+      and right or name and optionally direction. The segments are started
+      in the given order as far as the concurrency limits allow.
+    required: true
+    type: list
+  direction:
+    description: The default direction of the segments
+    default: left-to-right
+    choices: ["left-to-right", "right-to-left"]
+  concurrency:
+    description: Maximum number of reinitializations running at a time
+    default: 4
+  supplier_concurrency:
+    description:
+      Maximum number of reinitializations running at a time per supplier
+    default: 1
+  poll_interval:
+    description: Seconds between the status polls
+    default: 5
+  timeout:
+    description: Timeout in seconds per reinitialization
+    default: 3600
+author:
+    - Thomas Woerner
+"""
+
+EXAMPLES = """
+# Recover two replicas from ipaserver, then a third one from replica1
+- ipareplicareinit:
+    ipaadmin_password: MyPassword123
+    suffix: domain+ca
+    segments:
+    - left: ipaserver.test.local
+      right: ipareplica1.test.local
+    - left: ipaserver.test.local
+      right: ipareplica2.test.local
+    - left: ipareplica1.test.local
+      right: ipareplica3.test.local
+    supplier_concurrency: 2
+"""
+
+RETURN = """
+replicas:
+  description:
+    Per reinitialization the suffix, the segment name, the supplier, the
+    consumer, the status, the init status message and the elapsed time in
+    seconds
+  returned: always
+  type: list
+"""
+
+import os
+import time
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_text
+from ansible.module_utils.ansible_freeipa_module import temp_kinit, \
+    temp_kdestroy, valid_creds, api_connect, api_command, api_find_all, \
+    ldap_server_connect, get_agreements, replica_status
+
+AGREEMENT_ATTRS = ["nsds5beginreplicarefresh", "nsds5replicalastinitstart",
+                   "nsds5replicalastinitend", "nsds5replicalastinitstatus"]
+
+
+class Reinit(object):
+    """
+    Reinitialization of the consumer of a segment from the supplier
+    """
+
+    def __init__(self, suffix, segment, direction):
+        self.suffix = suffix
+        self.name = to_text(segment["cn"][0])
+        left = to_text(segment["iparepltoposegmentleftnode"][0])
+        right = to_text(segment["iparepltoposegmentrightnode"][0])
+        self.direction = direction
+        if direction == "left-to-right":
+            self.supplier, self.consumer = left, right
+        else:
+            self.supplier, self.consumer = right, left
+        self.state = "pending"
+        self.message = None
+        self.last_start = None
+        self.started = None
+        self.elapsed = None
+
+    def result(self):
+        return {
+            "suffix": self.suffix,
+            "name": self.name,
+            "supplier": self.supplier,
+            "consumer": self.consumer,
+            "status": self.state,
+            "message": self.message,
+            "elapsed": self.elapsed,
+        }
+
+
+def find_segment(module, segments, item, suffix):
+    """
+    Return the segment entry for item and the direction of the
+    reinitialization relative to the segment
+    """
+    direction = item.get("direction")
+    if item.get("name"):
+        segment = segments.get(to_text(item["name"]).lower())
+        if segment is not None:
+            return segment, direction
+    elif item.get("left") and item.get("right"):
+        left = to_text(item["left"]).lower()
+        right = to_text(item["right"]).lower()
+        for segment in segments.values():
+            nodes = (
+                to_text(segment["iparepltoposegmentleftnode"][0]).lower(),
+                to_text(segment["iparepltoposegmentrightnode"][0]).lower())
+            if nodes == (left, right):
+                return segment, direction
+            if nodes == (right, left):
+                # Swapped nodes, swap the direction
+                return segment, {
+                    "left-to-right": "right-to-left",
+                    "right-to-left": "left-to-right"}[direction]
+    else:
+        module.fail_json(
+            msg="Each segment needs to be a dict with left and right or "
+            "name")
+    module.fail_json(msg="No segment '%s' for suffix '%s'" %
+                     (item.get("name") or "%s - %s" % (item["left"],
+                                                       item["right"]),
+                      suffix))
+
+
+def read_agreement(conns, reinit, dm_password):
+    if reinit.supplier not in conns:
+        conns[reinit.supplier] = ldap_server_connect(reinit.supplier,
+                                                     dm_password)
+    entries = get_agreements(conns[reinit.supplier], reinit.suffix,
+                             AGREEMENT_ATTRS, reinit.consumer)
+    if len(entries) != 1:
+        raise ValueError("No unique agreement from '%s' to '%s'" %
+                         (reinit.supplier, reinit.consumer))
+    return entries[0]
+
+
+def can_start(reinit, running, concurrency, supplier_concurrency):
+    if len(running) >= concurrency:
+        return False
+    for other in running:
+        # Never supply from a server that is being reinitialized and never
+        # reinitialize a server that is in use
+        if other.consumer in [reinit.supplier, reinit.consumer] or \
+           other.supplier == reinit.consumer:
+            return False
+    return len([other for other in running
+                if other.supplier == reinit.supplier]) < supplier_concurrency
+
+
+def main():
+    ansible_module = AnsibleModule(
+        argument_spec=dict(
+            ipaadmin_principal=dict(type="str", default="admin"),
+            ipaadmin_password=dict(type="str", required=False, no_log=True),
+            dm_password=dict(type="str", required=False, no_log=True),
+            suffix=dict(choices=["domain", "ca", "domain+ca"],
+                        default="domain"),
+            segments=dict(type="list", required=True),
+            direction=dict(type="str", default="left-to-right",
+                           choices=["left-to-right", "right-to-left"]),
+            concurrency=dict(type="int", default=4),
+            supplier_concurrency=dict(type="int", default=1),
+            poll_interval=dict(type="int", default=5),
+            timeout=dict(type="int", default=3600),
+        ),
+        supports_check_mode=True,
+    )
+
+    ansible_module._ansible_debug = True
+
+    # Get parameters
+
+    ipaadmin_principal = ansible_module.params.get("ipaadmin_principal")
+    ipaadmin_password = ansible_module.params.get("ipaadmin_password")
+    dm_password = ansible_module.params.get("dm_password")
+    suffixes = ansible_module.params.get("suffix")
+    segments = ansible_module.params.get("segments")
+    direction = ansible_module.params.get("direction")
+    concurrency = max(ansible_module.params.get("concurrency"), 1)
+    supplier_concurrency = max(
+        ansible_module.params.get("supplier_concurrency"), 1)
+    poll_interval = ansible_module.params.get("poll_interval")
+    timeout = ansible_module.params.get("timeout")
+
+    # Check parameters
+
+    for item in segments:
+        if not isinstance(item, dict):
+            ansible_module.fail_json(msg="Each segment needs to be a dict")
+        item.setdefault("direction", direction)
+        if item["direction"] not in ["left-to-right", "right-to-left"]:
+            ansible_module.fail_json(msg="Unknown direction '%s'" %
+                                     item["direction"])
+
+    # Init
+
+    changed = False
+    reinits = []
+    conns = {}
+    ccache_dir = None
+    ccache_name = None
+    try:
+        if not valid_creds(ansible_module, ipaadmin_principal):
+            ccache_dir, ccache_name = temp_kinit(ipaadmin_principal,
+                                                 ipaadmin_password)
+            # The LDAP connections to the servers use the ccache
+            os.environ["KRB5CCNAME"] = ccache_name
+        api_connect()
+
+        for suffix in suffixes.split("+"):
+            _segments = api_find_all(ansible_module, "topologysegment_find",
+                                     "cn", suffix=to_text(suffix))
+            for item in segments:
+                segment, _direction = find_segment(ansible_module, _segments,
+                                                   item, suffix)
+                reinits.append(Reinit(suffix, segment, _direction))
+
+        if ansible_module.check_mode:
+            ansible_module.exit_json(
+                changed=len(reinits) > 0,
+                replicas=[reinit.result() for reinit in reinits])
+
+        # Start the reinitializations as far as the limits allow and poll
+        # the running ones until all are done
+
+        pending = list(reinits)
+        running = []
+        while pending or running:
+            for reinit in list(pending):
+                if not can_start(reinit, running, concurrency,
+                                 supplier_concurrency):
+                    continue
+                entry = read_agreement(conns, reinit, dm_password)
+                reinit.last_start = entry.get("nsds5replicalastinitstart")
+                args = {"cn": reinit.name}
+                if reinit.direction == "left-to-right":
+                    args["left"] = True
+                else:
+                    args["right"] = True
+                api_command(ansible_module, "topologysegment_reinitialize",
+                            to_text(reinit.suffix), args)
+                changed = True
+                reinit.state = "running"
+                reinit.started = time.time()
+                pending.remove(reinit)
+                running.append(reinit)
+
+            time.sleep(poll_interval)
+
+            for reinit in list(running):
+                elapsed = time.time() - reinit.started
+                entry = read_agreement(conns, reinit, dm_password)
+                code, message = replica_status(
+                    entry.single_value.get("nsds5replicalastinitstatus"))
+                reinit.message = message
+                if entry.get("nsds5beginreplicarefresh") or \
+                   entry.get("nsds5replicalastinitstart") == \
+                   reinit.last_start:
+                    # Not started or still running
+                    if elapsed > timeout:
+                        reinit.state = "timeout"
+                    else:
+                        continue
+                elif code == 0:
+                    reinit.state = "done"
+                else:
+                    reinit.state = "failed"
+                reinit.elapsed = round(elapsed, 3)
+                running.remove(reinit)
+
+    except Exception as e:
+        ansible_module.fail_json(msg=str(e),
+                                 replicas=[x.result() for x in reinits])
+
+    finally:
+        temp_kdestroy(ccache_dir, ccache_name)
+        for conn in conns.values():
+            conn.close()
+
+    # Done
+
+    replicas = [reinit.result() for reinit in reinits]
+    failed = [x for x in replicas if x["status"] != "done"]
+    if failed:
+        ansible_module.fail_json(
+            msg="Reinitialization failed for %s" %
+            ", ".join("%s (%s)" % (x["consumer"], x["suffix"])
+                      for x in failed),
+            changed=changed, replicas=replicas)
+
+    ansible_module.exit_json(changed=changed, replicas=replicas)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Thomas Woerner <twoerner@redhat.com>
+#
+# Copyright (C) 2019 Red Hat
+# see file 'COPYING' for use and warranty information
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+ANSIBLE_METADATA = {
+    "metadata_version": "1.0",
+    "supported_by": "community",
+    "status": ["preview"],
+}
+
+DOCUMENTATION = """
+---
+module: ipareplicatuning
+short description: Tune FreeIPA replication and changelog settings
+description:
+  Manage the replication performance settings of all masters in one run.
+  The agreement settings are applied to all agreements of the suffix on
+  every server, the purge delay to the replica and the trimming settings
+  to the changelog of the suffix. Settings that are not given are not
+  changed. Only differing values are modified, the effective values are
+  returned per server.
+options:
+  ipaadmin_principal:
+    description: The admin principal
+    default: admin
+  ipaadmin_password:
+    description: The admin password
+    required: false
+  dm_password:
+    description: Directory Manager password
+    required: true
+  servers:
+    description: The servers to tune (default all masters)
+    required: false
+    type: list
+  suffix:
+    description: Topology suffix
+    default: domain+ca
+    choices: ["domain", "ca", "domain+ca"]
+  changelog_max_age:
+    description:
+      Maximum age of the changelog entries, for example 7d or 12h
+      (nsslapd-changelogmaxage)
+    required: false
+  changelog_max_entries:
+    description:
+      Maximum number of changelog entries (nsslapd-changelogmaxentries)
+    required: false
+  busy_wait_time:
+    description:
+      Seconds a supplier waits after a busy consumer before the next
+      attempt (nsds5ReplicaBusyWaitTime)
+    required: false
+  session_pause_time:
+    description:
+      Seconds a supplier waits between update sessions
+      (nsds5ReplicaSessionPauseTime)
+    required: false
+  flow_control_window:
+    description:
+      Number of entries or updates sent without acknowledgement before
+      the supplier pauses (nsds5ReplicaFlowControlWindow)
+    required: false
+  flow_control_pause:
+    description:
+      Milliseconds the supplier pauses if the window is full
+      (nsds5ReplicaFlowControlPause)
+    required: false
+  purge_delay:
+    description:
+      Seconds the state information is kept before it is purged
+      (nsds5ReplicaPurgeDelay)
+    required: false
+  concurrency:
+    description: Maximum number of servers tuned at the same time
+    default: 10
+  timeout:
+    description: Timeout in seconds per server
+    default: 60
+author:
+    - Thomas Woerner
+"""
+
+EXAMPLES = """
+- ipareplicatuning:
+    ipaadmin_password: MyPassword123
+    dm_password: SomeDMpassword
+    changelog_max_age: 7d
+    busy_wait_time: 2
+    session_pause_time: 3
+    flow_control_window: 2000
+    flow_control_pause: 500
+"""
+
+RETURN = """
+servers:
+  description:
+    Per server if it has been changed, the modifications and per suffix
+    the effective values of the replica, the changelog and the agreements
+  returned: always
+  type: dict
+"""
+
+import os
+import re
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_text
+from ansible.module_utils.ansible_freeipa_module import temp_kinit, \
+    temp_kdestroy, valid_creds, api_connect, get_masters, \
+    ldap_server_connect, run_concurrently, get_agreements, replica_root, \
+    replica_entry, errors, DN, REPLICA_MAPPING_TREE
+
+# Option, attribute and the entry the attribute is set in
+SETTINGS = [
+    ("changelog_max_age", "nsslapd-changelogmaxage", "changelog"),
+    ("changelog_max_entries", "nsslapd-changelogmaxentries", "changelog"),
+    ("busy_wait_time", "nsds5replicabusywaittime", "agreement"),
+    ("session_pause_time", "nsds5replicasessionpausetime", "agreement"),
+    ("flow_control_window", "nsds5replicaflowcontrolwindow", "agreement"),
+    ("flow_control_pause", "nsds5replicaflowcontrolpause", "agreement"),
+    ("purge_delay", "nsds5replicapurgedelay", "replica"),
+]
+
+# Global changelog of 389-DS before 1.4.4, newer versions have a changelog
+# per backend
+CHANGELOG5 = "cn=changelog5,cn=config"
+
+
+def changelog_entry(conn, suffix, attrs):
+    """
+    Return the changelog entry that is used for suffix. The changelog of
+    the backend is used if it exists, a global changelog5 entry can be
+    left over from an update and is ignored then.
+    """
+    mapping = conn.get_entry(
+        DN(("cn", str(replica_root(suffix))), DN(REPLICA_MAPPING_TREE)),
+        ["nsslapd-backend"])
+    backend = to_text(mapping.single_value["nsslapd-backend"])
+    try:
+        return conn.get_entry(
+            DN(("cn", "changelog"), ("cn", backend), ("cn", "ldbm database"),
+               ("cn", "plugins"), ("cn", "config")), attrs)
+    except errors.NotFound:
+        return conn.get_entry(DN(CHANGELOG5), attrs)
+
+
+def tune_entry(conn, entry, settings, check_mode):
+    """
+    Set the settings in entry, return the modifications and the effective
+    values
+    """
+    modifications = []
+    for attr, value in settings.items():
+        current = entry.single_value.get(attr)
+        if current is None or to_text(current) != value:
+            modifications.append("%s: %s: %s -> %s" % (
+                entry.dn, attr, to_text(current) if current is not None
+                else None, value))
+            entry[attr] = [value]
+    if modifications and not check_mode:
+        conn.update_entry(entry)
+    return modifications, dict(
+        (attr, to_text(entry.single_value[attr])
+         if entry.get(attr) else None) for attr in settings)
+
+
+def tune_server(host, suffixes, desired, dm_password, timeout, check_mode):
+    conn = ldap_server_connect(host, dm_password, timeout)
+    try:
+        result = {"changed": False, "modifications": [], "suffixes": {}}
+        # The effective values per entry DN, the global changelog5 entry
+        # is shared by the suffixes and is only tuned once
+        tuned = {}
+        for suffix in suffixes:
+            effective = {}
+            for kind in ["replica", "changelog", "agreement"]:
+                settings = desired[kind]
+                if not settings:
+                    continue
+                attrs = list(settings)
+                if kind == "replica":
+                    entries = [("replica",
+                                replica_entry(conn, suffix, attrs))]
+                elif kind == "changelog":
+                    entries = [("changelog",
+                                changelog_entry(conn, suffix, attrs))]
+                else:
+                    entries = [
+                        (to_text(entry.single_value["nsds5replicahost"]),
+                         entry)
+                        for entry in get_agreements(
+                            conn, suffix, attrs + ["nsds5replicahost"])]
+                for key, entry in entries:
+                    dn = str(entry.dn)
+                    if dn not in tuned:
+                        modifications, tuned[dn] = tune_entry(
+                            conn, entry, settings, check_mode)
+                        result["modifications"].extend(modifications)
+                    values = tuned[dn]
+                    if kind == "agreement":
+                        effective.setdefault("agreements", {})[key] = values
+                    else:
+                        effective[key] = values
+            result["suffixes"][suffix] = effective
+        result["changed"] = len(result["modifications"]) > 0
+        return result
+    finally:
+        conn.close()
+
+
+def main():
+    ansible_module = AnsibleModule(
+        argument_spec=dict(
+            ipaadmin_principal=dict(type="str", default="admin"),
+            ipaadmin_password=dict(type="str", required=False, no_log=True),
+            dm_password=dict(type="str", required=True, no_log=True),
+            servers=dict(type="list", default=None),
+            suffix=dict(choices=["domain", "ca", "domain+ca"],
+                        default="domain+ca"),
+            changelog_max_age=dict(type="str", default=None),
+            changelog_max_entries=dict(type="int", default=None),
+            busy_wait_time=dict(type="int", default=None),
+            session_pause_time=dict(type="int", default=None),
+            flow_control_window=dict(type="int", default=None),
+            flow_control_pause=dict(type="int", default=None),
+            purge_delay=dict(type="int", default=None),
+            concurrency=dict(type="int", default=10),
+            timeout=dict(type="int", default=60),
+        ),
+        supports_check_mode=True,
+    )
+
+    ansible_module._ansible_debug = True
+
+    # Get parameters
+
+    ipaadmin_principal = ansible_module.params.get("ipaadmin_principal")
+    ipaadmin_password = ansible_module.params.get("ipaadmin_password")
+    dm_password = ansible_module.params.get("dm_password")
+    servers = ansible_module.params.get("servers")
+    suffixes = ansible_module.params.get("suffix").split("+")
+    concurrency = ansible_module.params.get("concurrency")
+    timeout = ansible_module.params.get("timeout")
+
+    # Check parameters
+
+    desired = {"replica": {}, "changelog": {}, "agreement": {}}
+    for option, attr, kind in SETTINGS:
+        value = ansible_module.params.get(option)
+        if value is None:
+            continue
+        if option == "changelog_max_age":
+            if not re.match(r"^\d+[smhdw]?$", value):
+                ansible_module.fail_json(
+                    msg="Invalid changelog_max_age '%s'" % value)
+        elif value < 0:
+            ansible_module.fail_json(msg="Invalid %s '%s'" % (option, value))
+        desired[kind][attr] = to_text(value)
+    if not any(desired.values()):
+        ansible_module.fail_json(msg="No setting given")
+
+    # Init
+
+    exit_args = {}
+    ccache_dir = None
+    ccache_name = None
+    try:
+        if servers is None:
+            if not valid_creds(ansible_module, ipaadmin_principal):
+                ccache_dir, ccache_name = temp_kinit(ipaadmin_principal,
+                                                     ipaadmin_password)
+                os.environ["KRB5CCNAME"] = ccache_name
+            api_connect()
+            servers = get_masters(ansible_module)
+
+        # Tune all servers concurrently
+
+        results = run_concurrently(
+            lambda host: tune_server(host, suffixes, desired, dm_password,
+                                     timeout, ansible_module.check_mode),
+            servers, concurrency, timeout)
+
+    except Exception as e:
+        ansible_module.fail_json(msg=str(e))
+
+    finally:
+        temp_kdestroy(ccache_dir, ccache_name)
+
+    exit_args["servers"] = {}
+    failures = []
+    for host in servers:
+        result, error, _elapsed = results[host]
+        if error is not None:
+            result = {"changed": False, "error": error}
+            failures.append("%s: %s" % (host, error))
+        exit_args["servers"][host] = result
+    changed = any(x["changed"] for x in exit_args["servers"].values())
+
+    # Done
+
+    if failures:
+        ansible_module.fail_json(msg="; ".join(failures), changed=changed,
+                                 **exit_args)
+
+    ansible_module.exit_json(changed=changed, **exit_args)
+
+
+if __name__ == "__main__":
+    main()
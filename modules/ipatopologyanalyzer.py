@@ -0,0 +1,378 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Thomas Woerner <twoerner@redhat.com>
+#
+# Copyright (C) 2019 Red Hat
+# see file 'COPYING' for use and warranty information
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+ANSIBLE_METADATA = {
+    "metadata_version": "1.0",
+    "supported_by": "community",
+    "status": ["preview"],
+}
+
+DOCUMENTATION = """
+---
+module: ipatopologyanalyzer
+short description: Analyze the FreeIPA replication topology
+description:
+  Analyze the replication topology of the domain and ca suffixes. The
+  connectivity, the diameter (the maximum number of replication hops), the
+  degree of every node and the single points of failure (nodes and
+  segments whose loss disconnects the topology) are reported. Optionally
+  a segment set is suggested that keeps every node within max_hops hops
+  while no node has more than max_degree segments. The suggested segments
+  can be used with ipatopologysegment in state exact.
+options:
+  ipaadmin_principal:
+    description: The admin principal
+    default: admin
+  ipaadmin_password:
+    description: The admin password
+    required: false
+  suffix:
+    description: Topology suffix
+    default: domain+ca
+    choices: ["domain", "ca", "domain+ca"]
+  max_degree:
+    description: The recommended maximum number of segments per server
+    default: 4
+  max_hops:
+    description: The maximum number of hops for the suggested segments
+    default: 4
+  suggest:
+    description: Suggest a segment set
+    type: bool
+    default: false
+  use_locations:
+    description:
+      Use the IPA locations of the servers for the suggestion. Servers of a
+      location are placed next to each other and segments within a
+      location are preferred, to keep the number of segments between sites
+      low.
+    type: bool
+    default: false
+author:
+    - Thomas Woerner
+"""
+
+EXAMPLES = """
+- ipatopologyanalyzer:
+    ipaadmin_password: MyPassword123
+    suffix: domain
+    suggest: yes
+    max_hops: 4
+    use_locations: yes
+  register: result
+
+- ipatopologysegment:
+    ipaadmin_password: MyPassword123
+    suffix: domain
+    segments: "{{ result.topology.domain.suggestion.segments }}"
+    state: exact
+"""
+
+RETURN = """
+topology:
+  description:
+    Per suffix the nodes, the number of segments, if the topology is
+    connected, the connected components, the diameter, the eccentricity and
+    the degree per node, the nodes over max_degree, the articulation
+    points, the bridges and the suggestion if suggest is set
+  returned: always
+  type: dict
+"""
+
+from collections import deque
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_text
+from ansible.module_utils.ansible_freeipa_module import temp_kinit, \
+    temp_kdestroy, valid_creds, api_connect, api_command, api_find_all
+
+
+def get_servers(module):
+    """
+    Return dict of the IPA masters and their location
+    """
+    _result = api_command(module, "server_find", None,
+                          {"all": True, "sizelimit": 0})
+    servers = {}
+    for server in _result["result"]:
+        location = server.get("ipalocation_location")
+        servers[to_text(server["cn"][0]).lower()] = \
+            to_text(location[0]) if location else None
+    return servers
+
+
+def get_ca_servers(module):
+    """
+    Return the set of the enabled CA servers
+    """
+    _result = api_command(module, "server_role_find", None,
+                          {"role_servrole": u"CA server",
+                           "status": u"enabled"})
+    # server_server is a string, not a list
+    return set(to_text(role["server_server"]).lower()
+               for role in _result["result"])
+
+
+def get_segments(module, suffix):
+    """
+    Return the list of the left and right nodes of the segments of suffix
+    """
+    return [(to_text(entry["iparepltoposegmentleftnode"][0]).lower(),
+             to_text(entry["iparepltoposegmentrightnode"][0]).lower())
+            for entry in api_find_all(module, "topologysegment_find", "cn",
+                                      suffix=to_text(suffix)).values()]
+
+
+def adjacency_of(nodes, segments):
+    adjacency = dict((node, set()) for node in nodes)
+    for left, right in segments:
+        adjacency.setdefault(left, set()).add(right)
+        adjacency.setdefault(right, set()).add(left)
+    return adjacency
+
+
+def distances(adjacency, start):
+    """
+    Return the hop counts from start to all reachable nodes
+    """
+    dist = {start: 0}
+    todo = deque([start])
+    while todo:
+        node = todo.popleft()
+        for other in adjacency[node]:
+            if other not in dist:
+                dist[other] = dist[node] + 1
+                todo.append(other)
+    return dist
+
+
+def components_of(adjacency):
+    components = []
+    seen = set()
+    for node in sorted(adjacency):
+        if node not in seen:
+            component = sorted(distances(adjacency, node))
+            seen.update(component)
+            components.append(component)
+    return components
+
+
+def eccentricities(adjacency):
+    """
+    Return the eccentricity per node, None if the graph is not connected
+    """
+    result = {}
+    for node in adjacency:
+        dist = distances(adjacency, node)
+        if len(dist) != len(adjacency):
+            return None
+        result[node] = max(dist.values())
+    return result
+
+
+def cut_points(adjacency):
+    """
+    Return the articulation points and the bridges (iterative DFS with low
+    links)
+    """
+    index = {}
+    low = {}
+    points = set()
+    bridges = []
+    for root in sorted(adjacency):
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        root_children = 0
+        work = [(root, None, iter(sorted(adjacency[root])))]
+        while work:
+            node, parent, children = work[-1]
+            for child in children:
+                if child == parent:
+                    continue
+                if child in index:
+                    low[node] = min(low[node], index[child])
+                    continue
+                index[child] = low[child] = len(index)
+                work.append((child, node, iter(sorted(adjacency[child]))))
+                break
+            else:
+                work.pop()
+                if parent is None:
+                    continue
+                low[parent] = min(low[parent], low[node])
+                if parent == root:
+                    root_children += 1
+                elif low[node] >= index[parent]:
+                    points.add(parent)
+                if low[node] > index[parent]:
+                    bridges.append(sorted([parent, node]))
+        if root_children > 1:
+            points.add(root)
+    return sorted(points), sorted(bridges)
+
+
+def analyze(nodes, segments, max_degree):
+    adjacency = adjacency_of(nodes, segments)
+    ecc = eccentricities(adjacency)
+    points, bridges = cut_points(adjacency)
+    degree = dict((node, len(adjacency[node])) for node in adjacency)
+    return {
+        "nodes": sorted(adjacency),
+        "segments": len(segments),
+        "connected": ecc is not None,
+        "components": components_of(adjacency),
+        "diameter": max(ecc.values()) if ecc else None,
+        "eccentricity": ecc,
+        "degree": degree,
+        "over_max_degree": sorted(node for node in degree
+                                  if degree[node] > max_degree),
+        "articulation_points": points,
+        "bridges": bridges,
+    }
+
+
+def suggest(nodes, locations, max_degree, max_hops):
+    """
+    Suggest segments: a ring with the nodes of a location next to each
+    other, then shortcuts between the most distant nodes with free degree
+    until the diameter is at most max_hops. Shortcuts within a location are
+    preferred for equal distances.
+    """
+    order = sorted(nodes, key=lambda node: (locations.get(node) or "", node))
+    segments = set()
+    if len(order) == 2:
+        segments.add(tuple(order))
+    elif len(order) > 2:
+        for i, node in enumerate(order):
+            segments.add(tuple(sorted([node, order[(i + 1) % len(order)]])))
+
+    adjacency = adjacency_of(order, segments)
+    while True:
+        dist = dict((node, distances(adjacency, node)) for node in order)
+        diameter = max([max(d.values()) for d in dist.values()] or [0])
+        if diameter <= max_hops:
+            break
+        candidates = [
+            (-dist[left][right],
+             locations.get(left) != locations.get(right), left, right)
+            for i, left in enumerate(order)
+            if len(adjacency[left]) < max_degree
+            for right in order[i + 1:]
+            if len(adjacency[right]) < max_degree and
+            dist[left][right] > 1]
+        if not candidates:
+            break
+        _dist, _remote, left, right = min(candidates)
+        segments.add(tuple(sorted([left, right])))
+        adjacency[left].add(right)
+        adjacency[right].add(left)
+
+    return sorted(segments), diameter
+
+
+def main():
+    ansible_module = AnsibleModule(
+        argument_spec=dict(
+            ipaadmin_principal=dict(type="str", default="admin"),
+            ipaadmin_password=dict(type="str", required=False, no_log=True),
+            suffix=dict(choices=["domain", "ca", "domain+ca"],
+                        default="domain+ca"),
+            max_degree=dict(type="int", default=4),
+            max_hops=dict(type="int", default=4),
+            suggest=dict(type="bool", default=False),
+            use_locations=dict(type="bool", default=False),
+        ),
+        supports_check_mode=True,
+    )
+
+    ansible_module._ansible_debug = True
+
+    # Get parameters
+
+    ipaadmin_principal = ansible_module.params.get("ipaadmin_principal")
+    ipaadmin_password = ansible_module.params.get("ipaadmin_password")
+    suffixes = ansible_module.params.get("suffix")
+    max_degree = ansible_module.params.get("max_degree")
+    max_hops = ansible_module.params.get("max_hops")
+    _suggest = ansible_module.params.get("suggest")
+    use_locations = ansible_module.params.get("use_locations")
+
+    # Check parameters
+
+    if max_degree < 2:
+        ansible_module.fail_json(msg="max_degree needs to be at least 2")
+    if max_hops < 1:
+        ansible_module.fail_json(msg="max_hops needs to be at least 1")
+
+    # Init
+
+    exit_args = {"topology": {}}
+    ccache_dir = None
+    ccache_name = None
+    try:
+        if not valid_creds(ansible_module, ipaadmin_principal):
+            ccache_dir, ccache_name = temp_kinit(ipaadmin_principal,
+                                                 ipaadmin_password)
+        api_connect()
+
+        servers = get_servers(ansible_module)
+        topology = {}
+        for suffix in suffixes.split("+"):
+            if suffix == "ca":
+                nodes = get_ca_servers(ansible_module)
+            else:
+                nodes = set(servers)
+            topology[suffix] = (nodes, get_segments(ansible_module, suffix))
+
+    except Exception as e:
+        ansible_module.fail_json(msg=str(e))
+
+    finally:
+        temp_kdestroy(ccache_dir, ccache_name)
+
+    # Analyze
+
+    locations = servers if use_locations else {}
+    for suffix, (nodes, segments) in topology.items():
+        result = analyze(nodes, segments, max_degree)
+        if _suggest:
+            suggested, diameter = suggest(result["nodes"], locations,
+                                          max_degree, max_hops)
+            current = set(tuple(sorted(segment)) for segment in segments)
+            result["suggestion"] = {
+                "segments": [{"left": left, "right": right}
+                             for left, right in suggested],
+                "diameter": diameter,
+                "satisfied": diameter <= max_hops,
+                "add": [list(x) for x in suggested if x not in current],
+                "delete": [list(x) for x in sorted(current)
+                           if x not in suggested],
+            }
+        exit_args["topology"][suffix] = result
+
+    # Done
+
+    ansible_module.exit_json(changed=False, **exit_args)
+
+
+if __name__ == "__main__":
+    main()
@@ -56,11 +56,36 @@ options:
     description: The direction a segment will be reinitialized
     required: false
     choices: ["left-to-right", "right-to-left"]
+  segments:
+    description:
+      The complete list of segments for state present or exact. Each
+      segment is a dict with left, right and optionally name. The segments
+      of all suffixes are fetched once, the segments to add and to delete
+      are computed locally. Segments are undirected, left and right can be
+      swapped. In state exact the segments that are not listed are
+      deleted, all additions are done before the first deletion and the
+      desired segments have to connect all nodes, the topology is never
+      disconnected while the changes are applied.
+    required: false
+    type: list
+  exact_max_delete:
+    description:
+      The maximum number of segments that may be deleted per suffix in state
+      exact
+    default: 100
+  mirror:
+    description:
+      Path of a local directory mirror created with ipamirror. Lookups are
+      answered from the mirror if it is not older than mirror_max_age.
+    required: false
+  mirror_max_age:
+    description: Maximum age of the mirror in seconds
+    default: 3600
   state:
     description: State to ensure
     default: present
     choices: ["present", "absent", "enabled", "disabled", "reinitialized"
-              "checked" ]
+              "checked", "exact"]
 author:
     - Thomas Woerner
 """
@@ -100,6 +125,16 @@ EXAMPLES = """
     left: ipaserver.test.local
     right: ipareplica1.test.local
     state: checked
+
+# Ensure the domain and ca topology is exactly a ring of four servers
+- ipatopologysegment:
+    suffix: domain+ca
+    segments:
+    - {left: ipaserver.test.local, right: ipareplica1.test.local}
+    - {left: ipareplica1.test.local, right: ipareplica2.test.local}
+    - {left: ipareplica2.test.local, right: ipareplica3.test.local}
+    - {left: ipareplica3.test.local, right: ipaserver.test.local}
+    state: exact
 """
 
 RETURN = """
@@ -111,49 +146,80 @@ not-found:
   description: List of not found segments
   returned: if state is checked
   type: list
+added:
+  description:
+    Per suffix the names of the added segments, in check mode the segments
+    that would be added
+  returned: if segments is set
+  type: dict
+deleted:
+  description:
+    Per suffix the names of the deleted segments, in check mode the
+    segments that would be deleted
+  returned: if state is exact
+  type: dict
 """
 
 from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils._text import to_text
 from ansible.module_utils.ansible_freeipa_module import temp_kinit, \
-    temp_kdestroy, valid_creds, api_connect, api_command
-
-
-def find_left_right(module, suffix, left, right):
-    _args = {
-        "iparepltoposegmentleftnode": to_text(left),
-        "iparepltoposegmentrightnode": to_text(right),
-    }
-    _result = api_command(module, "topologysegment_find",
-                          to_text(suffix), _args)
-    if len(_result["result"]) > 1:
+    temp_kdestroy, valid_creds, api_connect, api_command, mirror_open, \
+    api_find_all
+
+
+def find_segments(module, suffix, mirror=None):
+    """
+    Return all segments of suffix as dict indexed by the lower case name
+    """
+    if mirror is not None:
+        found, entries = mirror.search("topologysegment", suffix)
+        if found:
+            return dict((to_text(entry["cn"][0]).lower(), entry)
+                        for entry in entries)
+    return api_find_all(module, "topologysegment_find", "cn",
+                        suffix=to_text(suffix))
+
+
+def segment_pair(left, right):
+    return frozenset([to_text(left).lower(), to_text(right).lower()])
+
+
+class SegmentIndex(object):
+    """
+    All segments of a suffix, fetched once and indexed by the node pair and
+    by the lower case name. Segments are undirected, left and right can be
+    swapped for the lookups.
+    """
+
+    def __init__(self, module, suffix, mirror=None):
+        self.suffix = suffix
+        self.by_cn = find_segments(module, suffix, mirror)
+        self.by_pair = {}
+        for entry in self.by_cn.values():
+            pair = segment_pair(entry["iparepltoposegmentleftnode"][0],
+                                entry["iparepltoposegmentrightnode"][0])
+            self.by_pair.setdefault(pair, []).append(entry)
+
+
+def find_left_right(module, index, left, right):
+    entries = index.by_pair.get(segment_pair(left, right), [])
+    if len(entries) > 1:
         module.fail_json(
             msg="Combination of left node '%s' and right node '%s' is "
-            "not unique for suffix '%s'" % (left, right, suffix))
-    elif len(_result["result"]) == 1:
-        return _result["result"][0]
+            "not unique for suffix '%s'" % (left, right, index.suffix))
+    elif len(entries) == 1:
+        return entries[0]
     else:
         return None
 
 
-def find_cn(module, suffix, name):
-    _args = {
-        "cn": to_text(name),
-    }
-    _result = api_command(module, "topologysegment_find",
-                          to_text(suffix), _args)
-    if len(_result["result"]) > 1:
-        module.fail_json(
-            msg="CN '%s' is not unique for suffix '%s'" % (name, suffix))
-    elif len(_result["result"]) == 1:
-        return _result["result"][0]
-    else:
-        return None
+def find_cn(index, name):
+    return index.by_cn.get(to_text(name).lower())
 
 
-def find_left_right_cn(module, suffix, left, right, name):
+def find_left_right_cn(module, index, left, right, name):
     if left is not None and right is not None:
-        left_right = find_left_right(module, suffix, left, right)
+        left_right = find_left_right(module, index, left, right)
         if left_right is not None:
             if name is not None and \
                left_right["cn"][0] != to_text(name):
@@ -163,7 +229,7 @@ def find_left_right_cn(module, suffix, left, right, name):
             return left_right
         # else: Nothing to change
     elif name is not None:
-        cn = find_cn(module, suffix, name)
+        cn = find_cn(index, name)
         if cn is not None:
             return cn
         # else: Nothing to change
@@ -173,6 +239,106 @@ def find_left_right_cn(module, suffix, left, right, name):
     return None
 
 
+def check_segments(module, segments):
+    """
+    Check the segments, return dict of segments indexed by the node pair
+    """
+    _segments = {}
+    for segment in segments:
+        if not isinstance(segment, dict) or not segment.get("left") or \
+           not segment.get("right"):
+            module.fail_json(
+                msg="Each segment needs to be a dict with left and right")
+        for key in segment:
+            if key not in ["left", "right", "name"]:
+                module.fail_json(msg="Unknown key '%s' for segment" % key)
+        pair = segment_pair(segment["left"], segment["right"])
+        if len(pair) != 2:
+            module.fail_json(msg="Segment '%s' connects a node with itself" %
+                             segment["left"])
+        if pair in _segments:
+            module.fail_json(msg="Duplicate segment '%s' - '%s'" %
+                             (segment["left"], segment["right"]))
+        _segments[pair] = segment
+    return _segments
+
+
+def disconnected_nodes(nodes, pairs):
+    """
+    Return the sorted nodes that are not connected to the first node
+    """
+    adjacency = dict((node, set()) for node in nodes)
+    for pair in pairs:
+        left, right = tuple(pair)
+        adjacency.setdefault(left, set()).add(right)
+        adjacency.setdefault(right, set()).add(left)
+    if not adjacency:
+        return []
+    start = min(adjacency)
+    seen = set([start])
+    todo = [start]
+    while todo:
+        for node in adjacency[todo.pop()]:
+            if node not in seen:
+                seen.add(node)
+                todo.append(node)
+    return sorted(node for node in adjacency if node not in seen)
+
+
+def gen_segments_commands(module, index, segments, exact, max_delete):
+    """
+    Compute the commands to make the segments of the suffix of index match
+    segments. All additions are returned before the deletions, the
+    deletions keep the topology connected as the desired segments connect
+    all nodes.
+    """
+    suffix = index.suffix
+    current = dict((pair, entries[0])
+                   for pair, entries in index.by_pair.items())
+
+    add_commands = []
+    for pair, segment in sorted(segments.items(), key=lambda x: sorted(x[0])):
+        name = segment.get("name")
+        if pair in current:
+            if name is not None and \
+               current[pair]["cn"][0] != to_text(name):
+                module.fail_json(
+                    msg="Left and right nodes already used with different "
+                    "name (cn) '%s'" % current[pair]["cn"][0])
+            continue
+        if name is None:
+            name = "%s-to-%s" % (segment["left"], segment["right"])
+        add_commands.append(["topologysegment_add", {
+            "cn": to_text(name),
+            "iparepltoposegmentleftnode": to_text(segment["left"]),
+            "iparepltoposegmentrightnode": to_text(segment["right"]),
+        }, suffix])
+
+    del_commands = []
+    if exact:
+        nodes = set()
+        for pair in list(current) + list(segments):
+            nodes.update(pair)
+        disconnected = disconnected_nodes(nodes, segments)
+        if disconnected:
+            module.fail_json(
+                msg="The segments for suffix '%s' do not connect the nodes "
+                "%s" % (suffix, ", ".join(disconnected)))
+
+        names = sorted(
+            to_text(entry["cn"][0]) for pair, entries in index.by_pair.items()
+            if pair not in segments for entry in entries)
+        if max_delete is not None and len(names) > max_delete:
+            module.fail_json(
+                msg="Refusing to delete %d segments for suffix '%s', the "
+                "limit is %d (exact_max_delete)" %
+                (len(names), suffix, max_delete))
+        del_commands = [["topologysegment_del", {"cn": name}, suffix]
+                        for name in names]
+
+    return add_commands, del_commands
+
+
 def main():
     ansible_module = AnsibleModule(
         argument_spec=dict(
@@ -184,9 +350,13 @@ def main():
             right=dict(type="str", aliases=["rightnode"], default=None),
             direction=dict(type="str", default=None,
                            choices=["left-to-right", "right-to-left"]),
+            segments=dict(type="list", default=None),
+            exact_max_delete=dict(type="int", default=100),
+            mirror=dict(type="path", default=None),
+            mirror_max_age=dict(type="int", default=3600),
             state=dict(type="str", default="present",
                        choices=["present", "absent", "enabled", "disabled",
-                                "reinitialized", "checked"]),
+                                "reinitialized", "checked", "exact"]),
         ),
         supports_check_mode=True,
     )
@@ -202,6 +372,10 @@ def main():
     left = ansible_module.params.get("left")
     right = ansible_module.params.get("right")
     direction = ansible_module.params.get("direction")
+    segments = ansible_module.params.get("segments")
+    exact_max_delete = ansible_module.params.get("exact_max_delete")
+    mirror_path = ansible_module.params.get("mirror")
+    mirror_max_age = ansible_module.params.get("mirror_max_age")
     state = ansible_module.params.get("state")
 
     # Check parameters
@@ -209,6 +383,16 @@ def main():
     if state != "reinitialized" and direction is not None:
         ansible_module.fail_json(
             msg="Direction is not supported in this mode.")
+    if segments is not None:
+        if state not in ["present", "exact"]:
+            ansible_module.fail_json(
+                msg="segments is only supported in state present and exact")
+        if name is not None or left is not None or right is not None:
+            ansible_module.fail_json(
+                msg="name, left and right can not be used with segments")
+        segments = check_segments(ansible_module, segments)
+    elif state == "exact":
+        ansible_module.fail_json(msg="segments is needed for state exact")
 
     # Init
 
@@ -216,7 +400,9 @@ def main():
     exit_args = {}
     ccache_dir = None
     ccache_name = None
+    mirror = None
     try:
+        mirror = mirror_open(ansible_module, mirror_path, mirror_max_age)
         if not valid_creds(ansible_module, ipaadmin_principal):
             ccache_dir, ccache_name = temp_kinit(ipaadmin_principal,
                                                  ipaadmin_password)
@@ -224,7 +410,29 @@ def main():
 
         commands = []
 
-        for suffix in suffixes.split("+"):
+        if segments is not None:
+            # Additions of all suffixes first, then the deletions
+            exit_args["added"] = {}
+            if state == "exact":
+                exit_args["deleted"] = {}
+            del_commands = []
+            for suffix in suffixes.split("+"):
+                _add, _del = gen_segments_commands(
+                    ansible_module, SegmentIndex(ansible_module, suffix,
+                                                 mirror),
+                    segments, state == "exact", exact_max_delete)
+                commands.extend(_add)
+                del_commands.extend(_del)
+                exit_args["added"][suffix] = [x[1]["cn"] for x in _add]
+                if state == "exact":
+                    exit_args["deleted"][suffix] = [x[1]["cn"] for x in _del]
+            commands.extend(del_commands)
+
+        # Single segment, the segments list has been handled above
+        for suffix in suffixes.split("+") if segments is None else []:
+            # All lookups of the suffix use one fetch
+            index = SegmentIndex(ansible_module, suffix, mirror)
+
             # Create command
             if state in ["present", "enabled"]:
                 # Make sure topology segment exists
@@ -239,7 +447,7 @@ def main():
                 if name is not None:
                     args["cn"] = to_text(name)
 
-                res_left_right = find_left_right(ansible_module, suffix,
+                res_left_right = find_left_right(ansible_module, index,
                                                  left, right)
                 if res_left_right is not None:
                     if name is not None and \
@@ -266,7 +474,7 @@ def main():
             elif state in ["absent", "disabled"]:
                 # Make sure topology segment does not exist
 
-                res_find = find_left_right_cn(ansible_module, suffix,
+                res_find = find_left_right_cn(ansible_module, index,
                                               left, right, name)
                 if res_find is not None:
                     # Found either given name or found name from left and right
@@ -279,7 +487,7 @@ def main():
             elif state == "checked":
                 # Check if topology segment does exists
 
-                res_find = find_left_right_cn(ansible_module, suffix,
+                res_find = find_left_right_cn(ansible_module, index,
                                               left, right, name)
                 if res_find is not None:
                     # Found either given name or found name from left and right
@@ -296,7 +504,7 @@ def main():
                     ansible_module.fail_json(msg="Unknown direction '%s'" %
                                              direction)
 
-                res_find = find_left_right_cn(ansible_module, suffix,
+                res_find = find_left_right_cn(ansible_module, index,
                                               left, right, name)
                 if res_find is not None:
                     # Found either given name or found name from left and right
@@ -304,9 +512,18 @@ def main():
                     args = {
                         "cn": res_find["cn"][0]
                     }
-                    if direction == "left-to-right":
+                    _direction = direction
+                    _left = res_find["iparepltoposegmentleftnode"][0]
+                    if left is not None and \
+                       to_text(_left).lower() != to_text(left).lower():
+                        # The segment has been found with swapped nodes
+                        _direction = {
+                            "left-to-right": "right-to-left",
+                            "right-to-left": "left-to-right",
+                        }[direction]
+                    if _direction == "left-to-right":
                         args["left"] = True
-                    elif direction == "right-to-left":
+                    elif _direction == "right-to-left":
                         args["right"] = True
 
                     commands.append(["topologysegment_reinitialize", args,
@@ -326,17 +543,26 @@ def main():
             else:
                 ansible_module.fail_json(msg="Unkown state '%s'" % state)
 
-        # Execute command
+        # Execute command, in check mode the planned changes are only
+        # returned in added and deleted
+
+        if ansible_module.check_mode:
+            changed = len(commands) > 0
+            commands = []
 
         for command, args, _suffix in commands:
             api_command(ansible_module, command, to_text(_suffix), args)
             changed = True
+            if mirror is not None:
+                mirror.invalidate("topologysegment", args["cn"], _suffix)
 
     except Exception as e:
         ansible_module.fail_json(msg=str(e))
 
     finally:
         temp_kdestroy(ccache_dir, ccache_name)
+        if mirror is not None:
+            mirror.close()
 
     # Done
 
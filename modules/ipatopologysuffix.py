@@ -30,7 +30,11 @@ DOCUMENTATION = """
 ---
 module: ipatopologysuffix
 short description: Verify FreeIPA topology suffix
-description: Verify FreeIPA topology suffix
+description:
+  Verify FreeIPA topology suffix. The verification result is returned, the
+  module never changes the topology. With cache the result is stored per
+  hash of the segments and servers of the suffix, repeated verifications
+  of an unchanged topology skip the server side graph check.
 options:
   ipaadmin_principal:
     description: The admin principal
@@ -46,6 +50,13 @@ options:
     description: State to ensure
     default: verified
     choices: ["verified"]
+  cache:
+    description: Path of the cache file for the verification results
+    required: false
+  fail_on_error:
+    description: Fail if the topology is not in order
+    type: bool
+    default: false
 author:
     - Thomas Woerner
 """
@@ -54,14 +65,113 @@ EXAMPLES = """
 - ipatopologysuffix:
     suffix: domain
     state: verified
+
+- ipatopologysuffix:
+    suffix: domain
+    cache: /var/tmp/ipa-topology-verify.json
+    fail_on_error: yes
+  register: result
 """
 
 RETURN = """
+verify:
+  description: The verification result
+  returned: always
+  type: dict
+  contains:
+    in_order:
+      description: True if the topology has no errors
+      type: bool
+    connect_errors:
+      description:
+        Per server with connection errors the reachable and the
+        unreachable servers
+      type: list
+    max_agmts_errors:
+      description:
+        The servers with more than max_agmts agreements and their
+        replication partners
+      type: list
+    max_agmts:
+      description: The recommended maximum number of agreements per server
+      type: int
+    disconnected:
+      description: The servers that are unreachable from any other server
+      type: list
+    cached:
+      description: True if the result has been taken from the cache
+      type: bool
 """
 
+import os
+import json
+import hashlib
+import tempfile
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils._text import to_text
-from ansible.module_utils.ansible_freeipa_module import execute_api_command
+from ansible.module_utils._text import to_text, to_bytes
+from ansible.module_utils.ansible_freeipa_module import temp_kinit, \
+    temp_kdestroy, valid_creds, api_connect, api_command, api_find_all, \
+    get_masters
+
+
+def topology_hash(module, suffix):
+    """
+    Return a hash of the segments and the servers of suffix
+    """
+    segments = sorted(
+        "%s:%s:%s" % (to_text(entry["cn"][0]),
+                      to_text(entry["iparepltoposegmentleftnode"][0]),
+                      to_text(entry["iparepltoposegmentrightnode"][0]))
+        for entry in api_find_all(module, "topologysegment_find", "cn",
+                                  suffix=to_text(suffix)).values())
+    data = "\n".join([suffix] + get_masters(module) + segments)
+    return hashlib.sha256(to_bytes(data)).hexdigest()
+
+
+def verify_result(result):
+    """
+    Convert the topologysuffix_verify result to structured data
+    """
+    connect_errors = []
+    disconnected = set()
+    for server, reachable, unreachable in result.get("connect_errors", []):
+        connect_errors.append({
+            "server": to_text(server),
+            "reachable": sorted(to_text(x) for x in reachable),
+            "unreachable": sorted(to_text(x) for x in unreachable),
+        })
+        disconnected.update(to_text(x) for x in unreachable)
+    # A server is only disconnected if no other server reaches it
+    for error in connect_errors:
+        disconnected.difference_update(error["reachable"])
+    return {
+        "in_order": bool(result.get("in_order")),
+        "connect_errors": connect_errors,
+        "max_agmts_errors": [
+            {"server": to_text(server),
+             "agreements": sorted(to_text(x) for x in agreements)}
+            for server, agreements in result.get("max_agmts_errors", [])],
+        "max_agmts": result.get("max_agmts"),
+        "disconnected": sorted(disconnected),
+    }
+
+
+def load_cache(path):
+    if path is None or not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def write_cache(path, cache):
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix=".ipatopology-")
+    with os.fdopen(fd, "w") as f:
+        json.dump(cache, f)
+    os.rename(temp_path, path)
 
 
 def main():
@@ -72,6 +182,8 @@ def main():
             suffix=dict(choices=["domain", "ca"], required=True),
             state=dict(type="str", default="verified",
                        choices=["verified"]),
+            cache=dict(type="path", default=None),
+            fail_on_error=dict(type="bool", default=False),
         ),
         supports_check_mode=True,
     )
@@ -84,6 +196,8 @@ def main():
     ipaadmin_password = ansible_module.params.get("ipaadmin_password")
     suffix = ansible_module.params.get("suffix")
     state = ansible_module.params.get("state")
+    cache_path = ansible_module.params.get("cache")
+    fail_on_error = ansible_module.params.get("fail_on_error")
 
     # Check parameters
 
@@ -99,12 +213,49 @@ def main():
 
     # Execute command
 
-    execute_api_command(ansible_module, ipaadmin_principal, ipaadmin_password,
-                        command, to_text(suffix), args)
+    ccache_dir = None
+    ccache_name = None
+    try:
+        if not valid_creds(ansible_module, ipaadmin_principal):
+            ccache_dir, ccache_name = temp_kinit(ipaadmin_principal,
+                                                 ipaadmin_password)
+        api_connect()
+
+        key = None
+        cache = {}
+        if cache_path is not None:
+            key = topology_hash(ansible_module, suffix)
+            cache = load_cache(cache_path)
+
+        if key is not None and key in cache:
+            verify = dict(cache[key], cached=True)
+        else:
+            _result = api_command(ansible_module, command, to_text(suffix),
+                                  args)
+            verify = verify_result(_result["result"])
+            if key is not None:
+                # Only the current topology of every suffix is kept
+                cache = dict((k, v) for k, v in cache.items()
+                             if v.get("suffix") != suffix)
+                cache[key] = dict(verify, suffix=suffix)
+                write_cache(cache_path, cache)
+            verify["cached"] = False
+        verify.pop("suffix", None)
+
+    except Exception as e:
+        ansible_module.fail_json(msg=str(e))
+
+    finally:
+        temp_kdestroy(ccache_dir, ccache_name)
+
+    if fail_on_error and not verify["in_order"]:
+        ansible_module.fail_json(
+            msg="Topology of suffix '%s' is not in order" % suffix,
+            verify=verify)
 
     # Done
 
-    ansible_module.exit_json(changed=True)
+    ansible_module.exit_json(changed=False, verify=verify)
 
 
 if __name__ == "__main__":
@@ -41,6 +41,16 @@ options:
   name:
     description: The list of users (internally uid).
     required: false
+  users:
+    description:
+      List of users for bulk mode and the complete list of users for state
+      exact. Each user is a dict with name and the user settings (first,
+      last, fullname, displayname, homedir, shell, email, principalname,
+      passwordexpiration, password, uid, gid, phone and title). The
+      settings can only be used with states present and exact.
+    required: false
+    type: list
+    elements: dict
   first:
     description: The first name
     required: false
@@ -108,12 +118,22 @@ options:
   preserve:
     description: Delete a user, keeping the entry available for future use
     required: false
+  exact_max_delete:
+    description:
+      The maximum number of users that may be deleted in state exact
+    default: 100
+  exact_protect:
+    description: List of users that will never be deleted in state exact
+    default: ["admin"]
+    type: list
   state:
     description: State to ensure
     default: present
     choices: ["present", "absent",
               "enabled", "disabled",
-              "unlocked", "undeleted"]
+              "unlocked", "undeleted", "exact"]
+extends_documentation_fragment:
+  - ipaapi
 author:
     - Thomas Woerner
 """
@@ -170,19 +190,84 @@ EXAMPLES = """
     ipaadmin_password: MyPassword123
     name: pinky,brain
     state: disabled
+
+# Ensure pinky and brain are the only users besides admin
+- ipauser:
+    ipaadmin_password: MyPassword123
+    users:
+    - name: pinky
+      first: pinky
+      last: Acme
+    - name: brain
+      first: brain
+      last: Acme
+    exact_max_delete: 10
+    state: exact
 """
 
 RETURN = """
+commands:
+  description:
+    The planned commands in check mode. Each command has name, command,
+    args and the entry state as precondition, it can be applied with the
+    plan option.
+  returned: in check mode
+  type: list
+ldif_records:
+  description: The number of change records written to the LDIF file
+  returned: if ldif is set
+  type: int
+retries:
+  description:
+    The retry statistics, number of retries, retried commands, recovered
+    and already applied commands, gave up commands and the backoff delay
+  returned: always
+  type: dict
+throttle:
+  description:
+    The throttle statistics, commands, average and maximum latency per
+    command, the final and maximum limit, the number of decreases and the
+    wait time
+  returned: if the throttle is used
+  type: dict
+ipaapi_server:
+  description: The server selected with ipaapi_server auto
+  returned: if ipaapi_server is auto
+  type: str
+shards:
+  description:
+    The shard statistics, commands and elapsed time per server, the wait
+    times for replication and the servers that get a DNA range on demand
+  returned: if ipaapi_shards is used
+  type: dict
+results:
+  description: The per user results in bulk mode
+  returned: if users is set
+  type: list
 """
 
 from ansible.module_utils.basic import AnsibleModule
 from ansible.module_utils._text import to_text
-from ansible.module_utils.ansible_freeipa_module import temp_kinit, \
-    temp_kdestroy, valid_creds, api_connect, api_command, date_format, \
-    compare_args_ipa
+from ansible.module_utils.ansible_freeipa_module import api_command, \
+    compare_args_ipa, mirror_open, api_paged_index, exact_delete_names, \
+    check_items, item_argument_spec, check_plan, ipaapi_argument_spec, \
+    ipaapi_connect, ipaapi_execute, ipaapi_disconnect, ipaapi_stats, \
+    gen_user_args, gen_user_item_args, format_passwordexpiration, USER_KEYS
+
+# The attributes compared in state exact
+EXACT_ATTRS = ["givenname", "sn", "cn", "displayname", "homedirectory",
+               "loginshell", "mail", "krbprincipalname",
+               "krbpasswordexpiration", "uidnumber", "gidnumber",
+               "telephonenumber", "title"]
+
+
+def find_user(module, name, preserved=False, mirror=None):
+    if mirror is not None:
+        found, entry = mirror.lookup(
+            "user_preserved" if preserved else "user", name)
+        if found:
+            return entry
 
-
-def find_user(module, name, preserved=False):
     _args = {
         "all": True,
         "uid": to_text(name),
@@ -201,53 +286,56 @@ def find_user(module, name, preserved=False):
         return None
 
 
-def gen_args(first, last, fullname, displayname, homedir, shell, emails,
-             principalname, passwordexpiration, password, uid, gid,
-             phones, title, sshpubkey):
-    _args = {}
-    if first is not None:
-        _args["givenname"] = first
-    if last is not None:
-        _args["sn"] = last
-    if fullname is not None:
-        _args["cn"] = fullname
-    if displayname is not None:
-        _args["displayname"] = displayname
-    if homedir is not None:
-        _args["homedirectory"] = homedir
-    if shell is not None:
-        _args["loginshell"] = shell
-    if emails is not None and len(emails) > 0:
-        _args["mail"] = emails
-    if principalname is not None:
-        _args["krbprincipalname"] = principalname
-    if passwordexpiration is not None:
-        _args["krbpasswordexpiration"] = passwordexpiration
-    if password is not None:
-        _args["userpassword"] = password
-    if uid is not None:
-        _args["uidnumber"] = str(uid)
-    if gid is not None:
-        _args["gidnumber"] = str(gid)
-    if phones is not None and len(phones) > 0:
-        _args["telephonenumber"] = phones
-    if title is not None:
-        _args["title"] = title
-    if sshpubkey is not None:
-        _args["ipasshpubkey"] = sshpubkey
-
-    return _args
+def gen_exact_commands(module, users, preserve, update_password,
+                       max_delete, protect):
+    """
+    Compute the commands to make the active users match users exactly
+    """
+    desired = check_items(module, users, USER_KEYS)
+    for name, item in desired.items():
+        if item.get("first") is None or item.get("last") is None:
+            module.fail_json(msg="First and last name are needed for "
+                             "user '%s'" % item["name"])
+
+    current = api_paged_index(module, "user", EXACT_ATTRS)
+    preserved = api_paged_index(module, "user_preserved", EXACT_ATTRS)
+
+    commands = []
+    for name, item in desired.items():
+        args = gen_user_item_args(item)
+        res_find = current.get(name)
+        if res_find is None and name in preserved:
+            commands.append([item["name"], "user_undel", {}])
+            res_find = preserved[name]
+
+        if res_find is not None:
+            if update_password == "on_create" and "userpassword" in args:
+                del args["userpassword"]
+            if not compare_args_ipa(module, args, res_find):
+                commands.append([item["name"], "user_mod", args])
+        else:
+            commands.append([item["name"], "user_add", args])
+
+    for name in exact_delete_names(module, current, desired, protect,
+                                   max_delete):
+        args = {}
+        if preserve is not None:
+            args["preserve"] = preserve
+        commands.append([current[name]["uid"][0], "user_del", args])
+
+    return commands
 
 
 def main():
     ansible_module = AnsibleModule(
         argument_spec=dict(
+            ipaapi_argument_spec(),
             # general
             ipaadmin_principal=dict(type="str", default="admin"),
             ipaadmin_password=dict(type="str", required=False, no_log=True),
-
             name=dict(type="list", aliases=["login"], default=None,
-                      required=True),
+                      required=False),
+            users=item_argument_spec(USER_KEYS),
             # present
             first=dict(type="str", aliases=["givenname"], default=None),
             last=dict(type="str", default=None),
@@ -272,10 +360,13 @@ def main():
                                  choices=['always', 'on_create']),
             # deleted
             preserve=dict(required=False, type='bool', default=None),
+            # exact
+            exact_max_delete=dict(type="int", default=100),
+            exact_protect=dict(type="list", default=["admin"]),
             # state
             state=dict(type="str", default="present",
                        choices=["present", "absent", "enabled", "disabled",
-                                "unlocked", "undeleted"]),
+                                "unlocked", "undeleted", "exact"]),
         ),
         supports_check_mode=True,
     )
@@ -288,6 +379,7 @@ def main():
     ipaadmin_principal = ansible_module.params.get("ipaadmin_principal")
     ipaadmin_password = ansible_module.params.get("ipaadmin_password")
     names = ansible_module.params.get("name")
+    users = ansible_module.params.get("users")
 
     # present
     first = ansible_module.params.get("first")
@@ -300,9 +392,7 @@ def main():
     principalname = ansible_module.params.get("principalname")
     passwordexpiration = ansible_module.params.get("passwordexpiration")
     if passwordexpiration is not None:
-        if passwordexpiration[:-1] != "Z":
-            passwordexpiration = "%sZ" % passwordexpiration
-        passwordexpiration = date_format(passwordexpiration)
+        passwordexpiration = format_passwordexpiration(passwordexpiration)
     password = ansible_module.params.get("password")
     uid = ansible_module.params.get("uid")
     gid = ansible_module.params.get("gid")
@@ -312,12 +402,53 @@ def main():
     update_password = ansible_module.params.get("update_password")
     # deleted
     preserve = ansible_module.params.get("preserve")
+    # exact
+    exact_max_delete = ansible_module.params.get("exact_max_delete")
+    exact_protect = ansible_module.params.get("exact_protect")
+    # plan
+    plan = ansible_module.params.get("plan")
+    # mirror
+    mirror_path = ansible_module.params.get("mirror")
+    mirror_max_age = ansible_module.params.get("mirror_max_age")
     # state
     state = ansible_module.params.get("state")
 
     # Check parameters
 
-    if state == "present":
+    if plan is not None:
+        if names is not None or users is not None:
+            ansible_module.fail_json(
+                msg="plan can not be used together with name or users")
+        names = []
+    elif users is not None:
+        if names is not None:
+            ansible_module.fail_json(
+                msg="name can not be used together with users")
+        for x in ["first", "last", "fullname", "displayname", "homedir",
+                  "shell", "emails", "principalname", "passwordexpiration",
+                  "password", "uid", "gid", "phones", "title", "sshpubkey"]:
+            if vars()[x] is not None:
+                ansible_module.fail_json(
+                    msg="Argument '%s' can not be used together with users, "
+                    "set it in users" % x)
+        items = check_items(ansible_module, users, USER_KEYS)
+        for item in items.values():
+            if state == "present":
+                if item.get("first") is None or item.get("last") is None:
+                    ansible_module.fail_json(
+                        msg="First and last name are needed for user '%s'" %
+                        item["name"])
+            elif state != "exact" and len(item) > 1:
+                ansible_module.fail_json(
+                    msg="Only name can be set in users with state '%s'" %
+                    state)
+        names = []
+    elif state == "exact":
+        ansible_module.fail_json(msg="users is needed for state exact")
+    elif names is None:
+        ansible_module.fail_json(msg="name is needed")
+
+    if state == "present" and users is None and plan is None:
         if len(names) != 1:
             ansible_module.fail_json(
                 msg="Only one user can be added at a time.")
@@ -327,7 +458,7 @@ def main():
             ansible_module.fail_json(msg="Last name is needed")
 
     if state == "absent":
-        if len(names) < 1:
+        if len(names) < 1 and users is None and plan is None:
             ansible_module.fail_json(
                 msg="No name given.")
         for x in ["first", "last", "fullname", "displayname", "homedir",
@@ -338,10 +469,11 @@ def main():
                 ansible_module.fail_json(
                     msg="Argument '%s' can not be used with state '%s'" %
                     (x, state))
-    else:
+    elif state != "exact":
         if preserve is not None:
             ansible_module.fail_json(
-                msg="Preserve is only possible for state=absent")
+                msg="Preserve is only possible for state=absent or "
+                "state=exact")
 
     if update_password is None:
         update_password = "always"
@@ -352,25 +484,59 @@ def main():
     exit_args = {}
     ccache_dir = None
     ccache_name = None
+    mirror = None
     try:
-        if not valid_creds(ansible_module, ipaadmin_principal):
-            ccache_dir, ccache_name = temp_kinit(ipaadmin_principal,
-                                                 ipaadmin_password)
-        api_connect()
+        mirror = mirror_open(ansible_module, mirror_path, mirror_max_age)
+        ccache_dir, ccache_name, exit_args = ipaapi_connect(
+            ansible_module, ipaadmin_principal, ipaadmin_password)
 
         commands = []
 
-        for name in names:
+        if plan is not None:
+            commands = check_plan(ansible_module, "user", plan,
+                                  password)
+            bulk = []
+        elif state == "exact":
+            commands = gen_exact_commands(
+                ansible_module, users, preserve, update_password,
+                exact_max_delete, exact_protect)
+            bulk = []
+        elif users is not None:
+            bulk = [(item["name"], item) for item in users]
+        else:
+            bulk = [(name, None) for name in names]
+
+        for name, item in bulk:
+            if item is not None:
+                # Bulk mode: the settings are given per user
+                first = item.get("first")
+                last = item.get("last")
+                fullname = item.get("fullname")
+                displayname = item.get("displayname")
+                homedir = item.get("homedir")
+                shell = item.get("shell")
+                emails = item.get("email")
+                principalname = item.get("principalname")
+                passwordexpiration = item.get("passwordexpiration")
+                if passwordexpiration is not None:
+                    passwordexpiration = format_passwordexpiration(
+                        passwordexpiration)
+                password = item.get("password")
+                uid = item.get("uid")
+                gid = item.get("gid")
+                phones = item.get("phone")
+                title = item.get("title")
+
             # Make sure user exists
-            res_find = find_user(ansible_module, name)
+            res_find = find_user(ansible_module, name, mirror=mirror)
             # Also search for preserved user
             res_find_preserved = find_user(ansible_module, name,
-                                           preserved=True)
+                                           preserved=True, mirror=mirror)
 
             # Create command
             if state == "present":
                 # Generate args
-                args = gen_args(
+                args = gen_user_args(
                     first, last, fullname, displayname, homedir, shell, emails,
                     principalname, passwordexpiration, password, uid, gid,
                     phones, title, sshpubkey)
@@ -434,22 +600,29 @@ def main():
 
         # Execute commands
 
-        for name, command, args in commands:
-            try:
-                api_command(ansible_module, command, to_text(name), args)
-                changed = True
-            except Exception as e:
-                ansible_module.fail_json(msg="%s: %s: %s" % (command, name,
-                                                             str(e)))
+        changed_names, _exit_args = ipaapi_execute(ansible_module, "user",
+                                                   commands, mirror)
+        exit_args.update(_exit_args)
+        if len(changed_names) > 0:
+            changed = True
+
+        if users is not None:
+            exit_args["results"] = [
+                {"name": item["name"],
+                 "changed": to_text(item["name"]).lower() in changed_names}
+                for item in users]
 
     except Exception as e:
         ansible_module.fail_json(msg=str(e))
 
     finally:
-        temp_kdestroy(ccache_dir, ccache_name)
+        ipaapi_disconnect(ccache_dir, ccache_name)
+        if mirror is not None:
+            mirror.close()
 
     # Done
 
+    exit_args.update(ipaapi_stats())
     ansible_module.exit_json(changed=changed, **exit_args)
 
 
@@ -0,0 +1,521 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Authors:
+#   Thomas Woerner <twoerner@redhat.com>
+#
+# Copyright (C) 2019 Red Hat
+# see file 'COPYING' for use and warranty information
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+ANSIBLE_METADATA = {
+    "metadata_version": "1.0",
+    "supported_by": "community",
+    "status": ["preview"],
+}
+
+DOCUMENTATION = """
+---
+module: ipauserimport
+short description: Import FreeIPA users from CSV or LDIF files
+description:
+  Import users from a CSV or LDIF file on the managed node. The file is
+  read row by row, the rows are looked up and written in chunks, so that
+  the memory usage does not depend on the file size. Existing users are
+  modified if their settings differ, new users are added. Failed rows are
+  reported and do not stop the import.
+options:
+  ipaadmin_principal:
+    description: The admin principal
+    default: admin
+  ipaadmin_password:
+    description: The admin password
+    required: false
+  src:
+    description: The CSV or LDIF file
+    required: true
+  format:
+    description: The file format (default from the file extension)
+    required: false
+    choices: ["csv", "ldif"]
+  delimiter:
+    description: The CSV field delimiter
+    default: ","
+  list_separator:
+    description: The separator for list values (email, phone) in CSV files
+    default: ";"
+  column_map:
+    description:
+      Map of CSV columns to the user settings, for example
+      {"mail": "email", "surname": "last"}
+    required: false
+    type: dict
+  ignore_columns:
+    description: CSV columns that are not imported
+    required: false
+    type: list
+  chunk_size:
+    description: The number of rows that are looked up and written at once
+    default: 500
+  update_password:
+    description:
+      Set password for a user only on creation or always
+    default: 'on_create'
+    choices: ["always", "on_create"]
+  max_failures:
+    description:
+      Stop the import after this number of failed rows, 0 for no limit
+    default: 0
+  retry_attempts:
+    description:
+      The maximum number of attempts per command for transient errors like
+      a busy or unwilling server and timeouts, 1 disables retries
+    default: 5
+  report_failures:
+    description: The maximum number of failed rows returned in failures
+    default: 1000
+author:
+    - Thomas Woerner
+notes:
+  - CSV files need a header line. The columns are name (or uid) and the
+    user settings of ipauser (first, last, fullname, displayname, homedir,
+    shell, email, principalname, passwordexpiration, password, uid, gid,
+    phone and title). The header is checked before the import, other
+    columns need to be mapped with column_map or ignored with
+    ignore_columns.
+  - LDIF files use the LDAP attribute names (uid, givenName, sn, cn,
+    displayName, homeDirectory, loginShell, mail, krbPrincipalName,
+    krbPasswordExpiration, userPassword, uidNumber, gidNumber,
+    telephoneNumber and title), other attributes are ignored.
+"""
+
+EXAMPLES = """
+- ipauserimport:
+    ipaadmin_password: MyPassword123
+    src: /var/tmp/hr-export.csv
+    chunk_size: 1000
+  register: result
+
+- debug:
+    msg: "{{ result.rows_per_second }} rows/s, {{ result.failed }} failed"
+"""
+
+RETURN = """
+rows:
+  description: Number of processed rows
+  returned: always
+  type: int
+added:
+  description: Number of added users
+  returned: always
+  type: int
+modified:
+  description: Number of modified users
+  returned: always
+  type: int
+unchanged:
+  description: Number of unchanged users
+  returned: always
+  type: int
+failed:
+  description: Number of failed rows
+  returned: always
+  type: int
+failures:
+  description: The failed rows with row number, name and error
+  returned: always
+  type: list
+elapsed:
+  description: The import time in seconds
+  returned: always
+  type: float
+rows_per_second:
+  description: Processed rows per second
+  returned: always
+  type: float
+retries:
+  description:
+    The retry statistics, number of retries, retried commands, recovered
+    and already applied commands, gave up commands and the backoff delay
+  returned: always
+  type: dict
+"""
+
+import csv
+import base64
+import io
+import time
+from datetime import datetime
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils._text import to_text
+from ansible.module_utils.six import PY2
+from ansible.module_utils.ansible_freeipa_module import temp_kinit, \
+    temp_kdestroy, valid_creds, api_connect, api_command_batch, \
+    api_paged_search, compare_args_ipa, normalize_item, gen_user_item_args, \
+    retry_configure, retry_stats, USER_KEYS, api, DN
+from ldap.filter import escape_filter_chars
+
+# LDIF attributes and the user settings
+LDIF_ATTRIBUTES = {
+    "uid": "name",
+    "givenname": "first",
+    "sn": "last",
+    "cn": "fullname",
+    "displayname": "displayname",
+    "homedirectory": "homedir",
+    "loginshell": "shell",
+    "mail": "email",
+    "krbprincipalname": "principalname",
+    "krbpasswordexpiration": "passwordexpiration",
+    "userpassword": "password",
+    "uidnumber": "uid",
+    "gidnumber": "gid",
+    "telephonenumber": "phone",
+    "title": "title",
+}
+
+# The LDAP attributes compared for existing users
+COMPARE_ATTRIBUTES = ["uid", "givenname", "sn", "cn", "displayname",
+                      "homedirectory", "loginshell", "mail",
+                      "krbprincipalname", "krbpasswordexpiration",
+                      "uidnumber", "gidnumber", "telephonenumber", "title"]
+
+
+def csv_columns(fieldnames, column_map, ignore_columns):
+    """
+    Return the user setting for every column of the CSV header, None for
+    ignored columns. Raise ValueError for unknown columns.
+    """
+    columns = {}
+    unknown = []
+    for column in fieldnames:
+        key = to_text(column).strip().lower()
+        if key in ignore_columns:
+            columns[column] = None
+            continue
+        if key in column_map:
+            key = column_map[key]
+        elif key in ["uid", "login"]:
+            key = "name"
+        if key != "name" and key not in USER_KEYS:
+            unknown.append(to_text(column))
+        columns[column] = key
+    if unknown:
+        raise ValueError("Unknown CSV columns: %s, use column_map or "
+                         "ignore_columns" % ", ".join(unknown))
+    return columns
+
+
+def read_csv(src, delimiter, column_map, ignore_columns):
+    """
+    Yield (row number, item) for all rows of a CSV file. The header is
+    checked before the first row.
+    """
+    if PY2:
+        f = open(src, "rb")
+    else:
+        f = io.open(src, "r", encoding="utf-8", newline="")
+    with f:
+        reader = csv.DictReader(f, delimiter=str(delimiter))
+        columns = csv_columns(reader.fieldnames or [], column_map,
+                              ignore_columns)
+        for row in reader:
+            item = {}
+            for key, value in row.items():
+                if key is None or value is None or value == "":
+                    continue
+                key = columns[key]
+                if key is None:
+                    continue
+                item[key] = to_text(value)
+            yield reader.line_num, item
+
+
+def read_ldif(src):
+    """
+    Yield (line number, item) for all entries of a LDIF file. The file is
+    read line by line, folded lines and base64 values are supported.
+    """
+    def _item(attrs):
+        item = {}
+        for attr, values in attrs.items():
+            key = LDIF_ATTRIBUTES.get(attr)
+            if key is None:
+                continue
+            if USER_KEYS.get(key) == "list":
+                item[key] = values
+            else:
+                item[key] = values[0]
+        return item
+
+    attrs = {}
+    start = None
+    line = None
+    with io.open(src, "r", encoding="utf-8") as f:
+        for number, raw in enumerate(f, 1):
+            raw = raw.rstrip("\r\n")
+            if raw.startswith(" ") and line is not None:
+                line += raw[1:]
+                continue
+            if line is not None:
+                attr, value = parse_ldif_line(line)
+                if attr not in ["dn", "changetype", "version"]:
+                    attrs.setdefault(attr, []).append(value)
+                line = None
+            if raw.startswith("#"):
+                continue
+            if raw == "":
+                if attrs:
+                    yield start, _item(attrs)
+                attrs = {}
+                start = None
+                continue
+            if start is None:
+                start = number
+            line = raw
+        if line is not None:
+            attr, value = parse_ldif_line(line)
+            if attr not in ["dn", "changetype", "version"]:
+                attrs.setdefault(attr, []).append(value)
+        if attrs:
+            yield start, _item(attrs)
+
+
+def parse_ldif_line(line):
+    attr, sep, value = line.partition(":")
+    if sep == "":
+        raise ValueError("Invalid LDIF line '%s'" % line)
+    if value.startswith(":"):
+        value = to_text(base64.b64decode(value[1:].strip()))
+    elif value.startswith("<"):
+        raise ValueError("URL values are not supported: '%s'" % line)
+    else:
+        value = value.strip()
+    return attr.strip().lower(), value
+
+
+def lookup_users(names):
+    """
+    Return the existing and preserved users of names with one search
+    """
+    ldap_filter = "(&(objectclass=posixaccount)(|%s))" % "".join(
+        "(uid=%s)" % escape_filter_chars(name) for name in names)
+    existing = {}
+    preserved = set()
+    for entry in api_paged_search(
+            DN(api.env.container_user, api.env.basedn), ldap_filter,
+            COMPARE_ATTRIBUTES):
+        name = to_text(entry.single_value["uid"]).lower()
+        existing[name] = dict(
+            (attr, [value if isinstance(value, datetime) else to_text(value)
+                    for value in entry.get(attr, [])])
+            for attr in COMPARE_ATTRIBUTES if attr in entry)
+    # Preserved users are stored in the provisioning container
+    for entry in api_paged_search(
+            DN(api.env.container_deleteuser, api.env.basedn), ldap_filter,
+            ["uid"]):
+        preserved.add(to_text(entry.single_value["uid"]).lower())
+    return existing, preserved
+
+
+class Importer(object):
+
+    def __init__(self, module, chunk_size, update_password, max_failures,
+                 report_failures):
+        self.module = module
+        self.chunk_size = chunk_size
+        self.update_password = update_password
+        self.max_failures = max_failures
+        self.report_failures = report_failures
+        self.chunk = []
+        self.seen = set()
+        self.stats = {"rows": 0, "added": 0, "modified": 0, "unchanged": 0,
+                      "failed": 0}
+        self.failures = []
+
+    def fail(self, row, name, error):
+        self.stats["failed"] += 1
+        if len(self.failures) < self.report_failures:
+            self.failures.append({"row": row, "name": name,
+                                  "error": to_text(error)})
+        if 0 < self.max_failures <= self.stats["failed"]:
+            self.module.fail_json(
+                msg="Import stopped after %d failed rows" %
+                self.stats["failed"], failures=self.failures, **self.stats)
+
+    def add(self, row, item, list_separator):
+        self.stats["rows"] += 1
+        try:
+            normalize_item(item, USER_KEYS, list_separator)
+            if item.get("first") is None or item.get("last") is None:
+                raise ValueError("First and last name are needed")
+            name = to_text(item["name"]).lower()
+            if name in self.seen:
+                # The names of the whole file are kept
+                raise ValueError("Duplicate user")
+            args = gen_user_item_args(item)
+        except ValueError as e:
+            self.fail(row, item.get("name") if isinstance(item, dict)
+                      else None, e)
+            return
+
+        self.seen.add(name)
+        self.chunk.append((row, item["name"], args))
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.chunk:
+            return
+
+        existing, preserved = lookup_users(
+            [to_text(name) for _row, name, _args in self.chunk])
+
+        commands = []
+        rows = []
+        for row, name, args in self.chunk:
+            key = to_text(name).lower()
+            if key in preserved:
+                self.fail(row, name, "User is preserved")
+            elif key in existing:
+                if self.update_password == "on_create" and \
+                   "userpassword" in args:
+                    del args["userpassword"]
+                if compare_args_ipa(self.module, args, existing[key]):
+                    self.stats["unchanged"] += 1
+                else:
+                    commands.append([name, "user_mod", args])
+                    rows.append(row)
+            else:
+                commands.append([name, "user_add", args])
+                rows.append(row)
+
+        if commands and not self.module.check_mode:
+            results = api_command_batch(self.module, commands)
+        else:
+            results = [{} for _command in commands]
+
+        for row, (name, command, _args), result in zip(rows, commands,
+                                                       results):
+            if result.get("error") is not None:
+                self.fail(row, name, result["error"])
+            elif command == "user_add":
+                self.stats["added"] += 1
+            else:
+                self.stats["modified"] += 1
+
+        self.chunk = []
+
+
+def main():
+    ansible_module = AnsibleModule(
+        argument_spec=dict(
+            ipaadmin_principal=dict(type="str", default="admin"),
+            ipaadmin_password=dict(type="str", required=False, no_log=True),
+            src=dict(type="path", required=True),
+            format=dict(type="str", default=None, choices=["csv", "ldif"]),
+            delimiter=dict(type="str", default=","),
+            list_separator=dict(type="str", default=";"),
+            column_map=dict(type="dict", default=None),
+            ignore_columns=dict(type="list", default=None),
+            chunk_size=dict(type="int", default=500),
+            update_password=dict(type='str', default="on_create",
+                                 choices=['always', 'on_create']),
+            max_failures=dict(type="int", default=0),
+            report_failures=dict(type="int", default=1000),
+            retry_attempts=dict(type="int", default=5),
+        ),
+        supports_check_mode=True,
+    )
+
+    ansible_module._ansible_debug = True
+
+    # Get parameters
+
+    ipaadmin_principal = ansible_module.params.get("ipaadmin_principal")
+    ipaadmin_password = ansible_module.params.get("ipaadmin_password")
+    src = ansible_module.params.get("src")
+    _format = ansible_module.params.get("format")
+    delimiter = ansible_module.params.get("delimiter")
+    list_separator = ansible_module.params.get("list_separator")
+    column_map = ansible_module.params.get("column_map") or {}
+    ignore_columns = ansible_module.params.get("ignore_columns") or []
+    chunk_size = ansible_module.params.get("chunk_size")
+    update_password = ansible_module.params.get("update_password")
+    max_failures = ansible_module.params.get("max_failures")
+    report_failures = ansible_module.params.get("report_failures")
+    retry_attempts = ansible_module.params.get("retry_attempts")
+
+    # Check parameters
+
+    if _format is None:
+        _format = "ldif" if src.lower().endswith(".ldif") else "csv"
+    if chunk_size < 1:
+        ansible_module.fail_json(msg="chunk_size needs to be at least 1")
+    column_map = dict((to_text(key).strip().lower(),
+                       to_text(value).strip().lower())
+                      for key, value in column_map.items())
+    ignore_columns = [to_text(x).strip().lower() for x in ignore_columns]
+    for key in column_map.values():
+        if key != "name" and key not in USER_KEYS:
+            ansible_module.fail_json(
+                msg="Unknown user setting '%s' in column_map" % key)
+
+    # Init
+
+    retry_configure(attempts=retry_attempts)
+    importer = Importer(ansible_module, chunk_size, update_password,
+                        max_failures, report_failures)
+    ccache_dir = None
+    ccache_name = None
+    start = time.time()
+    try:
+        if not valid_creds(ansible_module, ipaadmin_principal):
+            ccache_dir, ccache_name = temp_kinit(ipaadmin_principal,
+                                                 ipaadmin_password)
+        api_connect()
+
+        if _format == "csv":
+            rows = read_csv(src, delimiter, column_map, ignore_columns)
+        else:
+            rows = read_ldif(src)
+            # LDIF list values are already lists
+            list_separator = None
+
+        for row, item in rows:
+            importer.add(row, item, list_separator)
+        importer.flush()
+
+    except Exception as e:
+        ansible_module.fail_json(msg=str(e))
+
+    finally:
+        temp_kdestroy(ccache_dir, ccache_name)
+
+    # Done
+
+    elapsed = time.time() - start
+    stats = importer.stats
+    ansible_module.exit_json(
+        changed=stats["added"] + stats["modified"] > 0,
+        failures=importer.failures,
+        elapsed=round(elapsed, 3),
+        rows_per_second=round(stats["rows"] / elapsed, 1) if elapsed else 0,
+        retries=retry_stats(),
+        **stats)
+
+
+if __name__ == "__main__":
+    main()